@@ -9,4 +9,8 @@ app.config.from_object('config')
 # Setup the database.
 db = MongoEngine(app)
 
+# Record metrics, unless they're turned off.
+from app import metrics
+metrics.ENABLED = app.config.get('METRICS_ENABLED', True)
+
 from app import routes, config, notify
\ No newline at end of file
@@ -1,45 +1,140 @@
-from app.brain import twitter
-from app.brain.classifier import Classifier
-from app.brain.markov import Markov
+import time
+_import_started = time.monotonic()
+
+from app.brain import twitter, corpus, deltalog, lazy
+from app.brain.lazy import Lazy
+from app.brain.speech import SpeechPool
+from app.brain.tasks import Tasks
 from app.models import Muse, Tweet, Doc
 from app.config import config
+from app import metrics
 
 from tweepy.error import TweepError
-from mongoengine.errors import NotUniqueError, OperationError
+from mongoengine.errors import OperationError, ValidationError
 from pymongo.errors import DuplicateKeyError
 
-import random
+import random, threading
+from os import path
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import cpu_count
 
 # Logging
 from app.logger import logger
 logger = logger(__name__)
 
-# Load the classifier and markov.
-# Loaded here so we can keep it in memory.
+def _load_classifier():
+    from app.brain.classifier import Classifier
+    return Classifier(running_idf=True)
+
+def _load_markov(**kwargs):
+    from app.brain.markov import Markov
+    return Markov(ramble=config().ramble, ngram_size=config().ngram_size, max_order=config().max_order, spasm=config().spasm, compact=True, **kwargs)
+
+# The classifier and markov, kept in memory once loaded.
+# They're only loaded (along with sklearn and nltk)
+# when they're first used, so importing the brain is quick.
 # accessible via app.brain.CLS or app.brain.MKV
-CLS = Classifier()
-MKV = Markov(ramble=config().ramble, ngram_size=config().ngram_size, spasm=config().spasm)
+CLS = Lazy('classifier', _load_classifier)
+MKV = Lazy('markov', _load_markov)
+
+# Pre-generated speech for the web app,
+# accessible via app.brain.SPEECH
+SPEECH = SpeechPool(MKV)
+
+# Background tasks, i.e. retraining,
+# accessible via app.brain.TASKS
+TASKS = Tasks()
+
+# How many docs to learn at a time
+# when bulk training.
+BATCH_SIZE = 10000
+
+# How often (in seconds) the web app syncs the Markov
+# with training done by other processes (see `follow()`).
+SYNC_INTERVAL = 60
+
+# How many Muses to fetch tweets for at once,
+# and how long (in seconds) to wait for all of them,
+# not counting time held up by Twitter's rate limit.
+FETCH_CONCURRENCY = 8
+FETCH_TIMEOUT = 60
+
+# How many pages (of 200 tweets) to go back through
+# for each Muse, i.e. when backfilling a new one.
+FETCH_PAGES = 16
+
+# Running totals for saving fetched tweets,
+# for keeping an eye on db round trips.
+INGEST_STATS = {
+    'fetched': 0,
+    'inserted': 0,
+    'duplicates': 0,
+    'round_trips': 0
+}
+
+def warm():
+    """
+    Loads the classifier and markov in the background,
+    so they're ready by the time they're needed.
+    Returns the loading threads.
+    """
+    return [lazy.warm(CLS), lazy.warm(MKV)]
+
+
+def follow(interval=SYNC_INTERVAL):
+    """
+    Keeps the Markov in step with what other processes
+    (i.e. the worker) train it on, by syncing it every `interval`
+    seconds on a background thread. Returns the thread.
+
+    Each process trains its own Markov and logs it,
+    and checkpoints sync it first, so none of it is lost either way;
+    this is just so this process's speech is up to date.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                # The pooled speech is from the old knowledge.
+                if MKV.sync():
+                    SPEECH.invalidate()
+            except Exception:
+                logger.exception('Failed to sync the markov.')
+
+    thread = threading.Thread(target=run, name='follow-markov')
+    thread.daemon = True
+    thread.start()
+    return thread
+
 
-def ponder():
+def ponder(concurrency=FETCH_CONCURRENCY, timeout=FETCH_TIMEOUT):
     """
     Fetch tweets from the Muses
     and memorize them;
     i.e. train classifier or Markov on them.
+
+    The Muses' tweets are fetched concurrently,
+    `concurrency` at a time, giving up on any
+    which haven't started within `timeout` seconds
+    (see `_fetch_muses()`).
     """
     logger.info('Pondering new twitter data...')
 
+    # The good muses and the evil muses.
+    pos_muses = list(Muse.objects(negative=False))
+    neg_muses = list(Muse.objects(negative=True))
+    fetched = _fetch_muses(pos_muses + neg_muses, concurrency=concurrency, timeout=timeout)
+
     # Each of these are just a list
     # of tweets as strings.
     pos = []
     neg = []
 
-    # For the good muses...
-    for muse in Muse.objects(negative=False):
-        pos += _process_muse(muse)
-
-    # For the evil muses...
-    for muse in Muse.objects(negative=True):
-        neg += _process_muse(muse)
+    for muse, tweets in zip(pos_muses + neg_muses, fetched):
+        if muse.negative:
+            neg += _save_tweets(muse, tweets)
+        else:
+            pos += _save_tweets(muse, tweets)
 
     # Extract the tweet contents into lists.
     pos_txts = _get_tweet_texts(pos)
@@ -53,10 +148,11 @@ def ponder():
 
     # Combine the new tweets.
     new_tweets = pos_txts + neg_txts
+    new_ids = [tweet['tid'] for tweet in pos + neg]
 
     # Update the classifier and markov.
     logger.info('Collected %s new tweets, training...' % len(new_tweets))
-    CLS.train(new_tweets, labels)
+    CLS.train(new_tweets, labels, ids=new_ids)
     MKV.train(pos_txts)
 
 
@@ -69,31 +165,121 @@ def consider():
     chance = config().chance_to_act
     if roll < chance:
         logger.info('Rolled %s, chance to act is %s, tweeting.' % (roll, chance))
-        twitter.tweet(MKV.generate())
+        speech = _best_speech(config().candidates, config().tweet_threshold)
+        if speech:
+            twitter.tweet(speech)
+        else:
+            logger.info('Nothing good enough to tweet.')
     else:
         logger.info('Rolled %s, chance to act is %s, NOT tweeting.' % (roll, chance))
 
 
-def retrain():
+def _best_speech(candidates, threshold):
+    """
+    Generates some candidate speech and returns the one
+    the classifier thinks is most like the good muses,
+    if it's above the threshold; otherwise None.
+
+    The candidates are generated and classified in batches,
+    and they're hashed by their text, so candidates which
+    come up again aren't hashed again.
+    If the classifier isn't trained yet
+    (or doesn't know of the positive class),
+    the first candidate is used.
+    """
+    speeches = [speech for speech in dict.fromkeys(MKV.generate_many(max(1, candidates))) if speech]
+    if not speeches:
+        return None
+
+    probs = CLS.classify(speeches, ids=speeches)
+    positive = CLS.positive()
+    if len(probs) == 0 or positive is None:
+        return speeches[0]
+
+    scores = [doc_probs[positive] for doc_probs in probs]
+    best = max(range(len(speeches)), key=scores.__getitem__)
+    logger.info('Best of %s candidates scored %s (threshold is %s).' % (len(speeches), scores[best], threshold))
+    if scores[best] < threshold:
+        return None
+    return speeches[best]
+
+
+def retrain(progress=None):
     """
     Retrains the Markov generator on the documents in the database.
+    The documents are streamed from the database in batches.
+
+    A fresh Markov is trained (and saved) on the side,
+    and swapped in for the current one once it's done,
+    so speech can still be generated in the meantime.
+    Whatever the current one is trained on in the meantime
+    (by any process) is kept in its log, and learned
+    by the fresh one before it takes over.
+
+    progress
+    A function which is called with how many docs
+    have been trained on so far, and how many there are in all.
     """
-    MKV.reset()
-    tweets = [tweet.body for tweet in Tweet.objects.all()]
-    logger.info('Training on %s tweets' % len(tweets))
-    MKV.train(tweets)
+    from app.brain.markov import FILEPATH
+    num_tweets, num_docs = Tweet.objects.count(), Doc.objects.count()
+
+    def report(num_trained):
+        _log_progress(num_trained)
+        if progress:
+            progress(num_trained, num_tweets + num_docs)
+
+    with deltalog.pinned(MKV.log_filepath) as since:
+        markov = _load_markov(filepath=path.splitext(FILEPATH)[0] + '.retrain.pickle')
+        markov.reset()
+
+        logger.info('Training on %s tweets' % num_tweets)
+        markov.train(corpus.queryset(Tweet.objects), processes=cpu_count(), batch_size=BATCH_SIZE, progress=report)
 
-    docs = [doc.body for doc in Doc.objects.all()]
-    logger.info('Training on %s docs' % len(docs))
-    MKV.train(docs)
+        logger.info('Training on %s docs' % num_docs)
+        markov.train(corpus.queryset(Doc.objects), processes=cpu_count(), batch_size=BATCH_SIZE, progress=lambda num_trained: report(num_tweets + num_trained))
+
+        # Take over the saved knowledge (catching up on
+        # what's been logged since), then the current Markov.
+        markov.move(FILEPATH, since=since)
+        lazy.swap(MKV, markov)
+
+    # The pooled speech is from the old knowledge.
+    SPEECH.invalidate()
+
+def retrain_async():
+    """
+    Retrains the Markov generator (see `retrain()`) on a background thread.
+    Returns the Task, to check on its progress.
+    If it's already retraining, that Task is returned instead.
+    """
+    return TASKS.start('retrain', retrain)
 
-def train(docs):
+def train(docs, progress=None):
     """
     Bulk train the brain with docs.
     These docs are not saved to the db!
+
+    `docs` can be any iterable, i.e. a generator
+    from `app.brain.corpus`, and are trained on in batches.
+    """
+    MKV.train(docs, processes=cpu_count(), batch_size=BATCH_SIZE, progress=progress or _log_progress)
+    MKV.checkpoint()
+
+
+def prune(**kwargs):
     """
-    MKV.train(docs)
+    Prunes rarely seen ngrams from the Markov generator,
+    to keep it small. See `Markov.prune()` for the arguments.
+    """
+    stats = MKV.prune(**kwargs)
+
+    # The pooled speech is from the old knowledge.
+    SPEECH.invalidate()
+    return stats
+
 
+def _log_progress(num_docs):
+    logger.info('Trained on %s docs so far...' % num_docs)
 
 
 def _process_muse(muse):
@@ -102,16 +288,115 @@ def _process_muse(muse):
     creating Tweet objects
     and saving them to the db.
     """
+    return _save_tweets(muse, _fetch_muse(muse))
+
+
+def _fetch_muses(muses, concurrency=FETCH_CONCURRENCY, timeout=FETCH_TIMEOUT):
+    """
+    Fetches the tweets for a list of Muses concurrently.
+    Returns a list of tweets for each Muse;
+    empty if fetching failed or hadn't started within `timeout`.
+    The timeout is for all of them together, so a few slow Muses
+    can't hold up pondering for a timeout each, but time spent
+    waiting on the rate limit doesn't count towards it,
+    since that's just how long the budget takes to get through them.
+    Fetches already underway when it runs out are finished,
+    since they've already spent some of the budget.
+
+    The Muses are fetched in a different order each time,
+    so the same ones don't always miss out.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    order = list(range(len(muses)))
+    random.shuffle(order)
+    futures = [None] * len(muses)
+    for i in order:
+        futures[i] = executor.submit(_fetch_muse, muses[i])
+
+    started = time.monotonic()
+    limited = twitter.limited()
+    not_done = set(futures)
+    while not_done:
+        remaining = timeout - (time.monotonic() - started) + (twitter.limited() - limited)
+        if remaining <= 0:
+            break
+        done, not_done = wait(not_done, timeout=remaining)
+
+    # Fetches which haven't started are dropped,
+    # but those underway are waited on.
+    cancelled = [future.cancel() for future in futures]
+    fetched = []
+    for muse, future, dropped in zip(muses, futures, cancelled):
+        if dropped:
+            logger.info('Timed out collecting tweets for %s.' % muse.username)
+            fetched.append([])
+        else:
+            fetched.append(future.result())
+
+    executor.shutdown()
+    return fetched
+
+
+def _fetch_muse(muse):
+    """
+    Fetches a Muse's tweets from Twitter.
+    Only tweets newer than the last ones fetched are fetched,
+    going back through as many pages as needed
+    (up to `FETCH_PAGES`), so a new Muse is backfilled.
+    """
     username = muse.username
     logger.info('Collecting tweets for %s...' % username)
 
     try:
-        tweets = twitter.tweets(username=username)
+        return twitter.tweets(username=username, since_id=muse.last_tid, pages=FETCH_PAGES)
     except TweepError:
         return []
 
-    new_tweets = []
+
+def _save_tweets(muse, tweets):
+    """
+    Creates Tweet objects for a Muse's tweets
+    and saves them to the db in bulk.
+    Returns the ones which are new.
+
+    Tweets which are already in the db are found
+    with a single query and skipped, and the rest
+    are inserted at once, so saving a Muse's tweets
+    takes two round trips rather than one per tweet.
+    """
+    username = muse.username
+    collection = Tweet._get_collection()
+    INGEST_STATS['fetched'] += len(tweets)
+
+    # Drop tweets repeated within the batch, then
+    # those already in the db. Both the tid and the body
+    # are unique, so either one makes a tweet a duplicate.
+    candidates = []
+    tids, bodies = set(), set()
     for tweet in tweets:
+        if tweet['tid'] not in tids and tweet['body'] not in bodies:
+            tids.add(tweet['tid'])
+            bodies.add(tweet['body'])
+            candidates.append(tweet)
+
+    if candidates:
+        with metrics.timed('brain_mongo_seconds', op='find'):
+            existing = collection.find({'$or': [
+                {'tid': {'$in': list(tids)}},
+                {'body': {'$in': list(bodies)}}
+            ]}, {'tid': True, 'body': True})
+            INGEST_STATS['round_trips'] += 1
+
+            seen_tids, seen_bodies = set(), set()
+            for doc in existing:
+                seen_tids.add(doc.get('tid'))
+                seen_bodies.add(doc.get('body'))
+        candidates = [tweet for tweet in candidates if tweet['tid'] not in seen_tids and tweet['body'] not in seen_bodies]
+
+    # Docs are validated before going out, since the insert
+    # skips the model's validation (e.g. empty bodies).
+    valid, docs = [], []
+    for tweet in candidates:
         data = {
                 'body': tweet['body'],
                 'tid': tweet['tid'],
@@ -119,11 +404,45 @@ def _process_muse(muse):
         }
         t = Tweet(**data)
         try:
-            t.save()
-            new_tweets.append(tweet)
-        except (NotUniqueError, DuplicateKeyError, OperationError):
-            # Duplicate tweet
-            pass
+            t.validate()
+        except ValidationError as err:
+            logger.info('Skipping invalid tweet %s from %s: %s' % (tweet['tid'], username, err))
+            continue
+        valid.append(tweet)
+        docs.append(t.to_mongo())
+    candidates = valid
+
+    new_tweets = []
+    if candidates:
+
+        try:
+            # Unordered, so one duplicate doesn't stop the rest.
+            with metrics.timed('brain_mongo_seconds', op='insert'):
+                collection.insert(docs, continue_on_error=True)
+            INGEST_STATS['round_trips'] += 1
+            new_tweets = candidates
+        except (DuplicateKeyError, OperationError):
+            # Another process saved some of these
+            # since we checked, so see which made it in.
+            # Docs are given their ids before being sent.
+            INGEST_STATS['round_trips'] += 2
+            ids = [doc['_id'] for doc in docs if '_id' in doc]
+            inserted = set(doc['_id'] for doc in collection.find({'_id': {'$in': ids}}, {'_id': True}))
+            new_tweets = [tweet for tweet, doc in zip(candidates, docs) if doc.get('_id') in inserted]
+
+    # Remember how far the Muse has been fetched.
+    if tweets:
+        last_tid = max(tweet['tid'] for tweet in tweets)
+        if muse.last_tid is None or last_tid > muse.last_tid:
+            muse.last_tid = last_tid
+            with metrics.timed('brain_mongo_seconds', op='save'):
+                muse.save()
+
+    INGEST_STATS['inserted'] += len(new_tweets)
+    INGEST_STATS['duplicates'] += len(tweets) - len(new_tweets)
+    metrics.inc('brain_tweets_fetched_total', len(tweets))
+    metrics.inc('brain_tweets_inserted_total', len(new_tweets))
+    logger.info('Saved %s new tweets for %s (%s duplicates).' % (len(new_tweets), username, len(tweets) - len(new_tweets)))
     return new_tweets
 
 
@@ -136,21 +455,28 @@ def _consider_retweets(tweets):
     logger.info('Considering retweeting...')
     num_retweeted = 0
     retweet_threshold = config().retweet_threshold
+    max_retweets = config().max_retweets
 
     # Filter out protected tweets.
     candidates = [tweet for tweet in tweets if not tweet['protected'] and not tweet['retweeted']]
     txts = _get_tweet_texts(candidates)
     if txts:
-        for idx, doc_probs in enumerate(CLS.classify(txts)):
-            if num_retweeted >= config().max_retweets:
+        probs = CLS.classify(txts, ids=[tweet['tid'] for tweet in candidates])
+        positive = CLS.positive()
+        if positive is None:
+            logger.info('Classifier doesn\'t know what\'s retweetable yet, not retweeting.')
+            return
+
+        for idx, doc_probs in enumerate(probs):
+            if num_retweeted >= max_retweets:
                 logger.info('Hit maximum retweet limit, stopping for now.')
                 break
-            if doc_probs[1] > retweet_threshold:
-                logger.info('Classified as %s retweetable, above %s threshold, retweeting...' % (doc_probs[1], retweet_threshold))
+            if doc_probs[positive] > retweet_threshold:
+                logger.info('Classified as %s retweetable, above %s threshold, retweeting...' % (doc_probs[positive], retweet_threshold))
                 twitter.retweet(candidates[idx]['tid'])
                 num_retweeted += 1
             else:
-                logger.info('Classified as %s retweetable, below %s threshold, not retweeting...' % (doc_probs[1], retweet_threshold))
+                logger.info('Classified as %s retweetable, below %s threshold, not retweeting...' % (doc_probs[positive], retweet_threshold))
 
 
 def _get_tweet_texts(tweets):
@@ -158,3 +484,8 @@ def _get_tweet_texts(tweets):
     Pulls out the content of a list of Tweets.
     """
     return [tweet['body'] for tweet in tweets]
+
+
+# How long (in seconds) importing the brain took.
+IMPORT_TIME = time.monotonic() - _import_started
+logger.info('Imported the brain in %.2fs.' % IMPORT_TIME)
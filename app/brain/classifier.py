@@ -1,12 +1,23 @@
 import pickle
-from os import getcwd, path
+from collections import OrderedDict
+from os import getcwd, getpid, path, replace
+from app.brain import deltalog
+from app import metrics
 
+import numpy as np
+import scipy.sparse as sp
 from sklearn.naive_bayes import MultinomialNB
-from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import normalize
 from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 
 __location__ = path.realpath(path.join(getcwd(), path.dirname(__file__)))
 
+# What a logged training entry holds, by its version:
+# docs already tf-idf weighted (each batch on its own),
+# or the docs' term counts, for weighting with the running idf.
+WEIGHTED = 0
+COUNTS = 1
+
 class Classifier():
     """
     Multinomial Naive Bayes classifier.
@@ -16,66 +27,267 @@ class Classifier():
     1 being positive.
     """
 
-    def __init__(self, filepath=path.join(__location__, 'classifier.pickle')):
+    def __init__(self, filepath=path.join(__location__, 'classifier.pickle'), running_idf=False, max_cached=100000):
         """
         Initialize the classifier.
         Tries to load the existing one;
         if none exists, a new one is created.
+
+        Training is logged to a '.log' file alongside
+        the saved classifier, until the next checkpoint.
+
+        running_idf
+        Whether or not to keep the tf-idf document frequencies
+        as running totals across training batches,
+        and weight with those when classifying.
+        Otherwise tf-idf is refit on each batch of docs.
+
+        max_cached
+        How many hashed docs to cache, by id.
         """
         self.filepath = filepath
+        self.log_filepath = path.splitext(filepath)[0] + '.log'
+
+        # How big (in bytes) the training log can get
+        # before it is checkpointed into the saved classifier.
+        self.max_log_size = 16 * 1024 * 1024
+
+        # The seq of the last logged training in the classifier.
+        self._seq = None
 
-        hasher = HashingVectorizer(stop_words='english', non_negative=True, norm=None, binary=False)
-        self.vectorizer = Pipeline((
-            ('hasher', hasher),
-            ('tf_idf', TfidfTransformer())
-        ))
+        self.hasher = HashingVectorizer(stop_words='english', non_negative=True, norm=None, binary=False)
+        self.tfidf = RunningTfidf(self.hasher.n_features) if running_idf else None
+
+        # Hashed docs, by id, so they're only hashed once.
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
 
         # Try to load the existing classifier.
         self.clf = self.load()
 
         # If there wasn't one, create a new one.
         if not self.clf:
-            self.clf = MultinomialNB(alpha=0.1)
+            self.clf = self._new()
+
+    def _new(self):
+        return MultinomialNB(alpha=0.1)
 
-    def train(self, docs, labels, save=True):
+    def train(self, docs, labels, save=True, ids=None):
         """
         Updates the classifier with new training data.
-        By default, saves the updated classifier as well.
+        By default, saves the updated classifier as well;
+        only the new training data is written, to the log.
+
+        Optionally provide `ids` for the docs (i.e. tweet ids),
+        so their hashed vectors can be cached.
         """
         if docs:
-            training = self.vectorizer.fit_transform(docs)
+            counts = self._hash(docs, ids)
+            if self.tfidf:
+                self.tfidf.partial_fit(counts)
+                training = self.tfidf.transform(counts)
+                entry, version = (counts, labels), COUNTS
+            else:
+                training = TfidfTransformer().fit_transform(counts)
+                entry, version = (training, labels), WEIGHTED
+
             self.clf.partial_fit(training, labels, [0,1])
             if save:
-                self.save()
+                self._seq, size = deltalog.append(self.log_filepath, entry, version=version)
+                if size > self.max_log_size:
+                    self.checkpoint()
 
-    def classify(self, docs):
+    def classify(self, docs, ids=None):
         """
         Classifies a list of documents.
         Returns a list of class probabilities
         for each document.
+
+        Optionally provide `ids` for the docs (i.e. tweet ids),
+        so their hashed vectors can be cached.
         """
-        docs_ = self.vectorizer.fit_transform(docs)
-        try:
-            return self.clf.predict_proba(docs_)
+        metrics.inc('brain_classifier_classify_docs_total', len(docs))
+        with metrics.timed('brain_classifier_classify_seconds'):
+            counts = self._hash(docs, ids)
+            if self.tfidf:
+                docs_ = self.tfidf.transform(counts)
+            else:
+                docs_ = TfidfTransformer().fit_transform(counts)
+
+            try:
+                return self.clf.predict_proba(docs_)
+
+            # Likely because the classifier hasn't been trained yet.
+            except AttributeError:
+                return []
+
+    def positive(self):
+        """
+        Returns the column of the positive class (1)
+        in the probabilities `classify` returns,
+        or None if the classifier doesn't know of it
+        (i.e. it hasn't been trained yet).
+        """
+        classes = list(getattr(self.clf, 'classes_', []))
+        if 1 not in classes:
+            return None
+        return classes.index(1)
+
+    def _hash(self, docs, ids=None):
+        """
+        Hashes docs into a sparse matrix of term counts.
+        Docs with ids are cached, so they're only hashed once.
+        """
+        if ids is None:
+            return self.hasher.transform(docs)
+
+        # The rows are taken from the cache, or this batch's own hashing,
+        # before the cache is trimmed, so nothing in the batch
+        # is evicted before it's used.
+        missing = OrderedDict((id, doc) for id, doc in zip(ids, docs) if id not in self._cache)
+        hashed = {}
+        if missing:
+            matrix = self.hasher.transform(list(missing.values()))
+            hashed = {id: matrix[row] for row, id in enumerate(missing)}
+
+        rows = []
+        for id in ids:
+            if id in hashed:
+                rows.append(hashed[id])
+            else:
+                rows.append(self._cache[id])
+                self._cache.move_to_end(id)
+
+        # The batch's ids are the most recently used,
+        # so older ones go first; only a batch bigger
+        # than the cache has some of its own dropped.
+        self._cache.update(hashed)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
 
-        # Likely because the classifier hasn't been trained yet.
-        except AttributeError:
-            return []
+        return sp.vstack(rows, format='csr')
 
     def save(self):
         """
         Persist the classifier to the disk.
+        It's written alongside and then moved into place,
+        so a crash mid-save leaves the last save as it was.
+
+        The seq of the last logged training it includes
+        is saved with it, so replaying the log skips that training.
+        This doesn't truncate the training log,
+        you probably want `checkpoint()` instead.
+        """
+        tmp_filepath = '%s.%s.tmp' % (self.filepath, getpid())
+        with open(tmp_filepath, 'wb') as file:
+            pickle.dump({'seq': self._seq or 0}, file)
+            if self.tfidf:
+                pickle.dump({'clf': self.clf, 'tfidf': self.tfidf}, file)
+            else:
+                pickle.dump(self.clf, file)
+        replace(tmp_filepath, self.filepath)
+
+    def checkpoint(self):
         """
-        file = open(self.filepath, 'wb')
-        pickle.dump(self.clf, file)
+        Persist the classifier and truncate the training log,
+        since that training is now in the saved classifier.
+        """
+        self.save()
+        deltalog.truncate(self.log_filepath, self._seq or 0)
 
     def load(self):
         """
-        Load the classifier from disk.
+        Load the classifier from disk,
+        replaying any training logged since it was saved.
         Returns None if one wasn't found.
+
+        With running idf, the saved document frequencies
+        are loaded (onto `self.tfidf`) as well.
+        Training logged already weighted (i.e. without running idf)
+        can't update them, so it's learned as it was weighted;
+        term counts logged with running idf are weighted
+        on their own if running idf is off.
         """
+        meta = {}
         try:
-            file = open(self.filepath, 'rb')
-            return pickle.load(file)
+            with open(self.filepath, 'rb') as file:
+                clf = pickle.load(file)
+
+                # Classifiers saved before the meta was
+                # are just the classifier.
+                if isinstance(clf, dict) and 'seq' in clf:
+                    meta, clf = clf, pickle.load(file)
         except IOError:
-            return None
+            clf = None
+
+        if isinstance(clf, dict):
+            if self.tfidf:
+                self.tfidf = clf['tfidf']
+            clf = clf['clf']
+
+        # Classifiers saved before the log was numbered
+        # include none of it.
+        seq = meta.get('seq')
+        for entry in deltalog.replay(self.log_filepath, after=seq):
+            training, labels = entry.data
+            if clf is None:
+                clf = self._new()
+            if entry.version == COUNTS:
+                if self.tfidf:
+                    self.tfidf.partial_fit(training)
+                    training = self.tfidf.transform(training)
+                else:
+                    training = TfidfTransformer().fit_transform(training)
+            clf.partial_fit(training, labels, [0,1])
+            seq = entry.seq
+
+        self._seq = seq
+        if seq:
+            deltalog.advance(self.log_filepath, seq)
+        return clf
+
+
+class RunningTfidf():
+    """
+    Tf-idf weighting where the document frequencies
+    are running totals, updated with `partial_fit`,
+    rather than being refit on every batch of docs.
+    Weights the same way as sklearn's TfidfTransformer,
+    i.e. with smoothed idf and l2 normalization.
+    """
+
+    def __init__(self, n_features):
+        self.n_docs = 0
+        self.doc_freqs = np.zeros(n_features)
+        self._idf = None
+
+    def partial_fit(self, counts):
+        """
+        Adds a batch of docs (as a sparse matrix of term counts)
+        to the document frequencies.
+        """
+        self.n_docs += counts.shape[0]
+        self.doc_freqs += np.asarray((counts > 0).sum(axis=0)).ravel()
+        self._idf = None
+        return self
+
+    def __getstate__(self):
+        # The idf is worked out from the frequencies,
+        # so it isn't worth saving.
+        state = dict(self.__dict__)
+        state['_idf'] = None
+        return state
+
+    def transform(self, counts):
+        """
+        Weights a batch of docs (as a sparse matrix of term counts).
+        """
+        # The idf only changes when more docs are fit.
+        if getattr(self, '_idf', None) is None:
+            self._idf = np.log((1 + self.n_docs) / (1 + self.doc_freqs)) + 1
+
+        # Only the docs' nonzero terms need weighting,
+        # rather than multiplying by the whole diagonal.
+        weighted = sp.csr_matrix(counts, dtype=np.float64, copy=True)
+        weighted.data *= self._idf[weighted.indices]
+        return normalize(weighted, norm='l2', copy=False)
@@ -0,0 +1,114 @@
+"""
+Readers which stream training docs
+from files and the database,
+so a corpus never has to be all in memory.
+"""
+
+import json, re
+from os import path
+
+# What can come between the items of a JSON array.
+SEPARATORS = re.compile(r'[\s,]*')
+
+# What can come right after an item in a JSON array.
+ENDS = set(' \t\n\r,]')
+
+def read(filepath, field=None):
+    """
+    Streams docs from a file, picking
+    the reader based on its extension:
+    .jsonl for JSON lines, .json for a JSON array,
+    otherwise one doc per line of plain text.
+
+    For JSON, `field` is the key of the doc text
+    if the items are objects, e.g. 'text'.
+    """
+    ext = path.splitext(filepath)[1]
+    if ext == '.jsonl':
+        return jsonl(filepath, field=field)
+    elif ext == '.json':
+        return json_array(filepath, field=field)
+    return lines(filepath)
+
+def lines(filepath):
+    """
+    Yields each non-empty line of a plain text file.
+    """
+    with open(filepath, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield line
+
+def jsonl(filepath, field=None):
+    """
+    Yields each doc from a JSON lines file.
+    """
+    for line in lines(filepath):
+        yield _field(json.loads(line), field)
+
+def json_array(filepath, field=None, chunk_size=1024*1024):
+    """
+    Yields each doc from a file containing a JSON array,
+    decoding it incrementally rather than loading it all at once.
+    Items are decoded in place in the buffer of what's been read,
+    which is only trimmed of them when more is read,
+    so it's copied once per read rather than once per item.
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r') as file:
+        buffer = ''
+        while not buffer:
+            more = file.read(chunk_size)
+            if not more:
+                break
+            buffer = more.lstrip()
+        if not buffer.startswith('['):
+            raise ValueError('Expected a JSON array in %s' % filepath)
+        idx = 1
+        eof = False
+
+        while True:
+            # Skip the separators between items.
+            idx = SEPARATORS.match(buffer, idx).end()
+            if buffer.startswith(']', idx):
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, idx)
+
+                # The item may have been cut off in a way
+                # that still decodes (i.e. a number), so make sure
+                # it's followed by a separator (or the end of the array)
+                # before trusting it.
+                complete = eof or buffer[end:end+1] in ENDS
+            except ValueError:
+                # Most likely the item is cut off,
+                # so read some more and try again.
+                if eof:
+                    raise
+                complete = False
+
+            if not complete:
+                more = file.read(chunk_size)
+                eof = not more
+                buffer = buffer[idx:] + more
+                idx = 0
+                continue
+
+            yield _field(item, field)
+            idx = end
+
+def queryset(qs, field='body', batch_size=1000):
+    """
+    Yields a field from each document in a QuerySet,
+    fetching them from the database in batches
+    and without caching them on the QuerySet.
+    """
+    for doc in qs.no_cache().only(field).batch_size(batch_size):
+        yield getattr(doc, field)
+
+def _field(item, field):
+    if field is None:
+        return item
+    return item[field]
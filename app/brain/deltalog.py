@@ -0,0 +1,219 @@
+"""
+An append-only log of training updates,
+so a model can persist just what changed
+instead of re-saving all of itself.
+
+Entries are numbered in order, so a saved model can record
+the last entry it includes, and replaying the log on top of it
+skips those, even if the log wasn't truncated after saving
+(i.e. the process died in between).
+The last number handed out is kept in a '.seq' file
+alongside the log, which is also locked while the log
+is written to, so many processes can log to it.
+"""
+
+import fcntl, glob, pickle, threading, uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from os import getpid, kill, path, remove, replace
+
+# seq: the entry's number in the log.
+# version: the format of the data, up to whoever logged it.
+# Entries written before they were numbered are replayed
+# with a seq and version of 0.
+Entry = namedtuple('Entry', ['seq', 'version', 'data'])
+
+# The lock held on each log, by this process.
+_locks = {}
+_locks_lock = threading.Lock()
+
+def append(filepath, data, version=0):
+    """
+    Appends an entry to the log.
+    Returns the entry's seq, and the size of the log afterwards.
+    """
+    with locked(filepath):
+        # The seq is taken before the entry is written,
+        # so if the process dies in between, it's skipped
+        # rather than given out twice.
+        seq = last_seq(filepath) + 1
+        _write_seq(filepath, seq)
+
+        with open(filepath, 'ab') as file:
+            pickle.dump(Entry(seq, version, data), file, pickle.HIGHEST_PROTOCOL)
+            return seq, file.tell()
+
+def replay(filepath, after=None):
+    """
+    A generator which yields the entries in the log, in order.
+    If the last entry was only partially written
+    (i.e. the process died mid-write), it is ignored.
+
+    after
+    Only entries after this seq are yielded,
+    i.e. the last one a saved model includes.
+    Entries from before they were numbered
+    are only yielded if this isn't given.
+    """
+    for entry in _entries(filepath):
+        if after is None or entry.seq > after:
+            yield entry
+
+def truncate(filepath, upto):
+    """
+    Drops the entries up to (and including) a seq from the log,
+    i.e. once a saved model includes them.
+    Entries after a pin (see `pinned()`) are kept regardless.
+    The log is rewritten alongside and then moved into place.
+    """
+    with locked(filepath):
+        if not path.exists(filepath):
+            return
+
+        upto = min([upto] + _pins(filepath))
+
+        tmp_filepath = '%s.%s.tmp' % (filepath, getpid())
+        with open(tmp_filepath, 'wb') as file:
+            for entry in _entries(filepath):
+                if entry.seq > upto:
+                    pickle.dump(entry, file, pickle.HIGHEST_PROTOCOL)
+        replace(tmp_filepath, filepath)
+
+def last_seq(filepath):
+    """
+    The seq of the last entry appended to the log,
+    or 0 if there hasn't been one.
+    """
+    try:
+        with open(_seq_filepath(filepath), 'r') as file:
+            return int(file.read())
+
+    # If the seq wasn't kept (or was only partially written),
+    # it's worked out from the log itself.
+    except (IOError, ValueError):
+        return max((entry.seq for entry in _entries(filepath)), default=0)
+
+def advance(filepath, seq):
+    """
+    Makes sure the next seq handed out is after `seq`,
+    i.e. the last seq of a saved model, in case
+    the log (and its seq) went missing.
+    """
+    with locked(filepath):
+        if last_seq(filepath) < seq:
+            _write_seq(filepath, seq)
+
+@contextmanager
+def pinned(filepath):
+    """
+    A context manager which keeps the entries logged while it's held
+    in the log, even through truncation, yielding the seq they come after.
+    i.e. so a model being rebuilt on the side can replay them once it's done.
+    Pins are kept in '.pin' files alongside the log,
+    and ones left by processes which have died are ignored.
+    """
+    with locked(filepath):
+        seq = last_seq(filepath)
+        pin_filepath = '%s.pin.%s.%s' % (filepath, getpid(), uuid.uuid4().hex)
+        with open(pin_filepath, 'w') as file:
+            file.write(str(seq))
+
+    try:
+        yield seq
+    finally:
+        remove(pin_filepath)
+
+def locked(filepath):
+    """
+    A context manager which holds the log's lock,
+    i.e. so a model can be saved and the log truncated
+    without another process logging in between.
+    Only one thread (of any process) holds it at a time,
+    but the thread holding it can take it again.
+    """
+    with _locks_lock:
+        lock = _locks.get(path.realpath(filepath))
+        if lock is None:
+            lock = _locks[path.realpath(filepath)] = _Lock(_seq_filepath(filepath))
+    return lock.held()
+
+def remove_log(filepath):
+    """
+    Deletes the log, and its seq.
+    """
+    for filepath in [filepath, _seq_filepath(filepath)]:
+        if path.exists(filepath):
+            remove(filepath)
+
+def _entries(filepath):
+    if not path.exists(filepath):
+        return
+
+    with open(filepath, 'rb') as file:
+        while True:
+            try:
+                entry = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError):
+                return
+
+            if not isinstance(entry, Entry):
+                entry = Entry(0, 0, entry)
+            yield entry
+
+def _pins(filepath):
+    """
+    The seqs of the log's pins,
+    cleaning up any left by processes which have died.
+    """
+    pins = []
+    for pin_filepath in glob.glob(glob.escape(filepath) + '.pin.*'):
+        try:
+            pid = int(pin_filepath[len(filepath):].split('.')[2])
+            kill(pid, 0)
+        except ProcessLookupError:
+            remove(pin_filepath)
+            continue
+        except (ValueError, PermissionError):
+            pass
+
+        try:
+            with open(pin_filepath, 'r') as file:
+                pins.append(int(file.read()))
+        except (IOError, ValueError):
+            pass
+    return pins
+
+def _seq_filepath(filepath):
+    return filepath + '.seq'
+
+def _write_seq(filepath, seq):
+    with open(_seq_filepath(filepath), 'w') as file:
+        file.write(str(seq))
+
+
+class _Lock():
+    """
+    A lock on a file, for locking across processes,
+    which the thread holding it can take again.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    @contextmanager
+    def held(self):
+        with self._lock:
+            if not self._depth:
+                self._file = open(self.filepath, 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    # Closing it releases the lock.
+                    self._file.close()
+                    self._file = None
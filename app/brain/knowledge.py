@@ -0,0 +1,517 @@
+from array import array
+from collections.abc import Mapping
+from heapq import merge
+import mmap, os, pickle, struct, sys
+
+# The memory-mapped file format.
+# A header, followed by a table of (offset, size) for each section,
+# followed by the sections, each aligned to 8 bytes.
+# Since version 2, the last section is the pickled `meta`.
+MAGIC = b'MKVBRAIN'
+VERSION = 2
+VERSIONS = (1, 2)
+HEADER = struct.Struct('<8sIcB')
+SECTION = struct.Struct('<QQ')
+SECTIONS = (
+    ('vocab_offsets', 'Q'),
+    ('vocab_data', 'B'),
+    ('prior_offsets', 'Q'),
+    ('prior_ids', 'I'),
+    ('post_offsets', 'Q'),
+    ('posts', 'I'),
+    ('counts', 'I')
+)
+
+def merge_counts(x, y):
+    """
+    Merges y into x,
+    where each is a dictionary of {'term': count}
+    """
+    for k, v_y in y.items():
+        x[k] = x.get(k, 0) + v_y
+    return x
+
+def merge_knowledge(x, y):
+    """
+    Merges y into x,
+    where each is a dictionary of {prior: {post: count}}
+    """
+    for prior, posts in y.items():
+        if prior in x:
+            merge_counts(x[prior], posts)
+        else:
+            x[prior] = dict(posts)
+    return x
+
+
+class Vocabulary():
+    """
+    A two-way mapping between tokens and integer ids.
+    Tokens are usually strings, but can also be
+    tuples of strings (i.e. starting tokens).
+    """
+
+    def __init__(self, tokens=()):
+        self.tokens = []
+        self.ids = {}
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        """
+        Returns the id for a token,
+        assigning it a new one if necessary.
+        """
+        try:
+            return self.ids[token]
+        except KeyError:
+            id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            return id
+
+    def get(self, token, default=None):
+        """
+        Returns the id for a token,
+        or `default` if it isn't known.
+        """
+        return self.ids.get(token, default)
+
+    def __getitem__(self, id):
+        return self.tokens[id]
+
+    def __contains__(self, token):
+        return token in self.ids
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getstate__(self):
+        # The id lookup is rebuilt on load,
+        # so only the tokens need to be pickled.
+        return {'tokens': self.tokens}
+
+    def __setstate__(self, state):
+        self.__init__(state['tokens'])
+
+
+class MappedVocabulary():
+    """
+    A read-only Vocabulary backed by a memory-mapped file.
+    The tokens are stored sorted by their encoding,
+    so looking one up is a binary search instead of a dict,
+    and nothing has to be decoded up front.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def get(self, token, default=None):
+        """
+        Returns the id for a token,
+        or `default` if it isn't known.
+        """
+        encoded = _encode_token(token)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._encoded(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._encoded(lo) == encoded:
+            return lo
+        return default
+
+    def _encoded(self, id):
+        return self.data[self.offsets[id]:self.offsets[id+1]].tobytes()
+
+    def __getitem__(self, id):
+        return _decode_token(self._encoded(id))
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __iter__(self):
+        for id in range(len(self)):
+            yield self[id]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def _encode_token(token):
+    """
+    Encodes a token (a string or a tuple of strings) as bytes.
+    """
+    if type(token) is tuple:
+        return b'\x01' + b'\x00'.join(t.encode('utf-8') for t in token)
+    return b'\x00' + token.encode('utf-8')
+
+def _decode_token(encoded):
+    if encoded[:1] == b'\x01':
+        if len(encoded) == 1:
+            return ()
+        return tuple(t.decode('utf-8') for t in encoded[1:].split(b'\x00'))
+    return encoded[1:].decode('utf-8')
+
+
+class CompactKnowledge(Mapping):
+    """
+    A compact store for Markov knowledge.
+
+    Tokens are mapped to integer ids by a Vocabulary,
+    and the prior: {post: count} tables are packed
+    CSR-style into flat arrays:
+
+        prior_offsets, prior_ids
+        The priors, as tuples of token ids, in sorted order.
+
+        post_offsets
+        Where each prior's posts start in...
+
+        posts, counts
+        ...the post token ids and their counts.
+
+    New counts are kept as pending until the next `compact()`,
+    which folds them into the arrays.
+    Otherwise it reads like the regular dict of dicts.
+
+    It can be dumped to a binary file, which `open()`
+    memory-maps, so loading is near-instant and processes
+    reading the same file share its pages.
+    A dict of `meta` (i.e. what the knowledge was saved as of)
+    is saved and loaded along with it.
+
+    Learning and compacting change it in place, so it can't be
+    read on other threads meanwhile; the Markov generator
+    holds off generating while it does either.
+    """
+
+    def __init__(self, knowledge=None, max_pending=100000):
+        """
+        knowledge
+        A dict of {prior: {post: count}} to pack.
+
+        max_pending
+        How many priors can have pending counts
+        before they are automatically compacted.
+        """
+        self.vocab = Vocabulary()
+        self.max_pending = max_pending
+        self.meta = {}
+
+        self.prior_offsets = array('Q', [0])
+        self.prior_ids = array('I')
+        self.post_offsets = array('Q', [0])
+        self.posts = array('I')
+        self.counts = array('I')
+
+        self._pending = {}
+        self.learn(knowledge or {(): {}})
+        self.compact()
+
+    @classmethod
+    def open(cls, filepath):
+        """
+        Opens a dumped CompactKnowledge, memory-mapped and read-only.
+        New counts can still be learned, but compacting them
+        copies the store into memory.
+        Raises a ValueError if the file isn't in a supported format.
+        """
+        with open(filepath, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(buffer)
+        magic, version, byteorder, num_sections = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('Not a Markov knowledge file: %s' % filepath)
+        if version not in VERSIONS:
+            raise ValueError('Unsupported Markov knowledge version %s: %s' % (version, filepath))
+        has_meta = version >= 2
+        if byteorder != sys.byteorder[0].encode() or num_sections != len(SECTIONS) + has_meta:
+            raise ValueError('Incompatible Markov knowledge file: %s' % filepath)
+
+        sections = {}
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, size = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            sections[name] = view[offset:offset+size].cast(typecode)
+
+        meta = {}
+        if has_meta:
+            offset, size = SECTION.unpack_from(view, HEADER.size + len(SECTIONS) * SECTION.size)
+            meta = pickle.loads(view[offset:offset+size])
+
+        knowledge = cls.__new__(cls)
+        knowledge.vocab = MappedVocabulary(sections['vocab_offsets'], sections['vocab_data'])
+        knowledge.max_pending = 100000
+        knowledge.prior_offsets = sections['prior_offsets']
+        knowledge.prior_ids = sections['prior_ids']
+        knowledge.post_offsets = sections['post_offsets']
+        knowledge.posts = sections['posts']
+        knowledge.counts = sections['counts']
+        knowledge._pending = {}
+        knowledge.meta = meta
+        return knowledge
+
+    def dump(self, filepath):
+        """
+        Writes the knowledge (including any pending counts)
+        and its `meta` to a binary file
+        which can be memory-mapped with `open()`.
+
+        The file is written alongside and then moved into place,
+        so processes which have the old one open are unaffected.
+        """
+        self.compact()
+
+        # Sort the vocabulary by encoding, and remap the ids
+        # (and the ordering of the priors) to match.
+        encoded = [_encode_token(token) for token in self.vocab]
+        order = sorted(range(len(encoded)), key=encoded.__getitem__)
+        remap = array('I', [0]) * len(order)
+        for new, old in enumerate(order):
+            remap[old] = new
+
+        vocab_offsets = array('Q', [0])
+        vocab_data = bytearray()
+        for old in order:
+            vocab_data += encoded[old]
+            vocab_offsets.append(len(vocab_data))
+        del encoded
+
+        rows = sorted((tuple(remap[id] for id in self._key(row)), row) for row in range(self._rows()))
+        prior_offsets = array('Q', [0])
+        prior_ids = array('I')
+        post_offsets = array('Q', [0])
+        posts = array('I')
+        counts = array('I')
+        for key, row in rows:
+            prior_ids.extend(key)
+            prior_offsets.append(len(prior_ids))
+            start, end = self.post_offsets[row], self.post_offsets[row+1]
+            posts.extend(remap[post] for post in self.posts[start:end])
+            counts.extend(self.counts[start:end])
+            post_offsets.append(len(posts))
+
+        meta = pickle.dumps(self.meta, pickle.HIGHEST_PROTOCOL)
+        sections = [vocab_offsets, vocab_data, prior_offsets, prior_ids, post_offsets, posts, counts, meta]
+
+        tmp_filepath = '%s.%s.tmp' % (filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode(), len(sections)))
+
+            # Lay out the sections after the section table.
+            offset = HEADER.size + SECTION.size * len(sections)
+            layout = []
+            for section in sections:
+                offset += -offset % 8
+                size = len(section) * _itemsize(section)
+                layout.append((offset, size))
+                offset += size
+            for offset, size in layout:
+                file.write(SECTION.pack(offset, size))
+
+            for (offset, size), section in zip(layout, sections):
+                file.write(b'\x00' * (offset - file.tell()))
+                file.write(section)
+        os.replace(tmp_filepath, filepath)
+
+    def learn(self, delta):
+        """
+        Adds counts, in the format of {prior: {post: count}}.
+        """
+        merge_knowledge(self._pending, delta)
+        if len(self._pending) > self.max_pending:
+            self.compact()
+
+    def compact(self):
+        """
+        Folds the pending counts into the arrays.
+
+        The existing rows and the new priors are both
+        in sorted order, so they are merged in one pass.
+        """
+        if not self._pending:
+            return
+
+        # New tokens can't be added to a memory-mapped vocabulary,
+        # so it gets copied into memory.
+        if self._pending and not isinstance(self.vocab, Vocabulary):
+            self.vocab = Vocabulary(self.vocab)
+
+        # Split the pending counts into those for existing rows,
+        # and those for new priors. The new priors are sorted
+        # so they can be merged with the (already sorted) rows.
+        extras, new = {}, []
+        for prior, posts in self._pending.items():
+            if self._find(prior) is None:
+                new.append((self._encode(prior, add=True), posts))
+            else:
+                extras[self._encode(prior)] = posts
+        new.sort(key=lambda item: item[0])
+
+        def existing():
+            for row in range(self._rows()):
+                key = self._key(row)
+                posts = self._posts(row)
+                if key in extras:
+                    merge_counts(posts, extras[key])
+                yield key, posts
+
+        rows = merge(existing(), new, key=lambda item: item[0])
+
+        prior_offsets = array('Q', [0])
+        prior_ids = array('I')
+        post_offsets = array('Q', [0])
+        posts = array('I')
+        counts = array('I')
+        for key, row_posts in rows:
+            prior_ids.extend(key)
+            prior_offsets.append(len(prior_ids))
+            for post, count in row_posts.items():
+                posts.append(self.vocab.add(post))
+                counts.append(count)
+            post_offsets.append(len(posts))
+
+        self.prior_offsets = prior_offsets
+        self.prior_ids = prior_ids
+        self.post_offsets = post_offsets
+        self.posts = posts
+        self.counts = counts
+        self._pending = {}
+
+    def to_dict(self):
+        """
+        Unpacks into a regular dict of dicts.
+        """
+        return dict(self.scan())
+
+    def scan(self):
+        """
+        Yields each prior and its {post: count} dict,
+        in one pass over the rows, which is quicker
+        than looking each prior up.
+        """
+        pending = self._pending
+        for row in range(self._rows()):
+            prior = self._decode(self._key(row))
+            posts = self._posts(row)
+            if prior in pending:
+                merge_counts(posts, pending[prior])
+            yield prior, posts
+
+        for prior, posts in pending.items():
+            if self._find(prior) is None:
+                yield prior, dict(posts)
+
+    @property
+    def nbytes(self):
+        """
+        Roughly how many bytes the store takes up, as dumped,
+        not counting any pending counts.
+        """
+        vocab = sum(len(_encode_token(token)) + 8 for token in self.vocab)
+        sections = [self.prior_offsets, self.prior_ids, self.post_offsets, self.posts, self.counts]
+        return vocab + sum(len(section) * _itemsize(section) for section in sections)
+
+    def prior_sizes(self):
+        """
+        The set of how many tokens the priors have,
+        without decoding them.
+        """
+        offsets = self.prior_offsets
+        sizes = {offsets[row+1] - offsets[row] for row in range(self._rows())}
+        sizes.update(len(prior) for prior in self._pending)
+        return sizes
+
+    def __getitem__(self, prior):
+        row = self._find(prior)
+        pending = self._pending.get(prior)
+        if row is None:
+            if pending is None:
+                raise KeyError(prior)
+            return dict(pending)
+
+        posts = self._posts(row)
+        if pending:
+            merge_counts(posts, pending)
+        return posts
+
+    def __contains__(self, prior):
+        return prior in self._pending or self._find(prior) is not None
+
+    def __iter__(self):
+        for row in range(self._rows()):
+            yield self._decode(self._key(row))
+        for prior in self._pending:
+            if self._find(prior) is None:
+                yield prior
+
+    def __len__(self):
+        return self._rows() + sum(1 for prior in self._pending if self._find(prior) is None)
+
+    def _rows(self):
+        return len(self.post_offsets) - 1
+
+    def _key(self, row):
+        """
+        The prior of a row, as a tuple of token ids.
+        """
+        return tuple(self.prior_ids[self.prior_offsets[row]:self.prior_offsets[row+1]])
+
+    def _posts(self, row):
+        """
+        The posts of a row, as a {post: count} dict.
+        """
+        start, end = self.post_offsets[row], self.post_offsets[row+1]
+        vocab = self.vocab
+        return {vocab[post]: count for post, count in zip(self.posts[start:end], self.counts[start:end])}
+
+    def _encode(self, prior, add=False):
+        """
+        Converts a prior into a tuple of token ids.
+        Returns None if a token isn't in the vocabulary
+        (unless `add` is True, in which case it is added).
+        """
+        if add:
+            return tuple(self.vocab.add(token) for token in prior)
+        key = []
+        for token in prior:
+            id = self.vocab.get(token)
+            if id is None:
+                return None
+            key.append(id)
+        return tuple(key)
+
+    def _decode(self, key):
+        return tuple(self.vocab[id] for id in key)
+
+    def _find(self, prior):
+        """
+        Binary searches for the row of a prior.
+        Returns None if it isn't there.
+        """
+        key = self._encode(prior)
+        if key is None:
+            return None
+
+        lo, hi = 0, self._rows()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._rows() and self._key(lo) == key:
+            return lo
+        return None
+
+
+def _itemsize(section):
+    if isinstance(section, (bytes, bytearray)):
+        return 1
+    return section.itemsize
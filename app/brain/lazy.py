@@ -0,0 +1,107 @@
+"""
+Stand-ins for objects which are expensive to create,
+which only create them once they're first used.
+
+The stand-in passes all of its attributes through to the object,
+so managing it is done with the functions here (i.e. `load(proxy)`)
+rather than methods, which could hide the object's own.
+"""
+
+import threading, time
+
+# Logging
+from app.logger import logger
+logger = logger(__name__)
+
+class Lazy():
+    """
+    A stand-in for an object which is expensive to create
+    (i.e. a model which has to be loaded from disk),
+    which only creates it once it's first used.
+
+    Attributes are passed through to the object,
+    so the proxy can be used as if it were the object.
+    """
+
+    def __init__(self, name, factory):
+        """
+        name
+        What to call the object, i.e. when logging.
+
+        factory
+        A function which creates the object.
+        """
+        object.__setattr__(self, '_lazy_name', name)
+        object.__setattr__(self, '_lazy_factory', factory)
+        object.__setattr__(self, '_lazy_obj', None)
+        object.__setattr__(self, '_lazy_lock', threading.RLock())
+        object.__setattr__(self, '_lazy_load_time', None)
+
+    def __getattr__(self, name):
+        return getattr(load(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(load(self), name, value)
+
+    def __delattr__(self, name):
+        delattr(load(self), name)
+
+    def __repr__(self):
+        if loaded(self):
+            return '<Lazy %s: %r>' % (self._lazy_name, self._lazy_obj)
+        return '<Lazy %s (not loaded)>' % self._lazy_name
+
+
+def load(proxy):
+    """
+    Creates a proxy's object, if it hasn't been already,
+    and returns it.
+    """
+    obj = proxy._lazy_obj
+    if obj is not None:
+        return obj
+
+    with proxy._lazy_lock:
+        if proxy._lazy_obj is None:
+            started = time.monotonic()
+            obj = proxy._lazy_factory()
+            object.__setattr__(proxy, '_lazy_load_time', time.monotonic() - started)
+            object.__setattr__(proxy, '_lazy_obj', obj)
+            logger.info('Loaded %s in %.2fs.' % (proxy._lazy_name, proxy._lazy_load_time))
+        return proxy._lazy_obj
+
+def swap(proxy, obj):
+    """
+    Replaces a proxy's object all at once (i.e. with a retrained model).
+    Anything in the middle of using the old one carries on with it.
+    Returns the old one, or None if it wasn't loaded.
+    """
+    with proxy._lazy_lock:
+        old = proxy._lazy_obj
+        object.__setattr__(proxy, '_lazy_obj', obj)
+    logger.info('Swapped in a new %s.' % proxy._lazy_name)
+    return old
+
+def loaded(proxy):
+    """
+    Whether or not a proxy's object has been created.
+    """
+    return proxy._lazy_obj is not None
+
+def load_time(proxy):
+    """
+    How long (in seconds) creating a proxy's object took,
+    or None if it hasn't been.
+    """
+    return proxy._lazy_load_time
+
+def warm(proxy):
+    """
+    Creates a proxy's object on a background thread,
+    so it's (hopefully) ready by the time it's used.
+    Returns the thread.
+    """
+    thread = threading.Thread(target=load, args=(proxy,), name='warm-%s' % proxy._lazy_name)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,11 +1,41 @@
-from nltk.tokenize import sent_tokenize
-import string, sys, random, pickle
-from os import getcwd, path
+import heapq, random, pickle, threading, time, uuid
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from copy import copy
+from itertools import accumulate, islice
+from operator import itemgetter
+from multiprocessing import get_context
+from os import getcwd, getpid, path, remove, replace
+from app.brain.knowledge import CompactKnowledge, merge_knowledge
+from app.brain import deltalog
+from app.brain.tokenizer import Tokenizer
+from app import metrics
+
+# Logging
+from app.logger import logger
+logger = logger(__name__)
 
 __location__ = path.realpath(path.join(getcwd(), path.dirname(__file__)))
 
+def _stop_rule(token):
+    # Ignore @ mentions
+    if token[0] == '@':
+        return True
+    # Ignore 'RT' in retweets
+    if token == 'RT':
+        return True
+
+# Where the Markov is saved by default.
+FILEPATH = path.join(__location__, 'markov.pickle')
+
+# Tokenizers, which cache how tokens are normalized.
+# One for tokenizing in general, one for training.
+TOKENIZER = Tokenizer()
+TRAINING_TOKENIZER = Tokenizer(stop_rule=_stop_rule)
+
 class Markov():
-    def __init__(self, ngram_size=1, max_chars=140, ramble=True, spasm=0.05, filepath=path.join(__location__, 'markov.pickle')):
+    def __init__(self, ngram_size=1, max_chars=140, ramble=True, spasm=0.05, filepath=FILEPATH, compact=False, max_order=None):
         """
         ngram_size
         Size of ngrams to use for knowledge. on smaller datasets, a value of 1 is recommended,
@@ -24,133 +54,732 @@ class Markov():
 
         filepath
         Where to save/load the Markov to/from.
+        Compact knowledge is saved in the memory-mapped format
+        alongside it, with a '.mkv' extension instead.
+        Training is logged to a '.log' file alongside it,
+        until the next checkpoint.
+
+        compact
+        Whether or not to keep the knowledge in a CompactKnowledge store,
+        which maps tokens to integer ids and packs the counts into arrays.
+        Much smaller in memory (and pickled) for large datasets.
+
+        max_order
+        If set, counts are kept for every ngram size from 1 up to this
+        (or `ngram_size`, if it's bigger), all in the same knowledge.
+        Generation then backs off to shorter priors when the prev tokens
+        have never been seen, before rambling, and `ngram_size`
+        can be changed to any of those sizes without retraining.
+        Costs roughly `max_order` times the knowledge.
         """
+        self.max_order = max_order
         self.n = ngram_size
         self.max_chars = max_chars
         self.ramble = ramble
         self.filepath = filepath
+        self.mapped_filepath = path.splitext(filepath)[0] + '.mkv'
+        self.log_filepath = path.splitext(filepath)[0] + '.log'
         self.spasm = spasm
         self.stop_token = '<STOP>'
 
-        # For limiting recursion-generating of new speech.
+        # For limiting retries at generating new speech.
         self.max_retries = 100
-        self.retries = 0
 
-        self.knowledge = self.load()
+        # How long recent generations took, in seconds.
+        self.latencies = deque(maxlen=1000)
+
+        # How big (in bytes) the training log can get
+        # before it is checkpointed into the saved knowledge.
+        self.max_log_size = 16 * 1024 * 1024
+
+        # Cached sampling tables, built lazily per prior.
+        # In the format of:
+        # prior: (posts, cumulative weights)
+        self._samplers = OrderedDict()
+
+        # Cached checks of which priors can be stopped on.
+        self._stoppable = OrderedDict()
+
+        # How many priors to keep each of those cached for,
+        # dropping the least recently used past that,
+        # so they don't grow into a copy of the whole knowledge.
+        self.max_cached = 100000
+
+        # The seq of the last logged training in the knowledge,
+        # and of any logged here since, past that.
+        self._seq = None
+        self._logged = set()
+
+        # Which save the knowledge was loaded from.
+        self._generation = None
+
+        # Held for reading while generating,
+        # and for writing while the knowledge is changed.
+        self._lock = _ReadWriteLock()
+
+        # The ngram sizes counted in the knowledge,
+        # or None if it doesn't have any counts yet.
+        self._counted = None
+
+        self._keep_compact = compact
+        self.knowledge = self._loaded()
+
+    @property
+    def n(self):
+        return self._n
+
+    @n.setter
+    def n(self, n):
+        self._n = n
+
+    @property
+    def orders(self):
+        """
+        The ngram sizes which are counted when training
+        knowledge which doesn't have any counts yet.
+        """
+        return _orders(self.n, self.max_order)
+
+    @property
+    def counted_orders(self):
+        """
+        The ngram sizes which are counted in the knowledge
+        (and so are counted when training it),
+        as saved and logged with it.
+        These only change when it's reset, i.e. to be retrained.
+        """
+        return self._counted or self.orders
+
+    def knows_order(self, n):
+        """
+        Whether or not ngrams of size `n` are counted in the knowledge,
+        i.e. if the ngram size can be changed to `n` without retraining.
+        """
+        return n in self.counted_orders
+
+    def knows_orders(self, ngram_size, max_order=None):
+        """
+        Whether or not all the ngram sizes counted for
+        an `ngram_size` and `max_order` are counted in the knowledge,
+        i.e. if they can be changed to without retraining.
+        """
+        return all(self.knows_order(n) for n in _orders(ngram_size, max_order))
+
+    @property
+    def knowledge(self):
+        return self._knowledge
 
-        if self.knowledge is None:
+    @knowledge.setter
+    def knowledge(self, knowledge):
+        # Swapping out the knowledge invalidates
+        # all of the cached sampling tables.
+        with self._lock.writing():
+            self._knowledge = knowledge
+            self._samplers = OrderedDict()
+            self._stoppable = OrderedDict()
+
+    def save(self):
+        """
+        Saves the knowledge to disk.
+        Compact knowledge is saved in the memory-mapped format,
+        otherwise it is pickled.
+        Either way, it's written alongside and then moved into place,
+        so a crash mid-save leaves the last save as it was.
+
+        The knowledge is synced first (see `sync()`), so training
+        logged by other processes isn't saved over.
+        The seq of the last logged training it includes
+        is saved with it, so replaying the log skips that training.
+        This doesn't truncate the training log,
+        you probably want `checkpoint()` instead.
+        """
+        with deltalog.locked(self.log_filepath):
+            self.sync()
+
+            self._generation = uuid.uuid4().hex
+            meta = {'seq': self._seq or 0, 'generation': self._generation, 'orders': self._counted}
+            if isinstance(self.knowledge, CompactKnowledge):
+                self.knowledge.meta = meta
+                self.knowledge.dump(self.mapped_filepath)
+            else:
+                tmp_filepath = '%s.%s.tmp' % (self.filepath, getpid())
+                with open(tmp_filepath, 'wb') as file:
+                    pickle.dump(meta, file, pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(self.knowledge, file, pickle.HIGHEST_PROTOCOL)
+                replace(tmp_filepath, self.filepath)
+
+                # Don't leave a stale memory-mapped file around,
+                # since it would be loaded instead.
+                if path.exists(self.mapped_filepath):
+                    remove(self.mapped_filepath)
+
+    def load(self):
+        """
+        Loads the knowledge from disk.
+        Prefers the memory-mapped format,
+        falling back to the pickle if there isn't one.
+        Any training logged since it was saved is replayed on top.
+        """
+        # If nothing's been saved or logged yet, there's nothing to lock
+        # (and no need to make a lock file); `sync()` catches up on anything since.
+        if not any(path.exists(filepath) for filepath in [self.mapped_filepath, self.filepath, self.log_filepath]):
+            self._seq = None
+            self._logged = set()
+            self._generation = None
+            self._counted = None
+            return None
+
+        with deltalog.locked(self.log_filepath):
+            knowledge, meta = self._load_snapshot()
+
+            # Knowledge saved before its ngram sizes were
+            # has them worked out from its priors.
+            if 'orders' in meta or knowledge is None:
+                self._counted = meta.get('orders')
+            else:
+                self._counted = _orders_of(knowledge)
+
+            # Knowledge saved before the log was numbered
+            # includes none of it.
+            seq = meta.get('seq')
+            for entry in deltalog.replay(self.log_filepath, after=seq):
+                if knowledge is None:
+                    knowledge = {(): {}}
+                delta = self._counts(entry)
+                if isinstance(knowledge, CompactKnowledge):
+                    knowledge.learn(delta)
+                else:
+                    merge_knowledge(knowledge, delta)
+                seq = entry.seq
+
+            self._seq = seq
+            self._logged = set()
+            self._generation = meta.get('generation')
+            if seq:
+                deltalog.advance(self.log_filepath, seq)
+            return knowledge
+
+    def _loaded(self):
+        """
+        Loads the knowledge (see `load()`), or starts
+        with nothing if there isn't any, compacting it if need be.
+        """
+        knowledge = self.load()
+
+        if knowledge is None:
             # Load knowledge into memory.
             # For now, just start with nothing.
             # In the format of:
             # ('this', 'is', 'an'): [1, 'example']
-            self.knowledge = {}
+            knowledge = {}
 
             # For keeping track of good starting tokens.
             # Starting tokens come after a prev value of (),
             # that is, after no previous tokens.
-            self.knowledge[()] = {}
+            knowledge[()] = {}
 
-        # Keep track of the last ngram seen,
-        # so we can pick the next token.
-        self.prev = ()
+        if self._keep_compact and not isinstance(knowledge, CompactKnowledge):
+            knowledge = CompactKnowledge(knowledge)
+        return knowledge
 
-    def save(self):
+    def _load_snapshot(self):
         """
-        Saves the knowledge to disk.
+        The saved knowledge and its meta,
+        or None (and no meta) if there isn't any.
         """
-        file = open(self.filepath, 'wb')
-        pickle.dump(self.knowledge, file)
+        try:
+            knowledge = CompactKnowledge.open(self.mapped_filepath)
+            return knowledge, knowledge.meta
+        except (IOError, ValueError):
+            pass
 
-    def load(self):
+        try:
+            file = open(self.filepath, 'rb')
+        except IOError:
+            return None, {}
+
+        # Pickles saved before the meta was
+        # are just the knowledge.
+        with file:
+            knowledge = pickle.load(file)
+            if isinstance(knowledge, dict) and 'seq' in knowledge:
+                return pickle.load(file), knowledge
+            return knowledge, {}
+
+    def _saved_meta(self):
         """
-        Loads the knowledge from disk.
+        The meta of the saved knowledge,
+        without loading all of it (unless it was saved without any).
         """
+        try:
+            return CompactKnowledge.open(self.mapped_filepath).meta
+        except (IOError, ValueError):
+            pass
+
         try:
             file = open(self.filepath, 'rb')
-            return pickle.load(file)
         except IOError:
-            return None
+            return {}
+
+        with file:
+            meta = pickle.load(file)
+            return meta if isinstance(meta, dict) and 'seq' in meta else {}
+
+    def sync(self):
+        """
+        Catches the knowledge up with what other processes
+        (i.e. the web app and the worker) have saved and logged:
+        if the knowledge was saved since it was loaded, it's loaded again,
+        otherwise the training they've logged since is learned.
+        The training logged here is on disk either way, so none is lost.
+        Returns whether or not it was loaded again.
+        """
+        with deltalog.locked(self.log_filepath):
+            if self._saved_meta().get('generation') != self._generation:
+                self.knowledge = self._loaded()
+                return True
+
+            for entry in deltalog.replay(self.log_filepath, after=self._seq or 0):
+                if entry.seq not in self._logged:
+                    self._learn(self._counts(entry))
+                self._seq = entry.seq
+            self._logged = set()
+            return False
+
+    def checkpoint(self):
+        """
+        Saves all of the knowledge and truncates the training log,
+        since its counts are now in the saved knowledge.
+        """
+        # If the process dies between these two, the saved knowledge
+        # has the seq of the logged training, so it isn't replayed twice.
+        with deltalog.locked(self.log_filepath):
+            self.save()
+            deltalog.truncate(self.log_filepath, self._seq or 0)
+
+    def move(self, filepath, since=None):
+        """
+        Saves the knowledge to `filepath` (replacing whatever is saved there),
+        and saves there from now on, cleaning up where it was saved before.
+        i.e. so a Markov trained on the side can take over from another.
 
-    def train(self, docs):
+        since
+        If set, the training logged there after this seq is learned first,
+        i.e. what the other Markov learned while this one was trained
+        (see `deltalog.pinned()`).
+        """
+        old_filepaths = [self.filepath, self.mapped_filepath]
+        old_log_filepath = self.log_filepath
+
+        self.filepath = filepath
+        self.mapped_filepath = path.splitext(filepath)[0] + '.mkv'
+        self.log_filepath = path.splitext(filepath)[0] + '.log'
+
+        with deltalog.locked(self.log_filepath):
+            if since is not None:
+                for entry in deltalog.replay(self.log_filepath, after=since):
+                    self._learn(self._counts(entry))
+
+            # Any other training logged there is in the replaced knowledge,
+            # and the log's seqs carry on from there.
+            self._seq = deltalog.last_seq(self.log_filepath)
+            self._logged = set()
+            self._generation = self._saved_meta().get('generation')
+            self.checkpoint()
+
+        for old_filepath in old_filepaths:
+            if path.exists(old_filepath):
+                remove(old_filepath)
+        deltalog.remove_log(old_log_filepath)
+
+    def train(self, docs, processes=1, chunk_size=1000, batch_size=None, progress=None, prune=None):
         """
         Add to knowledge the learnings
         from some input docs.
+
+        docs
+        Any iterable of docs, i.e. a generator,
+        so they don't need to all be in memory.
+
+        processes
+        How many processes to count the docs with.
+        For bulk training, the docs are split into chunks
+        of `chunk_size` docs, and each is counted
+        by a worker process; the counts are merged after.
+        The result is the same as counting them all here.
+
+        batch_size
+        If set, the docs are learned (and saved) in batches
+        of this many docs, so memory is bounded by the batch
+        rather than by all the docs.
+
+        progress
+        A function which is called with the number
+        of docs trained on so far, after each batch.
+
+        prune
+        Whether or not to `prune()` the knowledge once all
+        the docs are trained on; True, or a dict of its arguments.
+        Best for bulk training, since anything seen only once
+        in a batch is pruned before it can be seen again.
         """
-        def stop_rule(token):
-            # Ignore @ mentions
-            if token[0] == '@':
-                return True
-            # Ignore 'RT' in retweets
-            if token == 'RT':
-                return True
+        started = time.time()
+        ngrams = 0
+        docs = _Tally(docs)
+        batches = _chunks(docs, batch_size) if batch_size else [docs]
+
+        # The worker processes are spawned fresh rather than forked,
+        # since forking a threaded process (i.e. the web app) can leave
+        # them stuck on locks other threads were holding at the time.
+        pool = get_context('spawn').Pool(processes) if processes > 1 else None
+        try:
+            for batch in batches:
+                # The same ngram sizes are counted throughout the batch,
+                # even if the knowledge is synced in the meantime.
+                counter = self._counter()
+                if pool:
+                    delta = {(): {}}
+                    for partial in pool.imap(counter.count, _chunks(batch, chunk_size)):
+                        merge_knowledge(delta, partial)
+                else:
+                    delta = counter.count(batch)
+
+                # Save Markov!
+                # Only the new counts are written, to the log,
+                # so this costs as much as the docs, not the whole knowledge.
+                # They're logged with the ngram sizes they count.
+                data = (counter.counted_orders, delta)
+                with deltalog.locked(self.log_filepath):
+                    self._learn(self._counts(deltalog.Entry(None, 1, data)))
+                    seq, size = deltalog.append(self.log_filepath, data, version=1)
+
+                    # Other processes may have logged in between,
+                    # which `sync()` catches up on.
+                    if seq == (self._seq or 0) + 1 and not self._logged:
+                        self._seq = seq
+                    else:
+                        self._logged.add(seq)
+
+                ngrams += sum(sum(posts.values()) for prior, posts in delta.items() if prior)
+                if size > self.max_log_size:
+                    self.checkpoint()
+
+                if progress:
+                    progress(docs.count)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - started
+        logger.info('Trained on %s docs (%s ngrams) in %.2fs, %.1f docs/sec' % (docs.count, ngrams, elapsed, docs.count/max(elapsed, 1e-6)))
+        if metrics.ENABLED:
+            metrics.observe('brain_markov_train_seconds', elapsed)
+            metrics.inc('brain_markov_train_docs_total', docs.count)
+            metrics.inc('brain_markov_train_ngrams_total', ngrams)
+
+        if prune:
+            self.prune(**(prune if isinstance(prune, dict) else {}))
+
+    def count(self, docs):
+        """
+        Counts up the learnings from some input docs,
+        in the same format as the knowledge.
+        """
+        delta = {(): {}}
+        orders = self.counted_orders
 
         for doc in docs:
-            for sent in sent_tokenize(doc):
-                tokens = self.tokenize(sent, stop_rule=stop_rule)
+            for tokens in TRAINING_TOKENIZER.sentences(doc):
                 if tokens:
                     # Keep track of starting token candidates.
-                    start_token = tuple(tokens[0:self.n])
-                    self.knowledge[()][start_token] = self.knowledge[()].get(start_token, 0) + 1
+                    # These are as long as the longest ngrams,
+                    # since the prev tokens are truncated as needed.
+                    start_token = tuple(tokens[0:orders[-1]])
+                    delta[()][start_token] = delta[()].get(start_token, 0) + 1
 
                     # Example, where ngram_size=3:
                     # ngram = ['this', 'is', 'an', 'example']
-                    for ngram in self.ngramize(tokens):
+                    for n in orders:
+                        for ngram in self.ngramize(tokens, n):
+
+                            # The tokens leading up to the 'post'.
+                            # e.g. ('this', 'is', 'an')
+                            prior = tuple(ngram[:-1])
+
+                            # The 'post' token.
+                            # e.g. 'example'
+                            post = ngram[-1]
+
+                            # Keeps track as:
+                            # prior: {post: count}
+
+                            # Create new prior entry if necessary.
+                            if prior not in delta:
+                                delta[prior] = {}
+
+                            # Increment count of this post token
+                            # for this prior
+                            delta[prior][post] = delta[prior].get(post, 0) + 1
+
+        return delta
+
+    def _counter(self):
+        """
+        A copy of this Markov without any knowledge,
+        so it is cheap to send to worker processes for counting.
+        """
+        counter = copy(self)
+        counter._knowledge = None
+        counter._samplers = OrderedDict()
+        counter._stoppable = OrderedDict()
+        counter._lock = None
+        return counter
+
+    def _counts(self, entry):
+        """
+        The counts of some logged training, keeping only
+        the ngram sizes counted in the knowledge,
+        so it never mixes in other sizes (i.e. training
+        logged before a retrain changed them).
+        If the knowledge doesn't have any counts yet,
+        it counts whichever the training does from now on.
+        """
+        # Training logged before its ngram sizes were
+        # has them worked out from its priors.
+        if entry.version >= 1:
+            orders, delta = entry.data
+        else:
+            delta = entry.data
+            orders = _orders_of(delta)
+
+        if self._counted is None:
+            self._counted = orders
+            return delta
+        if not orders or set(orders) <= set(self._counted):
+            return delta
+
+        # Starting tokens are kept regardless,
+        # since the prev tokens are truncated as needed.
+        return {prior: posts for prior, posts in delta.items() if not prior or len(prior) in self._counted}
+
+    def _learn(self, delta):
+        """
+        Merges new counts, in the format of
+        {prior: {post: count}}, into the knowledge.
+        """
+        # Generation waits, so it never sees the counts half-merged
+        # (or caches a sampling table from before they were).
+        with self._lock.writing():
+            if isinstance(self.knowledge, CompactKnowledge):
+                self.knowledge.learn(delta)
+            else:
+                merge_knowledge(self.knowledge, delta)
+
+            # The counts changed, so these priors'
+            # sampling tables are stale.
+            for prior in delta:
+                self._samplers.pop(prior, None)
+                self._stoppable.pop(prior, None)
+
+    def compact(self):
+        """
+        Packs the knowledge into a CompactKnowledge store
+        (or folds any pending counts into the one it has)
+        and checkpoints it.
+        """
+        with deltalog.locked(self.log_filepath):
+            self.sync()
+            if isinstance(self.knowledge, CompactKnowledge):
+                with self._lock.writing():
+                    self.knowledge.compact()
+            else:
+                self.knowledge = CompactKnowledge(self.knowledge)
+            self.checkpoint()
+
+
+    def prune(self, min_count=2, min_prior_count=None, max_posts=None):
+        """
+        Prunes rarely seen ngrams from the knowledge, and checkpoints it.
+        Most of the ngrams in tweets are only ever seen once;
+        they take up most of the knowledge, but add little to the speech.
+
+        min_count
+        Posts seen fewer times than this (after their prior) are dropped.
+
+        min_prior_count
+        Priors seen fewer times than this (in all) are dropped.
+
+        max_posts
+        If set, only this many of each prior's most common posts are kept.
 
-                        # The tokens leading up to the 'post'.
-                        # e.g. ('this', 'is', 'an')
-                        prior = tuple(ngram[:self.n])
+        <STOP>s are kept for every prior which is,
+        so chains can still stop wherever they could before;
+        priors which would have no posts left are dropped.
+        Then so are posts which lead into a dropped prior,
+        or into one which can't reach a <STOP> any more,
+        so every chain left can still stop (see `_stoppable_only()`).
+        Starting tokens are pruned the same way,
+        but one is always kept: the most common which can stop,
+        or failing that, the most common.
 
-                        # The 'post' token.
-                        # e.g. 'example'
-                        post = ngram[-1]
+        Returns how many priors and posts there were,
+        and how big (in bytes) the knowledge was, before and after.
+        """
+        # Held until it's saved, so no training is logged
+        # in between that the pruned knowledge wouldn't have.
+        with deltalog.locked(self.log_filepath):
+            self.sync()
+            started = time.time()
+            before = self._size()
+
+            scan = self.knowledge.scan() if isinstance(self.knowledge, CompactKnowledge) else self.knowledge.items()
+            pruned = {}
+            for prior, posts in scan:
+                if prior and min_prior_count and sum(posts.values()) < min_prior_count:
+                    continue
 
-                        # Get existing data, if it's there.
-                        # Keeps track as:
-                        # prior: {post: count}
+                kept = {post: count for post, count in posts.items() if count >= min_count or post == self.stop_token}
+                if max_posts is not None and len(kept) > max_posts:
+                    stop = kept.get(self.stop_token)
+                    kept = dict(heapq.nlargest(max_posts, kept.items(), key=itemgetter(1)))
+                    if stop is not None:
+                        kept[self.stop_token] = stop
 
-                        # Create new prior entry if necessary.
-                        if prior not in self.knowledge:
-                            self.knowledge[prior] = {}
+                if kept or not prior:
+                    pruned[prior] = kept
 
-                        # Create new token entry for this prior
-                        # if necessary.
-                        if post not in self.knowledge[prior]:
-                            self.knowledge[prior][post] = 0
+            # If no starting tokens are left, one is kept anyway,
+            # so there's something to say: the most common which can stop, if any can.
+            pruned = self._stoppable_only(pruned)
+            if not pruned[()] and self.knowledge[()]:
+                starts = self.knowledge[()]
+                stoppable = {start: count for start, count in starts.items() if self._leads_on((), start, pruned)}
+                pruned[()] = dict([max((stoppable or starts).items(), key=itemgetter(1))])
 
-                        # Increment count of this post token
-                        # for this prior
-                        self.knowledge[prior][post] += 1
+            if isinstance(self.knowledge, CompactKnowledge):
+                self.knowledge = CompactKnowledge(pruned)
+            else:
+                self.knowledge = pruned
+            self.checkpoint()
 
-        # Save Markov!
-        self.save()
+        after = self._size()
+        stats = {
+            'priors_before': before[0],
+            'priors_after': after[0],
+            'posts_before': before[1],
+            'posts_after': after[1],
+            'bytes_before': before[2],
+            'bytes_after': after[2]
+        }
+        logger.info('Pruned %s of %s priors and %s of %s posts in %.2fs, %s bytes down to %s' % (
+            before[0] - after[0], before[0], before[1] - after[1], before[1], time.time() - started, before[2], after[2]))
+        return stats
+
+    def _stoppable_only(self, pruned):
+        """
+        Drops the posts of some pruned knowledge which lead
+        into a prior that can't reach a <STOP> any more
+        (i.e. it was dropped, or only leads into ones which were),
+        and the priors left without any posts,
+        so no chain in it is left at a dead end.
+        Posts which lead out of the knowledge as it was before pruning
+        weren't cut off by it, so they're left as they were.
+        """
+        # Which priors lead into which,
+        # and the ones which can stop, to walk back from.
+        leads_from = {}
+        stoppable = set()
+        for prior, posts in pruned.items():
+            if not prior:
+                continue
+            for post in posts:
+                next_prior = self._next_prior(prior, post)
+                if post == self.stop_token or next_prior not in self.knowledge:
+                    stoppable.add(prior)
+                elif next_prior in pruned:
+                    leads_from.setdefault(next_prior, []).append(prior)
+
+        queue = list(stoppable)
+        while queue:
+            for prior in leads_from.pop(queue.pop(), ()):
+                if prior not in stoppable:
+                    stoppable.add(prior)
+                    queue.append(prior)
+
+        # Every prior which can stop has a post which leads on.
+        return {prior: {post: count for post, count in posts.items() if self._leads_on(prior, post, stoppable)}
+                for prior, posts in pruned.items() if not prior or prior in stoppable}
+
+    def _leads_on(self, prior, post, stoppable):
+        """
+        Whether or not a post (or starting token, if the prior is ())
+        stops, or leads into a prior in `stoppable`
+        (or out of the knowledge, see `_stoppable_only()`).
+        """
+        next_prior = self._next_prior(prior, post)
+        return post == self.stop_token or next_prior in stoppable or next_prior not in self.knowledge
+
+    def _next_prior(self, prior, post):
+        """
+        The prior a post leads into, in the same ngram size
+        (or for starting tokens, the one generation starts from).
+        """
+        if not prior:
+            return self._advance(prior, post)
+        return (prior + (post,))[-len(prior):]
+
+    def _size(self):
+        """
+        How many priors and posts there are in the knowledge,
+        and roughly how big it is (in bytes) as saved.
+        """
+        if isinstance(self.knowledge, CompactKnowledge):
+            with self._lock.writing():
+                self.knowledge.compact()
+            return len(self.knowledge), len(self.knowledge.posts), self.knowledge.nbytes
+        return len(self.knowledge), sum(len(posts) for posts in self.knowledge.values()), len(pickle.dumps(self.knowledge, pickle.HIGHEST_PROTOCOL))
 
 
     def reset(self):
         """
         Resets the Markov generator's knowledge.
         """
-        self.knowledge = {}
-        self.knowledge[()] = {}
-        self.save()
+        with deltalog.locked(self.log_filepath):
+            if isinstance(self.knowledge, CompactKnowledge):
+                self.knowledge = CompactKnowledge()
+            else:
+                self.knowledge = {}
+                self.knowledge[()] = {}
 
+            # Everything saved and logged so far is reset too,
+            # and training counts the configured ngram sizes again.
+            self._counted = None
+            self._seq = deltalog.last_seq(self.log_filepath)
+            self._logged = set()
+            self._generation = self._saved_meta().get('generation')
+            self.checkpoint()
 
-    def ngramize(self, tokens):
+
+    def ngramize(self, tokens, n=None):
         """
         A generator which chunks a list of tokens
-        into ngram lists.
+        into ngram lists, of `n` (by default, `ngram_size`)
+        prior tokens and their post.
         """
+        n = n or self.n
 
         # Ensure we have enough tokens to work with.
-        if len(tokens) > self.n:
+        if len(tokens) > n:
             # Add the <stop> token to the end.
-            tokens.append(self.stop_token)
+            tokens = tokens + [self.stop_token]
 
             # Yield the ngrams.
-            for i in range(len(tokens) - self.n):
-                next = i + self.n + 1
+            for i in range(len(tokens) - n):
+                next = i + n + 1
                 yield tokens[i:next]
 
-    def tokenize(self, doc, stop_rule=lambda token: False):
+    def tokenize(self, doc, stop_rule=None):
         """
         Tokenizes a document.
         This is a very naive tokenizer;
@@ -162,36 +791,76 @@ class Markov():
         Optionally provide a `stop_rule` function,
         which should return True if a token should be stopped on.
         """
-        tokens = []
-        punctuation = string.punctuation.replace('@', '') + '“”‘’–"'
+        if stop_rule is None:
+            return TOKENIZER.tokenize(doc)
+        return Tokenizer(stop_rule=stop_rule).tokenize(doc)
 
-        for token in doc.split(' '):
-            # This saves memory by having
-            # duplicate strings just point to the same memory.
-            token = sys.intern(token.strip(punctuation))
+    def generate(self):
+        """
+        Generate some 'speech'.
 
-            # Ignore punctuation and stopwords
-            if not token or stop_rule(token):
-                continue
+        All of the state of the generation is local to the call,
+        so the same Markov can generate on many threads at once.
+        Training (or anything else which changes the knowledge)
+        waits for generation in progress to finish, and vice versa.
 
-            tokens.append(token.lower())
-        return tokens
+        This has a hard limit on its cost:
+        at most `max_retries` + 1 attempts,
+        each of at most `max_chars` tokens.
+        """
+        # Held throughout, so training can't change the knowledge mid-chain.
+        with self._lock.reading():
+            return self._generate(random)
 
-    def generate(self):
+    def _generate(self, rng):
         """
-        Generate some 'speech'.
+        Generates some 'speech' (see `generate()`),
+        making its random draws with `rng`.
         """
+        started = time.perf_counter()
+        consolidations = 0
 
-        # Reset the previous tokens.
-        self.prev = ()
+        for attempt in range(self.max_retries + 1):
+            tokens, length = self._chain(rng)
+            if length < self.max_chars:
+                break
 
-        tokens = []
+            # If the constraint is violated, try consolidating.
+            consolidations += 1
+            consolidated = self._consolidate(tokens)
+            if consolidated:
+                tokens = consolidated
+                break
+
+        # If the max retries has been hit,
+        # just drop the last token.
+        else:
+            tokens = tokens[:-1]
+
+        elapsed = time.perf_counter() - started
+        self.latencies.append(elapsed)
+        if metrics.ENABLED:
+            metrics.observe('brain_markov_generate_seconds', elapsed)
+            metrics.inc('brain_markov_generate_tokens_total', len(tokens))
+            metrics.inc('brain_markov_generate_retries_total', attempt)
+            metrics.inc('brain_markov_consolidations_total', consolidations)
+        return ' '.join(tokens)
+
+    def _chain(self, rng=random):
+        """
+        Walks a chain of tokens until it stops,
+        or until it is at least `max_chars` long.
+        Returns the tokens and the length of their text.
+        """
+        # Keep track of the last ngram seen,
+        # so we can pick the next token.
+        prev = ()
 
-        def constraint(tokens):
-            return len(' '.join(tokens)) < self.max_chars
+        tokens = []
+        length = 0
 
-        while constraint(tokens):
-            next_token = self._next_token()
+        while length < self.max_chars:
+            next_token = self._next_token(prev, rng)
 
             # If a token couldn't be found, or
             # if the next token is a stop token,
@@ -201,100 +870,300 @@ class Markov():
 
             # Update the prev tokens,
             # truncating if necessary.
-            if type(next_token) is tuple:
-                self.prev += next_token
-                tokens += list(next_token)
-            else:
-                self.prev += (next_token,)
-                tokens.append(next_token)
+            next_tokens = next_token if type(next_token) is tuple else (next_token,)
+            for token in next_tokens:
+                length += len(token) + (1 if tokens else 0)
+                tokens.append(token)
+            prev = self._advance(prev, next_token)
 
+        return tokens, length
 
-            if len(self.prev) > self.n:
-                self.prev = self.prev[1:]
+    def latency(self, percentile=99):
+        """
+        The given percentile of the latencies (in seconds)
+        of recent calls to `generate()`.
+        """
+        # Copied first, since other threads could be adding to it.
+        latencies = sorted(self.latencies.copy())
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
 
-        # If the constraint is violated, try consolidating.
-        if not constraint(tokens):
-            full = tokens
-            consolidated = self._consolidate(tokens)
+    def generate_many(self, n, seed=None):
+        """
+        Generate n 'speeches' at once.
+        These follow the same rules as `generate()`,
+        but training waits for all of them, not just each.
 
-            if not consolidated:
-                # Try to generate a new string.
-                if self.retries < self.max_retries:
-                    self.retries += 1
-                    tokens = self.generate().split(' ')
-                else:
-                    # If this max retries has been hit,
-                    # just drop the last token.
-                    tokens = full[:-1]
-            else:
-                tokens = consolidated
+        seed
+        Seed for the random draws, for reproducible speech.
+        """
+        rng = random.Random(seed) if seed is not None else random
+        with self._lock.reading():
+            return [self._generate(rng) for i in range(n)]
 
-        self.retries = 0
-        return ' '.join(tokens)
+    def _advance(self, prev, next_token):
+        """
+        Updates the prev tokens with the next token,
+        truncating if necessary.
+        """
+        if type(next_token) is tuple:
+            prev += next_token
+        else:
+            prev += (next_token,)
+
+        if len(prev) > self.n:
+            prev = prev[-self.n:]
+        return prev
 
     def _consolidate(self, tokens):
         """
         Shortens the generated text so it is
         less than the max character length.
 
-        The strategy is to remove ngrams until
-        the list of tokens ends with an ngram that
-        has a <STOP> associated with it.
+        The strategy is to backtrack until
+        the list of tokens is short enough and ends
+        with an ngram that has a <STOP> associated with it.
         The truncated list of tokens is returned.
         This list could potentially be empty.
         """
-        # The n-length tail of the generated text,
-        # to see if it's a stop candidate.
-        tail = tuple(tokens[-self.n:])
+        # The length of the text of tokens[:end].
+        length = len(' '.join(tokens))
 
-        # Check if we can stop here.
-        # Stop here anyway if tail is (), since it will infinitely recurse,
-        # and it implies the tokens list is now empty.
-        if not tail or (self.knowledge.get(tail, {}).get('<STOP>', 0) and len(tokens) < self.max_chars):
-            return tokens
+        for end in range(len(tokens), 0, -1):
+            if length < self.max_chars and self._can_stop(tuple(tokens[max(0, end - self.n):end])):
+                return tokens[:end]
+            length -= len(tokens[end-1]) + (1 if end > 1 else 0)
 
-        # If not, RECURSE!
-        else:
-            tokens = tokens[0:-self.n]
-            return self._consolidate(tokens)
+        return []
+
+    def _can_stop(self, prior):
+        """
+        Whether or not a prior has a <STOP> associated with it.
+        Cached, since it is checked a lot when consolidating.
+        """
+        try:
+            return _cached(self._stoppable, prior)
+        except KeyError:
+            # Checked against the prior that generation would use.
+            stoppable = False
+            for backoff in self._backoffs(prior):
+                posts = self.knowledge.get(backoff)
+                if posts is not None:
+                    stoppable = self.stop_token in posts
+                    break
+            return _cache(self._stoppable, prior, stoppable, self.max_cached)
 
-    def _next_token(self):
+    def _next_token(self, prev=(), rng=random):
         """
-        Choose the next token.
+        Choose the next token, given the prev tokens of the chain.
 
-        If there's a key error, it may be
-        because self.prev doesn't have enough grams/tokens in it,
+        If the prev ngram has never been encountered before,
+        it backs off to its shorter suffixes, if those are counted (see `max_order`).
+        If there's still a key error, it may be
+        because prev doesn't have enough grams/tokens in it,
         which  means we're still early in the generation, so just pick
         a random starting token.
-        Otherwise, it's probably because the self.prev ngram has never
-        been enconutered before. In which case, if self.ramble is True,
+        Otherwise, if self.ramble is True,
         pick a random starting token, otherwise, just end return None.
         """
-        if random.random() < self.spasm:
-            return self._weighted_choice(self.knowledge[()])
+        if rng.random() < self.spasm:
+            return self._choose((), rng)
         else:
-            try:
-                return self._weighted_choice(self.knowledge[self.prev])
-            except KeyError:
-                if len(self.prev) < self.n or self.ramble:
-                    return self._weighted_choice(self.knowledge[()])
+            for prior in self._backoffs(prev):
+                try:
+                    return self._choose(prior, rng)
+                except KeyError:
+                    pass
+            if len(prev) < self.n or self.ramble:
+                return self._choose((), rng)
+
+    def _backoffs(self, prev):
+        """
+        The priors to try for some prev tokens, longest first:
+        the prev tokens themselves and, if lower orders
+        are counted, their shorter suffixes.
+        """
+        yield prev
+        counted = self.counted_orders
+        for i in range(1, len(prev)):
+            if len(prev) - i in counted:
+                yield prev[i:]
+
+    def _choose(self, prior, rng=random):
+        """
+        Randomly selects a post token for a prior,
+        weighted by its counts.
+
+        The prior's sampling table is built on first use
+        and cached until training changes its counts,
+        so each draw is just a binary search.
+        Raises a KeyError if the prior is unknown.
+        """
+        return self._draw(self._sampler_for(prior), rng)
+
+    def _sampler_for(self, prior):
+        """
+        The cached sampling table for a prior.
+        Raises a KeyError if the prior is unknown.
+        """
+        try:
+            return _cached(self._samplers, prior)
+        except KeyError:
+            return _cache(self._samplers, prior, self._sampler(self.knowledge[prior]), self.max_cached)
 
     def _weighted_choice(self, choices):
         """
         Random selects a key from a dictionary,
         where each key's value is its probability weight.
         """
-        # Randomly select a value between 0 and
-        # the sum of all the weights.
-        rand = random.uniform(0, sum(choices.values()))
+        return self._draw(self._sampler(choices))
 
-        # Seek through the dict until a key is found
-        # resulting in the random value.
-        summ = 0.0
-        for key, value in choices.items():
-            summ += value
-            if rand < summ: return key
+    def _sampler(self, choices):
+        """
+        Builds a sampling table for a dictionary of weights:
+        the keys, and the running total of their weights.
+        """
+        keys = list(choices.keys())
+        cumulative = list(accumulate(choices[key] for key in keys))
+        return keys, cumulative
+
+    def _draw(self, sampler, rng=random):
+        """
+        Draws a key from a sampling table.
+        """
+        keys, cumulative = sampler
 
         # If this returns False,
         # it's likely because the knowledge is empty.
-        return False
\ No newline at end of file
+        if not keys:
+            return False
+
+        # Randomly select a value between 0 and
+        # the sum of all the weights, and find
+        # the first key whose running total exceeds it.
+        rand = rng.random() * cumulative[-1]
+        return keys[bisect_right(cumulative, rand)]
+
+
+class _Tally():
+    """
+    Iterates over some docs,
+    keeping count of how many there were.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.count = 0
+
+    def __iter__(self):
+        for doc in self.docs:
+            self.count += 1
+            yield doc
+
+
+class _ReadWriteLock():
+    """
+    A lock which many threads can hold for reading at once,
+    or one thread for writing.
+    Threads waiting to write go first, so they aren't
+    held off forever by a steady stream of readers.
+    Neither is reentrant.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting = 0
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writing or self._waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+def _orders(ngram_size, max_order):
+    """
+    The ngram sizes counted for an `ngram_size` and `max_order`
+    (see `Markov.__init__()`).
+    """
+    if max_order is None:
+        return (ngram_size,)
+    return tuple(range(1, max(max_order, ngram_size) + 1))
+
+def _orders_of(knowledge):
+    """
+    The ngram sizes counted in some knowledge (or counts),
+    i.e. the sizes of its priors, or None if it doesn't have any.
+    """
+    if isinstance(knowledge, CompactKnowledge):
+        sizes = knowledge.prior_sizes()
+    else:
+        sizes = {len(prior) for prior in knowledge}
+    sizes.discard(0)
+    return tuple(sorted(sizes)) or None
+
+def _cached(cache, key):
+    """
+    Gets a value from a least recently used cache (an OrderedDict),
+    marking it as used. Raises a KeyError if it isn't cached.
+    """
+    value = cache[key]
+    try:
+        cache.move_to_end(key)
+
+    # Another thread generating may have just dropped it.
+    except KeyError:
+        pass
+    return value
+
+def _cache(cache, key, value, size):
+    """
+    Puts a value into a least recently used cache (an OrderedDict),
+    dropping the least recently used past `size`,
+    and returns the value.
+    """
+    cache[key] = value
+    while len(cache) > size:
+        try:
+            cache.popitem(last=False)
+
+        # Another thread generating may have just emptied it.
+        except KeyError:
+            break
+    return value
+
+def _chunks(docs, size):
+    """
+    A generator which chunks an iterable
+    of docs into lists of `size` docs.
+    """
+    docs = iter(docs)
+    while True:
+        chunk = list(islice(docs, size))
+        if not chunk:
+            return
+        yield chunk
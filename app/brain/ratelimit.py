@@ -0,0 +1,202 @@
+"""
+Rate limiting for calls to rate-limited APIs (i.e. Twitter),
+so concurrent callers share each endpoint's budget
+instead of each finding out they're over it the hard way.
+"""
+
+import time
+import threading
+
+class Clock():
+    """
+    The real time, for scheduling.
+    """
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class TokenBucket():
+    """
+    Hands out tokens at a steady `rate` (per second),
+    allowing bursts of up to `capacity` tokens.
+
+    Tokens can be reserved before they're available,
+    which puts the bucket into debt; later reservations
+    wait behind earlier ones, so callers are served in order.
+    """
+
+    def __init__(self, rate, capacity, clock):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock.time()
+
+    def reserve(self):
+        """
+        Takes a token.
+        Returns how long (in seconds) to wait
+        until it can be used.
+        """
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def hold(self, seconds):
+        """
+        Holds off handing out any more tokens
+        for at least `seconds`, i.e. when backing off.
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def _refill(self):
+        now = self.clock.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Scheduler():
+    """
+    Schedules calls to rate-limited endpoints.
+
+    Each endpoint has a token bucket, and calls
+    wait their turn for a token before going out.
+    Calls which fail in a way that's worth retrying
+    (i.e. being rate limited) are backed off exponentially,
+    holding up the rest of the endpoint's calls as well.
+    """
+
+    def __init__(self, limits=None, clock=None, should_retry=None, max_retries=3, backoff=5, max_backoff=15*60):
+        """
+        limits
+        A dict of {endpoint: (calls, period, burst)},
+        i.e. `calls` per `period` seconds,
+        with up to `burst` of them at once.
+        Endpoints without limits aren't held up.
+
+        clock
+        What to tell time and wait with;
+        defaults to the real time.
+
+        should_retry
+        A function which takes the endpoint and an exception
+        raised by a call to it, and returns whether or not
+        it's worth retrying.
+        By default, nothing is retried.
+
+        max_retries
+        How many times to retry a call before giving up.
+
+        backoff, max_backoff
+        How long (in seconds) to back off after the first failure;
+        this doubles with each failure, up to `max_backoff`.
+        """
+        self.clock = clock or Clock()
+        self.should_retry = should_retry or (lambda endpoint, err: False)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._stats = {}
+
+        # When each endpoint's scheduled waits run until.
+        self._limited_until = {}
+        for endpoint, (calls, period, burst) in (limits or {}).items():
+            self._buckets[endpoint] = TokenBucket(calls / period, burst, self.clock)
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """
+        Calls `func` with the given args
+        once there's room in the endpoint's budget,
+        retrying it (if it's worth it) when it fails.
+        """
+        bucket = self._buckets.get(endpoint)
+        stats = self._stats_for(endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            wait = 0
+            with self._lock:
+                if bucket is not None:
+                    wait = bucket.reserve()
+                    self._limit(endpoint, stats, wait)
+                stats['queued'] += 1
+                stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+
+            if wait > 0:
+                self.clock.sleep(wait)
+
+            with self._lock:
+                stats['queued'] -= 1
+                stats['waited'] += wait
+                stats['max_wait'] = max(stats['max_wait'], wait)
+                stats['calls'] += 1
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                with self._lock:
+                    stats['errors'] += 1
+                if attempt == self.max_retries or not self.should_retry(endpoint, err):
+                    raise
+
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                with self._lock:
+                    stats['retries'] += 1
+                    if bucket is not None:
+                        bucket.hold(delay)
+                    else:
+                        self._limit(endpoint, stats, delay)
+                if bucket is None:
+                    self.clock.sleep(delay)
+
+    def stats(self):
+        """
+        Returns a dict of stats for each endpoint called so far:
+        how many calls were made, how many errored and were retried,
+        how many calls are queued (and the most there have been),
+        how long (in seconds) calls have waited in total (and at most),
+        and how long the endpoint has been held up by its limits
+        (or backing off) in all, i.e. as time passes rather than
+        added up over calls waiting at once.
+        """
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def _limit(self, endpoint, stats, wait):
+        """
+        Counts a scheduled wait towards the time the endpoint is held up,
+        leaving out any of it which overlaps waits already counted.
+        Waits are served in order, so they end in order too.
+        """
+        if wait <= 0:
+            return
+        now = self.clock.time()
+        start = max(now, self._limited_until.get(endpoint, now))
+        end = now + wait
+        if end > start:
+            stats['limited'] += end - start
+            self._limited_until[endpoint] = end
+
+    def _stats_for(self, endpoint):
+        with self._lock:
+            if endpoint not in self._stats:
+                self._stats[endpoint] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'queued': 0,
+                    'max_queued': 0,
+                    'waited': 0,
+                    'max_wait': 0,
+                    'limited': 0
+                }
+            return self._stats[endpoint]
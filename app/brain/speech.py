@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+
+class SpeechPool():
+    """
+    A pool of pre-generated speech,
+    so requests don't have to wait on the Markov generator.
+    A background thread keeps it topped up.
+    """
+
+    def __init__(self, markov, size=50):
+        """
+        markov
+        The Markov generator to generate speech with.
+
+        size
+        How much speech to keep in the pool.
+        """
+        self.markov = markov
+        self.size = size
+
+        self._speech = deque()
+        self._thread = None
+
+        # Set whenever the pool needs topping up.
+        self._wanted = threading.Event()
+
+        # Guards the pool when it is being invalidated.
+        # Generation needs no lock, since the Markov
+        # can generate on many threads at once.
+        self._lock = threading.Lock()
+
+        # Incremented whenever the pool is invalidated,
+        # so speech which was being generated at the time
+        # is thrown out rather than added to the pool.
+        self._version = 0
+
+    def pop(self):
+        """
+        Takes some speech from the pool.
+        If the pool is empty, it's generated on the spot.
+        """
+        if self._thread is None:
+            self.start()
+
+        try:
+            speech = self._speech.popleft()
+        except IndexError:
+            speech = self._generate()
+
+        self._wanted.set()
+        return speech
+
+    def invalidate(self):
+        """
+        Empties the pool, i.e. when the Markov's
+        configuration or knowledge has changed.
+        """
+        with self._lock:
+            self._version += 1
+            self._speech.clear()
+        self._wanted.set()
+
+    def fill(self):
+        """
+        Tops up the pool.
+        """
+        while len(self._speech) < self.size:
+            version = self._version
+            speech = self._generate()
+            with self._lock:
+                if version == self._version:
+                    self._speech.append(speech)
+
+    def start(self):
+        """
+        Starts the background thread which keeps the pool topped up.
+        """
+        self._thread = threading.Thread(target=self._run, name='speech-pool')
+        self._thread.daemon = True
+        self._thread.start()
+        self._wanted.set()
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            self.fill()
+
+    def _generate(self):
+        return self.markov.generate()
+
+    def __len__(self):
+        return len(self._speech)
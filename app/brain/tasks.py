@@ -0,0 +1,122 @@
+import threading, time, uuid
+from collections import OrderedDict
+
+# Logging
+from app.logger import logger
+logger = logger(__name__)
+
+class Task():
+    """
+    A function run on a background thread (i.e. retraining),
+    whose progress can be checked on by its id.
+
+    The function is called with a `progress` function,
+    which it can call with how much it's done so far
+    (and optionally, how much there is to do in all).
+    """
+
+    def __init__(self, name, func):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.func = func
+
+        self.status = 'pending'
+        self.done = 0
+        self.total = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='task-%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        logger.info('Started %s (%s).' % (self.name, self.id))
+        try:
+            self.func(self.progress)
+            self.status = 'done'
+            logger.info('Finished %s (%s).' % (self.name, self.id))
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            logger.exception('Task %s (%s) failed.' % (self.name, self.id))
+        finally:
+            self.finished_at = time.time()
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    @property
+    def running(self):
+        return self.status in ('pending', 'running')
+
+    def join(self, timeout=None):
+        """
+        Waits for the task to finish.
+        Returns whether or not it did.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class Tasks():
+    """
+    Keeps track of background Tasks,
+    only running one of each name at a time.
+    """
+
+    def __init__(self, max_kept=100):
+        """
+        max_kept
+        How many tasks to keep track of;
+        the oldest are forgotten first.
+        """
+        self.max_kept = max_kept
+        self._tasks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, name, func):
+        """
+        Starts running `func` as a Task, and returns it.
+        If a Task of the same name is already running,
+        that one is returned instead.
+        """
+        with self._lock:
+            for task in self._tasks.values():
+                if task.name == name and task.running:
+                    return task
+
+            task = Task(name, func)
+            self._tasks[task.id] = task
+            while len(self._tasks) > self.max_kept:
+                self._tasks.popitem(last=False)
+
+        return task.start()
+
+    def get(self, id):
+        """
+        The Task with an id, or None if there isn't one.
+        """
+        return self._tasks.get(id)
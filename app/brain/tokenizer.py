@@ -0,0 +1,146 @@
+"""
+A fast tokenizer for training the Markov generator,
+which splits docs into sentences of tokens in a single pass.
+
+Sentences are split the way NLTK's punkt tokenizer
+would split tweet-like text: at '!' and '?',
+and at '.' unless it ends an abbreviation or an initial.
+An ellipsis only ends a sentence if the next one is capitalized.
+"""
+
+import re, string, sys
+
+# Stripped from the beginning and end of tokens,
+# except for '@' at the beginning of a token.
+PUNCTUATION = string.punctuation.replace('@', '') + '“”‘’–"'
+
+# Abbreviations which don't end a sentence.
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc',
+    'inc', 'ltd', 'co', 'corp', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul',
+    'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'no', 'approx', 'dept'
+}
+
+# Sentence-ending punctuation at the end of a token,
+# possibly followed by closing quotes or brackets.
+_sentence_end = re.compile(r'([.!?…]+)[\'"”’)\]]*$')
+
+# How a token ends a sentence.
+NO_END = 0
+END = 1
+MAYBE_END = 2
+
+
+class Tokenizer():
+    """
+    Splits docs into tokens, and sentences of tokens.
+
+    Tokens are split on whitespace, stripped of punctuation,
+    lowercased, and then interned, so duplicate tokens
+    point to the same memory. How each distinct token
+    is normalized is cached, since most tokens repeat.
+    """
+
+    def __init__(self, stop_rule=None, max_cached=100000):
+        """
+        stop_rule
+        A function which should return True if a token
+        should be stopped on (i.e. left out). It's given
+        the token stripped of punctuation, but not lowercased.
+
+        max_cached
+        How many distinct tokens to cache the normalization of.
+        """
+        self.stop_rule = stop_rule
+        self.max_cached = max_cached
+        self._cache = {}
+
+    def tokenize(self, doc):
+        """
+        Returns a doc's tokens.
+        """
+        tokens = []
+        cache = self._cache
+        for raw in doc.split():
+            try:
+                token = cache[raw][0]
+            except KeyError:
+                token = self._normalize(raw)[0]
+            if token is not None:
+                tokens.append(token)
+        return tokens
+
+    def sentences(self, doc):
+        """
+        Returns a doc's sentences, each as a list of its tokens.
+        Sentences without any tokens are left out.
+        """
+        sentences = []
+        tokens = []
+        cache = self._cache
+        raws = doc.split()
+        last = len(raws) - 1
+
+        for i, raw in enumerate(raws):
+            try:
+                token, end = cache[raw]
+            except KeyError:
+                token, end = self._normalize(raw)
+
+            if token is not None:
+                tokens.append(token)
+
+            if end == END or (end == MAYBE_END and i < last and raws[i+1].lstrip(PUNCTUATION)[:1].isupper()):
+                if tokens:
+                    sentences.append(tokens)
+                tokens = []
+
+        if tokens:
+            sentences.append(tokens)
+        return sentences
+
+    def _normalize(self, raw):
+        """
+        Normalizes a token, caching the result.
+        Returns the token (None if it should be left out)
+        and how it ends a sentence.
+        """
+        stripped = raw.strip(PUNCTUATION)
+        if not stripped or (self.stop_rule is not None and self.stop_rule(stripped)):
+            token = None
+        else:
+            # Interned after lowercasing,
+            # since lowering makes a new string.
+            token = sys.intern(stripped.lower())
+
+        result = (token, _ends_sentence(raw))
+        if len(self._cache) >= self.max_cached:
+            self._cache.clear()
+        self._cache[raw] = result
+        return result
+
+
+def _ends_sentence(raw):
+    """
+    Whether a token ends a sentence:
+    it does (END), it doesn't (NO_END),
+    or it does if the next token is capitalized (MAYBE_END).
+    """
+    match = _sentence_end.search(raw)
+    if match is None:
+        return NO_END
+
+    marks = match.group(1)
+    if '!' in marks or '?' in marks:
+        return END
+
+    # An ellipsis.
+    if len(marks) > 1 or marks == '…':
+        return MAYBE_END
+
+    # An abbreviation, i.e. 'Mr.', 'e.g.' or an initial.
+    word = raw[:match.start()].lstrip(PUNCTUATION).lower()
+    if word in ABBREVIATIONS or '.' in word or (len(word) == 1 and word.isalpha()):
+        return NO_END
+
+    return END
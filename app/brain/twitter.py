@@ -1,5 +1,8 @@
+import re
 import tweepy
 from tweepy import TweepError
+from app.brain.ratelimit import Scheduler
+from app import metrics
 
 # Logging
 from app.logger import logger
@@ -9,6 +12,10 @@ from os import getcwd, path
 import simplejson as json
 __location__ = path.realpath(path.join(getcwd(), path.dirname(__file__)))
 
+# How long (in seconds) to wait on Twitter's response to a request,
+# so a stalled connection can't tie up a fetching thread for good.
+TIMEOUT = 20
+
 def _api():
     """
     Load auth info from config.
@@ -21,31 +28,124 @@ def _api():
     auth.set_access_token(twitter['access_token'], twitter['access_token_secret'])
 
     # Return API object.
-    return tweepy.API(auth)
+    return tweepy.API(auth, timeout=TIMEOUT)
 
 api = _api()
 
-def tweets(username, count=200):
+# Twitter's limits for the endpoints we use,
+# as (calls, per seconds, burst).
+# Tweeting and retweeting share a budget.
+LIMITS = {
+    'user_timeline': (180, 15*60, 15),
+    'statuses': (300, 3*60*60, 5)
+}
+
+# Endpoints which only read, so are safe to call again.
+READS = {'user_timeline'}
+
+def _status(err):
+    """
+    The HTTP status of a TweepError, if it has one.
+    """
+    response = getattr(err, 'response', None)
+    status = getattr(response, 'status', None) or getattr(response, 'status_code', None)
+    if status is None:
+        match = re.search(r'\b([45]\d\d)\b', str(err))
+        if match:
+            status = int(match.group(1))
+    return status
+
+def _should_retry(endpoint, err):
     """
-    Returns 200 last tweets for a user.
+    Retry when rate limited or when Twitter is having trouble;
+    anything else won't go any better the second time.
+    Only reads are retried when Twitter is having trouble though,
+    since a tweet or retweet may have gone out regardless,
+    and retrying it would post it twice.
+    """
+    if not isinstance(err, TweepError):
+        return False
+    status = _status(err)
+    return status == 429 or (endpoint in READS and status in (500, 502, 503, 504))
+
+scheduler = Scheduler(LIMITS, should_retry=_should_retry)
+
+def _call(endpoint, func, *args, **kwargs):
+    """
+    Calls the API through the scheduler, timing it
+    (including any time spent waiting on the rate limit).
+    """
+    with metrics.timed('brain_twitter_call_seconds', endpoint=endpoint):
+        try:
+            return scheduler.call(endpoint, func, *args, **kwargs)
+        except TweepError as err:
+            metrics.inc('brain_twitter_errors_total', endpoint=endpoint, status=_status(err))
+            raise
+
+def limited(endpoint='user_timeline'):
     """
-    return [
-            {
-                'body': tweet.text,
-                'tid': tweet.id,
-                'protected': tweet.user.protected,
-                'retweeted': tweet.retweeted
-            }
-            for tweet in api.user_timeline(screen_name=username, count=count)
-            ]
+    How long (in seconds) calls to an endpoint
+    have been held up by its rate limit so far,
+    i.e. so time spent waiting on it can be told apart
+    from time spent waiting on Twitter.
+    """
+    return scheduler.stats().get(endpoint, {}).get('limited', 0)
+
+def tweets(username, count=200, since_id=None, max_id=None, pages=1):
+    """
+    Returns the last tweets for a user, newest first.
+
+    since_id
+    Only return tweets newer than this tweet id.
+
+    max_id
+    Only return tweets at least as old as this tweet id.
+
+    pages
+    How many pages of `count` tweets to go back through,
+    i.e. to backfill past the last 200 tweets.
+    Stops early once a page comes back empty,
+    or once it's gone back past `since_id`.
+    A short page doesn't mean there's nothing older,
+    since Twitter counts deleted and suspended tweets
+    against `count` and then leaves them out.
+    """
+    results = []
+    for page in range(pages):
+        params = {'screen_name': username, 'count': count}
+        if since_id is not None:
+            params['since_id'] = since_id
+        if max_id is not None:
+            params['max_id'] = max_id
+
+        timeline = _call('user_timeline', api.user_timeline, **params)
+        results += [
+                {
+                    'body': tweet.text,
+                    'tid': tweet.id,
+                    'protected': tweet.user.protected,
+                    'retweeted': tweet.retweeted
+                }
+                for tweet in timeline
+                ]
+
+        if not timeline:
+            break
+
+        # The next page picks up below the oldest tweet so far.
+        max_id = min(tweet.id for tweet in timeline) - 1
+        if since_id is not None and max_id <= since_id:
+            break
+
+    return results
 
 def retweet(id):
     try:
-        api.retweet(id)
+        _call('statuses', api.retweet, id)
     except TweepError as err:
         # Assume we may have violated some rate limit
         # and forget about it
-        if '403' in err:
+        if _status(err) == 403:
             logger.info('403 error when trying to retweet. Possibly hit a rate limit.')
         else:
             raise err
@@ -53,11 +153,11 @@ def retweet(id):
 
 def tweet(text):
     try:
-        api.update_status(text)
+        _call('statuses', api.update_status, text)
     except TweepError as err:
         # Assume we may have violated some rate limit
         # and forget about it
-        if '403' in err:
+        if _status(err) == 403:
             logger.info('403 error when trying to tweet. Possibly hit a rate limit.')
         else:
             raise err
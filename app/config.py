@@ -1,14 +1,43 @@
+import threading
+from time import monotonic
 from app.models import Config
+from app import metrics
 
 # Create Config object if necessary.
 if len(Config.objects) < 1:
     config = Config()
     config.save()
 
+# How long (in seconds) to hold onto the Config
+# before loading it again. Changes made through
+# the web app invalidate it right away, but changes
+# made elsewhere (i.e. by another process) take this long.
+TTL = 60
+
+_cached = None
+_loaded_at = None
+_lock = threading.Lock()
+
 def config():
     """
     Loads the Config.
-    Loading it on the fly means the latest
-    configuration will always be used.
+    It's cached for `TTL` seconds, so it can be
+    called as often as needed without hitting the db,
+    but the latest configuration will still be used.
+    """
+    global _cached, _loaded_at
+    with _lock:
+        if _cached is None or monotonic() - _loaded_at > TTL:
+            with metrics.timed('brain_mongo_seconds', op='config'):
+                _cached = Config.objects[0]
+            _loaded_at = monotonic()
+        return _cached
+
+def invalidate():
+    """
+    Forgets the cached Config, i.e. when it's been changed,
+    so the next call to `config()` loads it again.
     """
-    return Config.objects[0]
+    global _cached
+    with _lock:
+        _cached = None
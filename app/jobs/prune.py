@@ -0,0 +1,28 @@
+# Prunes rarely seen ngrams from the Markov generator's knowledge,
+# to keep it (and its saved file) small.
+#
+#   $ python -m app.jobs.prune
+#   $ python -m app.jobs.prune --min-count 2 --min-prior-count 3 --max-posts 100
+#
+# The worker (and web app) pick up the pruned knowledge
+# the next time they sync or checkpoint.
+
+import argparse
+from app import brain
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prunes rarely seen ngrams from the brain.')
+    parser.add_argument('--min-count', type=int, default=2, help='drop posts seen fewer times than this')
+    parser.add_argument('--min-prior-count', type=int, help='drop priors seen fewer times than this')
+    parser.add_argument('--max-posts', type=int, help='keep at most this many posts per prior')
+    args = parser.parse_args(argv)
+
+    stats = brain.prune(min_count=args.min_count, min_prior_count=args.min_prior_count, max_posts=args.max_posts)
+    print('Priors: %s -> %s' % (stats['priors_before'], stats['priors_after']))
+    print('Posts: %s -> %s' % (stats['posts_before'], stats['posts_after']))
+    print('Size: %s -> %s bytes (%.1f%% smaller)' % (stats['bytes_before'], stats['bytes_after'],
+        100 * (1 - stats['bytes_after'] / max(stats['bytes_before'], 1))))
+    return stats
+
+if __name__ == '__main__':
+    main()
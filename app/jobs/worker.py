@@ -0,0 +1,196 @@
+# A long-running worker which runs the brain's jobs on intervals,
+# keeping the brain loaded in memory between runs
+# rather than starting up a fresh process for each (i.e. from cron).
+#
+#   $ python -m app.jobs.worker
+#   $ python -m app.jobs.worker --ponder 3600 --consider 600 --jitter 0.1
+#   $ python -m app.jobs.worker --prune 86400
+#   $ python -m app.jobs.worker --metrics-port 9101
+#
+# Stop it with SIGINT or SIGTERM; it finishes the job
+# it's on, if any, and checkpoints the brain before exiting.
+#
+# Metrics are kept per process, so the worker serves its own
+# (i.e. of pondering and training) at http://localhost:9101/metrics,
+# alongside the web app's /metrics.
+
+import argparse, random, signal, threading, time
+from collections import deque
+from app import brain, metrics
+
+# Logging
+from app.logger import logger
+logger = logger(__name__)
+
+# Default intervals (in seconds) for each job.
+PONDER_INTERVAL = 60 * 60
+CONSIDER_INTERVAL = 10 * 60
+CHECKPOINT_INTERVAL = 60 * 60
+
+# How much (as a fraction of their intervals)
+# to randomly stagger the jobs by.
+JITTER = 0.1
+
+# The port to serve the worker's metrics on.
+METRICS_PORT = 9101
+
+
+class Job():
+    """
+    A function to run every `interval` seconds,
+    give or take `jitter` (a fraction of the interval).
+    Keeps track of how long its runs take.
+    """
+
+    def __init__(self, name, func, interval, jitter=JITTER):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run = None
+
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.durations = deque(maxlen=100)
+
+    def schedule(self, now):
+        """
+        Schedules the next run, an interval (give or take) from `now`.
+        """
+        spread = self.interval * self.jitter
+        self.next_run = now + self.interval + random.uniform(-spread, spread)
+
+    def run(self):
+        """
+        Runs the job, logging rather than raising any errors,
+        so one bad run doesn't take the worker down.
+        """
+        logger.info('Running %s...' % self.name)
+        started = time.monotonic()
+        try:
+            self.func()
+        except Exception:
+            self.failures += 1
+            logger.exception('Job %s failed.' % self.name)
+            if metrics.ENABLED:
+                metrics.inc('brain_worker_job_failures_total', job=self.name)
+        finally:
+            duration = time.monotonic() - started
+            self.runs += 1
+            self.last_run = time.time()
+            self.durations.append(duration)
+            logger.info('Finished %s in %.2fs.' % (self.name, duration))
+            if metrics.ENABLED:
+                metrics.observe('brain_worker_job_seconds', duration, job=self.name)
+
+    def stats(self):
+        durations = list(self.durations)
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_run': self.last_run,
+            'last_duration': durations[-1] if durations else None,
+            'mean_duration': sum(durations) / len(durations) if durations else None,
+            'max_duration': max(durations) if durations else None
+        }
+
+
+class Worker():
+    """
+    Runs jobs on their intervals, one at a time,
+    until it's stopped.
+    """
+
+    def __init__(self, jobs, checkpoint=None):
+        """
+        jobs
+        The Jobs to run.
+
+        checkpoint
+        A function to call once the worker's stopped,
+        i.e. to persist anything still in memory.
+        """
+        self.jobs = jobs
+        self.checkpoint = checkpoint
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+        Runs the jobs until `stop()` is called.
+        The first runs are staggered over the jitter,
+        so the jobs don't all go off at once.
+        """
+        now = time.monotonic()
+        for job in self.jobs:
+            job.next_run = now + random.uniform(0, job.interval * job.jitter)
+
+        while not self._stopped.is_set():
+            job = min(self.jobs, key=lambda job: job.next_run)
+            wait = job.next_run - time.monotonic()
+            if wait > 0 and self._stopped.wait(wait):
+                break
+
+            job.run()
+            job.schedule(time.monotonic())
+
+        if self.checkpoint is not None:
+            logger.info('Checkpointing before stopping...')
+            self.checkpoint()
+        logger.info('Stopped.')
+
+    def stop(self, *args):
+        """
+        Stops the worker once it's done with its current job.
+        Takes (and ignores) args so it can be a signal handler.
+        """
+        logger.info('Stopping...')
+        self._stopped.set()
+
+    def stats(self):
+        """
+        Returns the stats (i.e. run durations) for each job.
+        """
+        return {job.name: job.stats() for job in self.jobs}
+
+
+def checkpoint():
+    """
+    Persists the brain's models,
+    folding their training logs into them.
+    """
+    brain.CLS.checkpoint()
+    brain.MKV.checkpoint()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the brain\'s jobs on intervals.')
+    parser.add_argument('--ponder', type=float, default=PONDER_INTERVAL, help='seconds between pondering')
+    parser.add_argument('--consider', type=float, default=CONSIDER_INTERVAL, help='seconds between considering')
+    parser.add_argument('--checkpoint', type=float, default=CHECKPOINT_INTERVAL, help='seconds between checkpoints')
+    parser.add_argument('--prune', type=float, help='seconds between pruning the Markov (off by default)')
+    parser.add_argument('--jitter', type=float, default=JITTER, help='fraction of the intervals to stagger jobs by')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='port to serve metrics on (0 for off)')
+    args = parser.parse_args(argv)
+
+    jobs = [
+        Job('ponder', brain.ponder, args.ponder, args.jitter),
+        Job('consider', brain.consider, args.consider, args.jitter),
+        Job('checkpoint', checkpoint, args.checkpoint, args.jitter)
+    ]
+    if args.prune:
+        jobs.append(Job('prune', brain.prune, args.prune, args.jitter))
+    worker = Worker(jobs, checkpoint=checkpoint)
+
+    if args.metrics_port and metrics.ENABLED:
+        metrics.serve(args.metrics_port)
+
+    brain.warm()
+    signal.signal(signal.SIGINT, worker.stop)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
+    return worker
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Metrics
+==============
+
+Counters and timings for the hot paths,
+exported in Prometheus' text format (see the `/metrics` route).
+
+Metrics are kept per process, so the web app's
+are separate from the worker's; the worker serves its own
+(see `serve()`), so scrape both.
+When disabled, recording a metric does nothing.
+"""
+
+import threading, time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Whether or not to record metrics.
+ENABLED = True
+
+# The content type of the rendered metrics.
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Upper bounds (in seconds) of the timing histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, float('inf'))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {}
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def describe(name, help):
+    """
+    Sets the help text for a metric.
+    """
+    _help[name] = help
+
+def inc(name, value=1, **labels):
+    """
+    Increments a counter.
+    """
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """
+    Records a timing.
+    """
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Times a block, i.e.
+
+        with metrics.timed('brain_markov_generate_seconds'):
+            ...
+    """
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def render():
+    """
+    Renders the metrics in Prometheus' text format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _histograms.items()}
+
+    lines = []
+    for name in sorted(set(name for name, labels in counters)):
+        lines += _header(name, 'counter')
+        for (name_, labels), value in sorted(counters.items()):
+            if name_ == name:
+                lines.append('%s%s %s' % (name, _format(labels), _number(value)))
+
+    for name in sorted(set(name for name, labels in histograms)):
+        lines += _header(name, 'histogram')
+        for (name_, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name_ != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %s' % (name, _format(labels + (('le', le),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, _format(labels), _number(total)))
+            lines.append('%s_count%s %s' % (name, _format(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+def serve(port, host=''):
+    """
+    Serves the metrics at '/metrics' over HTTP, on a background thread,
+    for processes other than the web app (i.e. the worker).
+    Returns the server, which can be `shutdown()`.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def reset():
+    """
+    Clears all the metrics.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+def _header(name, type):
+    lines = []
+    if name in _help:
+        lines.append('# HELP %s %s' % (name, _help[name]))
+    lines.append('# TYPE %s %s' % (name, type))
+    return lines
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log.
+        pass
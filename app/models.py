@@ -22,6 +22,10 @@ class Muse(db.Document):
     username = db.StringField(required=True, unique=True, max_length=50)
     negative = db.BooleanField(default=False)
 
+    # The id of the newest tweet fetched for this muse,
+    # so only newer tweets are fetched next time.
+    last_tid = db.IntField()
+
     meta = {
             'allow_inheritance': True,
             'indexes': ['-created_at', 'username'],
@@ -52,12 +56,27 @@ class Config(db.Document):
     # The lower this is, the less the brain will tweet.
     chance_to_act = db.FloatField(required=True, default=0.05)
 
+    # How many candidate tweets to generate when tweeting,
+    # the best of which (according to the classifier) is tweeted...
+    candidates = db.IntField(required=True, default=50)
+
+    # ...if its probability of being positive is at least this.
+    tweet_threshold = db.FloatField(required=True, default=0.5)
+
     # Maximum amount of retweets in an interval.
     # Cause sometimes it accidentally retweets a TON of stuff.
     max_retweets = db.IntField(required=True, default=10)
 
     # Some brain configuration.
     ngram_size = db.IntField(required=True, default=1)
+
+    # If set, ngrams of every size up to this are counted,
+    # so generation can back off to shorter ones,
+    # and the ngram size can be changed (up to this) without retraining.
+    # Costs roughly this many times the knowledge.
+    # Unset, only `ngram_size` is counted, as before this was added.
+    # Changing this requires retraining.
+    max_order = db.IntField()
     ramble = db.BooleanField(default=True)
     spasm = db.FloatField(required=True, default=0.05)
 
@@ -1,8 +1,9 @@
-from flask import Blueprint, render_template, redirect, request, url_for, jsonify, flash
+from flask import Blueprint, render_template, redirect, request, url_for, jsonify, flash, Response
 from flask.views import MethodView
 from flask.ext.mongoengine.wtf import model_form
-from app import app, brain, db
+from app import app, brain, db, metrics
 from app.models import Muse, Tweet, Config, Doc
+from app.config import invalidate as invalidate_config
 from app.auth import requires_auth
 from app.forms import TweetingForm
 
@@ -14,11 +15,11 @@ logger = logger(__name__)
 @app.route('/')
 @app.route('/index')
 def index():
-    return render_template('index.html', speech=brain.MKV.generate())
+    return render_template('index.html', speech=brain.SPEECH.pop())
 
 @app.route('/generate')
 def generate():
-    return render_template('generate.html', speech=brain.MKV.generate())
+    return render_template('generate.html', speech=brain.SPEECH.pop())
 
 @app.route('/generate_', methods=['GET', 'POST'])
 @requires_auth
@@ -28,12 +29,16 @@ def generate_():
         flash('Tweet twoot')
         brain.twitter.tweet(form.tweet.data)
         return redirect('/generate_')
-    return render_template('generate_.html', form=form, speech=brain.MKV.generate())
+    return render_template('generate_.html', form=form, speech=brain.SPEECH.pop())
 
 @app.route('/status')
 def status():
     return render_template('status.html', tweets=Tweet.objects.count(), docs=Doc.objects.count(), muses=Muse.objects.count())
 
+@app.route('/metrics')
+def metrics_():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.errorhandler(404)
 def internal_error(error):
     return render_template('404.html'), 404
@@ -119,6 +124,8 @@ class ConfigAPI(MethodView):
         form = self.form(request.form, obj=config)
 
         if form.validate():
+            # The ngram sizes as they were saved, before the form's are.
+            ngram_size, max_order = config.ngram_size, config.max_order
             form.populate_obj(config)
 
             # Need to reload the brain.
@@ -126,16 +133,33 @@ class ConfigAPI(MethodView):
                 logger.info('Brain config value changed!')
                 brain.MKV.ramble = form.ramble.data
                 brain.MKV.spasm = form.spasm.data
+                brain.SPEECH.invalidate()
 
-            # If the ngram size has changed,
+            # If the max order has changed, or the ngram size has
+            # changed to one the knowledge doesn't count,
             # the brain needs to be retrained.
-            if form.ngram_size.data != brain.MKV.n:
-                logger.info('Brain ngram size changed! Retraining...')
+            # Saving the config without changing either never retrains it.
+            retrain = form.max_order.data != max_order or \
+                (form.ngram_size.data != ngram_size and not brain.MKV.knows_orders(form.ngram_size.data, form.max_order.data))
+
+            # Otherwise if the ngram size has changed,
+            # it's one which is already counted, so the brain can just switch to it.
+            if not retrain and form.ngram_size.data != brain.MKV.n:
+                logger.info('Brain ngram size changed!')
                 brain.MKV.n = form.ngram_size.data
-                brain.retrain()
+                brain.SPEECH.invalidate()
 
             config.save()
-            flash('I will change my ways.')
+            invalidate_config()
+
+            # The retrained brain is configured from the saved config,
+            # and swapped in once it's done.
+            if retrain:
+                logger.info('Brain ngram sizes changed! Retraining...')
+                task = brain.retrain_async()
+                flash('I will change my ways, once I\'m retrained. See %s for how that\'s going.' % url_for('retrain_api', id=task.id))
+            else:
+                flash('I will change my ways.')
             return redirect(url_for('config_api'))
 
         return redirect(url_for('config_api'))
@@ -143,6 +167,22 @@ config_api = ConfigAPI.as_view('config_api')
 app.add_url_rule('/config/', view_func=config_api, methods=['GET', 'POST'])
 
 
+class RetrainAPI(MethodView):
+    def get(self, id):
+        task = brain.TASKS.get(id)
+        if task is None:
+            return jsonify({'success':False, 'error':'No such retraining.'}), 404
+        return jsonify(task.stats())
+
+    @requires_auth
+    def post(self, id=None):
+        task = brain.retrain_async()
+        return jsonify(dict(task.stats(), progress=url_for('retrain_api', id=task.id))), 202
+retrain_api = RetrainAPI.as_view('retrain_api')
+app.add_url_rule('/retrain/', view_func=retrain_api, methods=['POST'])
+app.add_url_rule('/retrain/<string:id>', view_func=retrain_api, methods=['GET'])
+
+
 class DocAPI(MethodView):
     form = model_form(Doc, exclude=['created_at'])
 
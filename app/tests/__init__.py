@@ -8,8 +8,13 @@ class RequiresMocks(unittest.TestCase):
 
         Args:
             | name (str)       -- the 'module.package.method' to mock.
+
+        It's autospecced, unless a mock to patch it with is given as `new`
+        (i.e. for things which would have to be loaded to autospec).
         """
-        patcher = patch(name, autospec=True, **kwargs)
+        if 'new' not in kwargs:
+            kwargs['autospec'] = True
+        patcher = patch(name, **kwargs)
         thing = patcher.start()
         self.addCleanup(patcher.stop)
         return thing
@@ -1,13 +1,20 @@
-import unittest
-from unittest.mock import MagicMock
+import unittest, os, threading, time
+from unittest.mock import MagicMock, patch
 from app import brain
+from app.brain import lazy
+from app.brain.lazy import Lazy
+from app.brain.markov import Markov
+from app.brain.classifier import Classifier
+from app.brain.tasks import Tasks
 from . import RequiresMocks
+from .fakes import FakeTwitter, FakeCollection, FakeTweet, faux_tweet
 
 class BrainTest(RequiresMocks):
     def setUp(self):
         self.mock_twitter = self.create_patch('app.brain.twitter')
         self.mock_Tweet = self.create_patch('app.brain.Tweet')
-        self.mock_CLS = self.create_patch('app.brain.CLS')
+        self.mock_CLS = self.create_patch('app.brain.CLS', new=MagicMock(spec=Classifier))
+        self.mock_CLS.positive.return_value = 1
 
         # Mock the app config.
         self.faux_config = MagicMock()
@@ -29,6 +36,7 @@ class BrainTest(RequiresMocks):
     def test_process_muse_creates_Tweets(self):
         muse = MagicMock(name='muse')
         muse.username = 'foo'
+        muse.last_tid = None
         self.mock_twitter.tweets.return_value = self.faux_tweets
 
         brain._process_muse(muse)
@@ -45,6 +53,12 @@ class BrainTest(RequiresMocks):
         brain._consider_retweets(self.faux_tweets)
         self.assertFalse(self.mock_twitter.retweet.called)
 
+    def test_consider_retweets_no_positive_class_does_not_retweet(self):
+        self.mock_CLS.positive.return_value = None
+        self.mock_CLS.classify.return_value = [[1.0]]
+        brain._consider_retweets(self.faux_tweets)
+        self.assertFalse(self.mock_twitter.retweet.called)
+
     def test_consider_retweets_max_retweets_does_not_retweet(self):
         self.faux_config.max_retweets = 0
         self.mock_CLS.classify.return_value = [[0,1]]
@@ -64,5 +78,354 @@ class BrainTest(RequiresMocks):
         self.assertFalse(self.mock_twitter.retweet.called)
 
 
+class ConsiderTest(RequiresMocks):
+    def setUp(self):
+        self.mock_twitter = self.create_patch('app.brain.twitter')
+        self.mock_CLS = self.create_patch('app.brain.CLS', new=MagicMock(spec=Classifier))
+        self.mock_CLS.positive.return_value = 1
+        self.mock_MKV = self.create_patch('app.brain.MKV', new=MagicMock(spec=Markov))
+        self.mock_random = self.create_patch('app.brain.random')
+        self.mock_random.random.return_value = 0
+
+        self.faux_config = MagicMock()
+        self.faux_config.chance_to_act = 0.5
+        self.faux_config.candidates = 3
+        self.faux_config.tweet_threshold = 0.5
+        self.mock_config = self.create_patch('app.brain.config')
+        self.mock_config.return_value = self.faux_config
+
+        self.mock_MKV.generate_many.return_value = ['meh', 'great', 'bad']
+
+    def test_consider_tweets_best_candidate(self):
+        self.mock_CLS.classify.return_value = [[0.6, 0.4], [0.1, 0.9], [0.9, 0.1]]
+        brain.consider()
+        self.mock_twitter.tweet.assert_called_with('great')
+
+    def test_consider_classifies_candidates_at_once(self):
+        self.mock_CLS.classify.return_value = [[0.6, 0.4], [0.1, 0.9], [0.9, 0.1]]
+        brain.consider()
+        self.mock_MKV.generate_many.assert_called_with(3)
+        self.assertEqual(self.mock_CLS.classify.call_count, 1)
+        self.mock_CLS.classify.assert_called_with(['meh', 'great', 'bad'], ids=['meh', 'great', 'bad'])
+
+    def test_consider_below_threshold_does_not_tweet(self):
+        self.mock_CLS.classify.return_value = [[0.6, 0.4], [0.7, 0.3], [0.9, 0.1]]
+        brain.consider()
+        self.assertFalse(self.mock_twitter.tweet.called)
+
+    def test_consider_untrained_classifier_tweets_first_candidate(self):
+        self.mock_CLS.classify.return_value = []
+        brain.consider()
+        self.mock_twitter.tweet.assert_called_with('meh')
+
+    def test_consider_positive_class_column(self):
+        # The positive class's probabilities come first.
+        self.mock_CLS.positive.return_value = 0
+        self.mock_CLS.classify.return_value = [[0.6, 0.4], [0.1, 0.9], [0.9, 0.1]]
+        brain.consider()
+        self.mock_twitter.tweet.assert_called_with('bad')
+
+    def test_consider_no_positive_class_tweets_first_candidate(self):
+        self.mock_CLS.positive.return_value = None
+        self.mock_CLS.classify.return_value = [[1.0], [1.0], [1.0]]
+        brain.consider()
+        self.mock_twitter.tweet.assert_called_with('meh')
+
+    def test_consider_skips_duplicate_and_empty_candidates(self):
+        self.mock_MKV.generate_many.return_value = ['meh', '', 'meh', 'great']
+        self.mock_CLS.classify.return_value = [[0.6, 0.4], [0.1, 0.9]]
+        brain.consider()
+        self.mock_CLS.classify.assert_called_with(['meh', 'great'], ids=['meh', 'great'])
+        self.mock_twitter.tweet.assert_called_with('great')
+
+    def test_consider_does_not_act(self):
+        self.mock_random.random.return_value = 0.9
+        brain.consider()
+        self.assertFalse(self.mock_MKV.generate_many.called)
+        self.assertFalse(self.mock_twitter.tweet.called)
+
+
+
+class PonderTest(unittest.TestCase):
+    def setUp(self):
+        self.muses = []
+        for username in ['foo', 'bar', 'baz', 'qux']:
+            muse = MagicMock(name=username)
+            muse.username = username
+            muse.negative = False
+            muse.last_tid = None
+            self.muses.append(muse)
+
+        self.timelines = {muse.username: [faux_tweet(i + 10 * j) for i in range(3)] for j, muse in enumerate(self.muses)}
+
+    def test_fetch_muses(self):
+        fake = FakeTwitter(self.timelines)
+        with patch('app.brain.twitter', new=fake):
+            fetched = brain._fetch_muses(self.muses)
+        self.assertEqual(fetched, [self.timelines[muse.username] for muse in self.muses])
+
+    def test_fetch_muses_concurrently(self):
+        fake = FakeTwitter(self.timelines, latency=0.2)
+        with patch('app.brain.twitter', new=fake):
+            started = time.time()
+            brain._fetch_muses(self.muses, concurrency=4)
+            self.assertLess(time.time() - started, 0.6)
+        self.assertEqual(sorted(fake.requests), sorted(self.timelines))
+
+    def test_fetch_muses_failure(self):
+        fake = FakeTwitter(self.timelines, failing=['bar'])
+        with patch('app.brain.twitter', new=fake):
+            fetched = brain._fetch_muses(self.muses)
+        self.assertEqual(fetched[1], [])
+        self.assertEqual(fetched[0], self.timelines['foo'])
+
+    def test_fetch_muses_timeout(self):
+        # Fetches underway when it times out are finished,
+        # but those not started yet are dropped.
+        fake = FakeTwitter(self.timelines, latency=0.3)
+        with patch('app.brain.twitter', new=fake):
+            fetched = brain._fetch_muses(self.muses, concurrency=2, timeout=0.1)
+        self.assertEqual(len(fake.requests), 2)
+        self.assertEqual(sorted(muse.username for muse, tweets in zip(self.muses, fetched) if tweets), sorted(fake.requests))
+
+    def test_fetch_muses_overall_timeout(self):
+        # One at a time, each well within the timeout,
+        # but not all of them together.
+        fake = FakeTwitter(self.timelines, latency=0.15)
+        with patch('app.brain.twitter', new=fake):
+            started = time.time()
+            fetched = brain._fetch_muses(self.muses, concurrency=1, timeout=0.4)
+            self.assertLess(time.time() - started, 0.55)
+        self.assertEqual(len(fake.requests), 3)
+        self.assertEqual(sum(1 for tweets in fetched if not tweets), 1)
+
+    def test_fetch_muses_rate_limited(self):
+        # Waiting on the rate limit doesn't count towards the timeout.
+        fake = FakeTwitter(self.timelines, latency=0.15, rate_limited=True)
+        with patch('app.brain.twitter', new=fake):
+            fetched = brain._fetch_muses(self.muses, concurrency=1, timeout=0.2)
+        self.assertEqual(fetched, [self.timelines[muse.username] for muse in self.muses])
+
+    def test_fetch_muses_order(self):
+        # The same Muses don't always go last.
+        fake = FakeTwitter(self.timelines)
+        with patch('app.brain.twitter', new=fake):
+            for i in range(10):
+                brain._fetch_muses(self.muses, concurrency=1)
+        firsts = set(fake.requests[i * 4] for i in range(10))
+        self.assertGreater(len(firsts), 1)
+
+    def test_fetch_muse_since_last_tid(self):
+        muse = self.muses[0]
+        muse.last_tid = 1
+        fake = FakeTwitter(self.timelines)
+        with patch('app.brain.twitter', new=fake):
+            fetched = brain._fetch_muse(muse)
+        self.assertEqual(fetched, [faux_tweet(2)])
+
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.muse = MagicMock(name='muse')
+        self.muse.username = 'foo'
+        self.muse.last_tid = None
+        self.tweets = [faux_tweet(i) for i in range(5)]
+
+        self.collection = FakeCollection()
+        FakeTweet.collection = self.collection
+        patcher = patch('app.brain.Tweet', new=FakeTweet)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_save_tweets(self):
+        new_tweets = brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual(new_tweets, self.tweets)
+        self.assertEqual([doc['tid'] for doc in self.collection.docs], [0, 1, 2, 3, 4])
+        self.assertEqual(self.collection.docs[0]['username'], 'foo')
+
+    def test_save_tweets_round_trips(self):
+        round_trips = brain.INGEST_STATS['round_trips']
+        brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual(self.collection.finds, 1)
+        self.assertEqual(self.collection.inserts, 1)
+        self.assertEqual(brain.INGEST_STATS['round_trips'] - round_trips, 2)
+
+    def test_save_tweets_skips_existing(self):
+        self.collection.add({'_id': 'a', 'tid': 1, 'body': 'something else'})
+        self.collection.add({'_id': 'b', 'tid': 100, 'body': self.tweets[3]['body']})
+        new_tweets = brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual([tweet['tid'] for tweet in new_tweets], [0, 2, 4])
+
+    def test_save_tweets_skips_repeats(self):
+        tweets = self.tweets + [faux_tweet(2), faux_tweet(10, body=self.tweets[0]['body'])]
+        new_tweets = brain._save_tweets(self.muse, tweets)
+        self.assertEqual(new_tweets, self.tweets)
+        self.assertEqual(len(self.collection.docs), 5)
+
+    def test_save_tweets_skips_invalid(self):
+        tweets = self.tweets + [faux_tweet(10)]
+        tweets[-1]['body'] = ''
+        new_tweets = brain._save_tweets(self.muse, tweets)
+        self.assertEqual(new_tweets, self.tweets)
+        self.assertEqual([doc['tid'] for doc in self.collection.docs], [0, 1, 2, 3, 4])
+
+    def test_save_tweets_all_existing(self):
+        brain._save_tweets(self.muse, self.tweets)
+        new_tweets = brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual(new_tweets, [])
+        self.assertEqual(self.collection.inserts, 1)
+
+    def test_save_tweets_race(self):
+        # Another process saves a tweet between the check and the insert.
+        find = self.collection.find
+        def racing_find(spec, fields=None):
+            found = find(spec, fields)
+            if self.collection.finds == 1:
+                self.collection.add({'_id': 'a', 'tid': 2, 'body': 'tweet number 2'})
+            return found
+        self.collection.find = racing_find
+
+        new_tweets = brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual([tweet['tid'] for tweet in new_tweets], [0, 1, 3, 4])
+        self.assertEqual(len(self.collection.docs), 5)
+
+    def test_save_tweets_empty(self):
+        self.assertEqual(brain._save_tweets(self.muse, []), [])
+        self.assertEqual(self.collection.finds, 0)
+        self.assertIsNone(self.muse.last_tid)
+        self.assertFalse(self.muse.save.called)
+
+    def test_save_tweets_advances_last_tid(self):
+        brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual(self.muse.last_tid, 4)
+        self.assertTrue(self.muse.save.called)
+
+        # Duplicates still count as fetched.
+        brain._save_tweets(self.muse, self.tweets + [faux_tweet(7)])
+        self.assertEqual(self.muse.last_tid, 7)
+
+    def test_save_tweets_last_tid_does_not_go_back(self):
+        self.muse.last_tid = 100
+        brain._save_tweets(self.muse, self.tweets)
+        self.assertEqual(self.muse.last_tid, 100)
+        self.assertFalse(self.muse.save.called)
+
+
+class RetrainTest(unittest.TestCase):
+    def setUp(self):
+        self.tweets = ['hey this is a test', 'this is only a test']
+        self.docs = ['hey this is not a drill']
+        self.Tweet = MagicMock()
+        self.Tweet.objects.count.return_value = len(self.tweets)
+        self.Doc = MagicMock()
+        self.Doc.objects.count.return_value = len(self.docs)
+        self.corpus = MagicMock()
+        self.corpus.queryset.side_effect = lambda qs: iter(self.tweets if qs is self.Tweet.objects else self.docs)
+
+        self.old = Markov(ngram_size=1, filepath='app/tests/markov.pickle', spasm=0.0)
+        self.old.train(['something else entirely'])
+        self.MKV = Lazy('markov', lambda: self.old)
+        self.SPEECH = MagicMock()
+        config = MagicMock(ramble=True, ngram_size=2, max_order=None, spasm=0.0)
+
+        patches = [
+            patch('app.brain.Tweet', new=self.Tweet),
+            patch('app.brain.Doc', new=self.Doc),
+            patch('app.brain.corpus', new=self.corpus),
+            patch('app.brain.config', new=lambda: config),
+            patch('app.brain.cpu_count', new=lambda: 1),
+            patch('app.brain.markov.FILEPATH', new='app/tests/markov.pickle'),
+            patch('app.brain.MKV', new=self.MKV),
+            patch('app.brain.SPEECH', new=self.SPEECH),
+            patch('app.brain.TASKS', new=Tasks())
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for name in ['markov', 'markov.retrain', 'markov_expected']:
+            for ext in ['.pickle', '.mkv', '.log', '.log.seq']:
+                if os.path.exists('app/tests/%s%s' % (name, ext)):
+                    os.remove('app/tests/%s%s' % (name, ext))
+
+    def test_retrain_swaps_in_fresh_markov(self):
+        progress = MagicMock()
+        brain.retrain(progress=progress)
+
+        markov = lazy.load(self.MKV)
+        self.assertIsNot(markov, self.old)
+        self.assertEqual(markov.n, 2)
+        progress.assert_called_with(3, 3)
+        self.assertTrue(self.SPEECH.invalidate.called)
+
+        expected = Markov(ngram_size=2, filepath='app/tests/markov_expected.pickle')
+        expected.train(self.tweets + self.docs)
+        self.assertEqual(markov.knowledge, expected.knowledge)
+
+        # It's saved where the old one was.
+        self.assertEqual(Markov(ngram_size=2, filepath='app/tests/markov.pickle').knowledge, expected.knowledge)
+
+    def test_retrain_async_generates_meanwhile(self):
+        release = threading.Event()
+        def queryset(qs):
+            release.wait(5)
+            return iter(self.tweets if qs is self.Tweet.objects else self.docs)
+        self.corpus.queryset.side_effect = queryset
+
+        task = brain.retrain_async()
+        self.assertIs(brain.retrain_async(), task)
+        self.assertIs(lazy.load(self.MKV), self.old)
+        self.assertEqual(self.MKV.generate(), 'something else entirely')
+
+        release.set()
+        self.assertTrue(task.join(5))
+        self.assertEqual(task.status, 'done')
+        self.assertEqual((task.done, task.total), (3, 3))
+        self.assertIsNot(lazy.load(self.MKV), self.old)
+
+    def test_retrain_keeps_training_meanwhile(self):
+        # Counting the same ngram sizes as the retrained brain will.
+        self.old.n = 2
+        self.old.reset()
+        self.old.train(['something else entirely'])
+
+        # i.e. the worker, which checkpoints in the meantime too.
+        other = Markov(ngram_size=2, filepath='app/tests/markov.pickle')
+        def queryset(qs):
+            if qs is self.Doc.objects:
+                other.train(['hey this is new'])
+                other.checkpoint()
+            return iter(self.tweets if qs is self.Tweet.objects else self.docs)
+        self.corpus.queryset.side_effect = queryset
+        brain.retrain()
+
+        expected = Markov(ngram_size=2, filepath='app/tests/markov_expected.pickle')
+        expected.train(self.tweets + self.docs + ['hey this is new'])
+        self.assertEqual(self.MKV.knowledge, expected.knowledge)
+        self.assertEqual(Markov(ngram_size=2, filepath='app/tests/markov.pickle').knowledge, expected.knowledge)
+
+    def test_retrain_keeps_ngram_sizes(self):
+        # Training logged meanwhile counts the old ngram sizes,
+        # which aren't mixed in with the new ones.
+        other = Markov(ngram_size=2, filepath='app/tests/markov.pickle')
+        def queryset(qs):
+            if qs is self.Doc.objects:
+                other.train(['hey this is new'])
+            return iter(self.tweets if qs is self.Tweet.objects else self.docs)
+        self.corpus.queryset.side_effect = queryset
+        brain.retrain()
+
+        self.assertEqual(self.MKV.counted_orders, (2,))
+        self.assertEqual(set(len(prior) for prior in self.MKV.knowledge if prior), {2})
+        self.assertTrue(self.MKV.knows_orders(2))
+
+    def test_prune(self):
+        stats = brain.prune(min_count=2)
+        self.assertEqual(stats['posts_before'], 4)
+        self.assertEqual(self.MKV.knowledge[()], {('something',): 1})
+        self.assertTrue(self.SPEECH.invalidate.called)
+
+
 if __name__ == '__main__':
     unittest.main()
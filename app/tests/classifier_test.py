@@ -1,5 +1,8 @@
-import unittest, os
-from app.brain.classifier import Classifier
+import unittest, os, pickle
+import numpy as np
+from unittest.mock import patch
+from sklearn.feature_extraction.text import TfidfTransformer
+from app.brain.classifier import Classifier, RunningTfidf
 
 pos_docs = [
         'dog bar',
@@ -21,17 +24,20 @@ docs = pos_docs + neg_docs
 labels = [1 for i in range(len(pos_docs))] + [0 for i in range(len(neg_docs))]
 
 test_filepath = 'app/tests/classifier.pickle'
+test_log_filepath = 'app/tests/classifier.log'
+test_seq_filepath = 'app/tests/classifier.log.seq'
 
 class ClassifierTest(unittest.TestCase):
     def setUp(self):
         self.clf = Classifier(filepath=test_filepath)
 
     def tearDown(self):
-        # Clean up test pickle.
-        try:
-            os.remove(test_filepath)
-        except FileNotFoundError:
-            pass
+        # Clean up test files.
+        for filepath in [test_filepath, test_log_filepath, test_seq_filepath]:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
 
     def test_train(self):
         self.clf.train(docs, labels, save=False)
@@ -47,10 +53,124 @@ class ClassifierTest(unittest.TestCase):
         probs = self.clf.classify(['foo dog bar'])[0]
         self.assertEqual(1, round(probs[1]))
 
+    def test_positive(self):
+        self.assertIsNone(self.clf.positive())
+        self.clf.train(docs, labels, save=False)
+        self.assertEqual(self.clf.positive(), 1)
+
     def test_save_and_load(self):
         self.clf.train(docs, labels, save=True)
         clf = self.clf.load()
         self.assertEqual(list(clf.class_count_), [3.0, 3.0])
 
+    def test_checkpoint(self):
+        self.clf.train(docs, labels, save=True)
+        self.clf.checkpoint()
+        self.clf.train(new_docs, [1,1,1], save=True)
+        clf = self.clf.load()
+        self.assertEqual(list(clf.class_count_), [3.0, 6.0])
+
+    def test_checkpoint_interrupted(self):
+        # i.e. the process died after saving, before truncating the log.
+        self.clf.train(docs, labels, save=True)
+        self.clf.save()
+        clf = self.clf.load()
+        self.assertEqual(list(clf.class_count_), [3.0, 3.0])
+
+    def test_running_idf(self):
+        clf = Classifier(filepath=test_filepath, running_idf=True)
+        clf.train(docs, labels, save=False)
+        clf.train(new_docs, [1,1,1], save=False)
+        self.assertEqual(clf.tfidf.n_docs, 9)
+        self.assertEqual(list(clf.clf.class_count_), [3.0, 6.0])
+
+        probs = clf.classify(['foo dog bar'])[0]
+        self.assertEqual(1, round(probs[1]))
+
+    def test_running_idf_save_and_load(self):
+        clf = Classifier(filepath=test_filepath, running_idf=True)
+        clf.train(docs, labels)
+        clf.checkpoint()
+        clf.train(new_docs, [1,1,1])
+
+        clf_ = Classifier(filepath=test_filepath, running_idf=True)
+        self.assertEqual(clf_.tfidf.n_docs, 9)
+        self.assertEqual(list(clf_.clf.class_count_), [3.0, 6.0])
+        self.assertEqual(list(clf_.classify(['foo dog bar'])[0]), list(clf.classify(['foo dog bar'])[0]))
+
+    def test_running_idf_loads_weighted_log(self):
+        # Training logged without running idf is already weighted,
+        # so it's learned as is, without counting towards the idf.
+        self.clf.train(docs, labels)
+
+        clf = Classifier(filepath=test_filepath, running_idf=True)
+        self.assertEqual(clf.tfidf.n_docs, 0)
+        self.assertEqual(list(clf.clf.class_count_), [3.0, 3.0])
+        self.assertTrue(np.array_equal(clf.clf.feature_count_, self.clf.clf.feature_count_))
+
+    def test_loads_running_idf_log(self):
+        clf = Classifier(filepath=test_filepath, running_idf=True)
+        clf.train(docs, labels)
+
+        # Without running idf, the logged counts are weighted on their own,
+        # the same as if they'd been trained on without it.
+        clf_ = Classifier(filepath=test_filepath)
+        self.clf.train(docs, labels, save=False)
+        self.assertEqual(list(clf_.clf.class_count_), [3.0, 3.0])
+        self.assertTrue(np.allclose(clf_.clf.feature_count_, self.clf.clf.feature_count_))
+
+    def test_cached_vectors(self):
+        ids = list(range(len(docs)))
+        self.clf.train(docs, labels, save=False, ids=ids)
+        with patch.object(self.clf.hasher, 'transform', wraps=self.clf.hasher.transform) as transform:
+            probs = self.clf.classify(docs[:2], ids=ids[:2])
+            self.assertFalse(transform.called)
+        self.assertEqual(list(probs[0]), list(self.clf.classify(docs[:2])[0]))
+
+
+    def test_cached_vectors_full(self):
+        clf = Classifier(filepath=test_filepath, max_cached=3)
+        clf.train(docs[:3], [1,1,1], save=False, ids=[1,2,3])
+
+        # 1 is the oldest cached, and has to make way for 4.
+        probs = clf.classify([docs[0], docs[3]], ids=[1,4])
+        self.assertEqual([list(p) for p in probs], [list(p) for p in clf.classify([docs[0], docs[3]])])
+        self.assertEqual(list(clf._cache), [3, 1, 4])
+
+    def test_cached_vectors_batch_bigger_than_cache(self):
+        clf = Classifier(filepath=test_filepath, max_cached=2)
+        clf.train(docs, labels, save=False, ids=list(range(len(docs))))
+        self.assertEqual(list(clf.clf.class_count_), [3.0, 3.0])
+        self.assertEqual(list(clf._cache), [4, 5])
+
+
+class RunningTfidfTest(unittest.TestCase):
+    def setUp(self):
+        self.hasher = Classifier(filepath=test_filepath).hasher
+        self.counts = self.hasher.transform(docs + new_docs)
+
+    def test_matches_tfidf_transformer(self):
+        tfidf = RunningTfidf(self.hasher.n_features)
+        tfidf.partial_fit(self.counts[:6])
+        tfidf.partial_fit(self.counts[6:])
+        expected = TfidfTransformer().fit_transform(self.counts)
+        self.assertAlmostEqual(abs(tfidf.transform(self.counts) - expected).max(), 0)
+
+    def test_idf_is_updated(self):
+        tfidf = RunningTfidf(self.hasher.n_features)
+        tfidf.partial_fit(self.counts[:6])
+        before = tfidf.transform(self.counts[6:])
+        tfidf.partial_fit(self.counts[6:])
+        self.assertNotAlmostEqual(abs(tfidf.transform(self.counts[6:]) - before).max(), 0)
+
+    def test_idf_is_not_pickled(self):
+        tfidf = RunningTfidf(self.hasher.n_features)
+        tfidf.partial_fit(self.counts)
+        expected = tfidf.transform(self.counts)
+        tfidf_ = pickle.loads(pickle.dumps(tfidf))
+        self.assertIsNone(tfidf_._idf)
+        self.assertAlmostEqual(abs(tfidf_.transform(self.counts) - expected).max(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from app import config
+from . import RequiresMocks
+
+class ConfigTest(RequiresMocks):
+    def setUp(self):
+        self.objects = MagicMock()
+        self.objects.__getitem__.side_effect = lambda i: MagicMock(name='config')
+        self.mock_Config = self.create_patch('app.config.Config')
+        self.mock_Config.objects = self.objects
+
+        self.now = 1000
+        patcher = patch('app.config.monotonic', new=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        config.invalidate()
+        self.addCleanup(config.invalidate)
+
+    def test_config_is_cached(self):
+        first = config.config()
+        for i in range(10):
+            self.assertIs(config.config(), first)
+        self.assertEqual(self.objects.__getitem__.call_count, 1)
+
+    def test_config_expires(self):
+        first = config.config()
+        self.now += config.TTL - 1
+        self.assertIs(config.config(), first)
+
+        self.now += 2
+        self.assertIsNot(config.config(), first)
+        self.assertEqual(self.objects.__getitem__.call_count, 2)
+
+    def test_invalidate(self):
+        first = config.config()
+        config.invalidate()
+        self.assertIsNot(config.config(), first)
+        self.assertEqual(self.objects.__getitem__.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
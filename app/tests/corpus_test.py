@@ -0,0 +1,58 @@
+import unittest, os, json
+from unittest.mock import MagicMock
+from app.brain import corpus
+
+test_filepath = 'app/tests/corpus'
+docs = ['hey this is a test', 'foo "bar" [baz]', 'ünïcode, commas, 123']
+
+class CorpusTest(unittest.TestCase):
+    def tearDown(self):
+        for ext in ['.txt', '.json', '.jsonl']:
+            try:
+                os.remove(test_filepath + ext)
+            except FileNotFoundError:
+                pass
+
+    def write(self, ext, content):
+        with open(test_filepath + ext, 'w') as file:
+            file.write(content)
+        return test_filepath + ext
+
+    def test_lines(self):
+        filepath = self.write('.txt', '\n'.join(docs) + '\n\n')
+        self.assertEqual(list(corpus.read(filepath)), docs)
+
+    def test_jsonl(self):
+        filepath = self.write('.jsonl', '\n'.join(json.dumps({'text': doc}) for doc in docs))
+        self.assertEqual(list(corpus.read(filepath, field='text')), docs)
+
+    def test_json_array(self):
+        filepath = self.write('.json', json.dumps([{'text': doc} for doc in docs], indent=2))
+        self.assertEqual(list(corpus.read(filepath, field='text')), docs)
+
+    def test_json_array_small_chunks(self):
+        items = docs + [123, 4567]
+        filepath = self.write('.json', '  ' + json.dumps(items))
+        for chunk_size in [1, 2, 3, 7]:
+            self.assertEqual(list(corpus.json_array(filepath, chunk_size=chunk_size)), items)
+
+    def test_json_array_split_numbers(self):
+        # Numbers which still decode when cut off.
+        items = [1.5, -12e3, {'text': [10, 200]}, 3000]
+        filepath = self.write('.json', json.dumps(items, indent=1))
+        for chunk_size in [1, 2, 3, 4]:
+            self.assertEqual(list(corpus.json_array(filepath, chunk_size=chunk_size)), items)
+
+    def test_json_array_empty(self):
+        filepath = self.write('.json', ' [ ] ')
+        self.assertEqual(list(corpus.read(filepath)), [])
+
+    def test_queryset(self):
+        qs = MagicMock()
+        qs.no_cache().only().batch_size.return_value = [MagicMock(body=doc) for doc in docs]
+        self.assertEqual(list(corpus.queryset(qs, batch_size=2)), docs)
+        qs.no_cache().only.assert_called_with('body')
+        qs.no_cache().only().batch_size.assert_called_with(2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+import threading, time, itertools
+from unittest.mock import MagicMock
+from tweepy.error import TweepError
+from pymongo.errors import DuplicateKeyError
+from mongoengine.errors import ValidationError
+
+class FakeTwitter():
+    """
+    A stand-in for the `app.brain.twitter` module,
+    which serves canned timelines instead of hitting Twitter.
+    """
+    TweepError = TweepError
+
+    def __init__(self, timelines=None, latency=0, failing=(), rate_limited=False):
+        """
+        timelines
+        A dict of {username: [tweet, ...]}.
+
+        latency
+        How long (in seconds) each timeline request takes.
+        Either a number or a dict of {username: latency}.
+
+        failing
+        Usernames whose timeline requests raise a TweepError.
+
+        rate_limited
+        Whether the latency is spent waiting on the rate limit,
+        rather than on Twitter.
+        """
+        self.timelines = timelines or {}
+        self.latency = latency
+        self.failing = set(failing)
+        self.rate_limited = rate_limited
+        self._limited = 0
+
+        self.requests = []
+        self.tweeted = []
+        self.retweeted = []
+        self._lock = threading.Lock()
+
+    def tweets(self, username, count=200, since_id=None, max_id=None, pages=1):
+        with self._lock:
+            self.requests.append(username)
+
+        latency = self.latency.get(username, 0) if isinstance(self.latency, dict) else self.latency
+        if self.rate_limited:
+            with self._lock:
+                self._limited += latency
+        time.sleep(latency)
+
+        if username in self.failing:
+            raise TweepError('Failed to fetch tweets for %s' % username)
+
+        timeline = [dict(tweet) for tweet in self.timelines.get(username, [])
+                    if (since_id is None or tweet['tid'] > since_id) and (max_id is None or tweet['tid'] <= max_id)]
+        return timeline[:count * pages]
+
+    def limited(self, endpoint='user_timeline'):
+        return self._limited
+
+    def tweet(self, text):
+        self.tweeted.append(text)
+
+    def retweet(self, id):
+        self.retweeted.append(id)
+
+
+class FakeAPI():
+    """
+    A stand-in for a tweepy API,
+    which serves canned timelines.
+    """
+
+    def __init__(self, timelines=None, errors=None, hidden=()):
+        """
+        timelines
+        A dict of {username: [tweet id, ...]}.
+
+        hidden
+        Tweet ids which count towards a page
+        but are left out of it, like Twitter does
+        with deleted or suspended tweets.
+
+        errors
+        A dict of {method name: [error, ...]};
+        each call to the method raises the next error,
+        until there are none left.
+        """
+        self.timelines = timelines or {}
+        self.errors = {method: list(errs) for method, errs in (errors or {}).items()}
+        self.hidden = set(hidden)
+        self.calls = []
+        self.retweeted = []
+        self.tweeted = []
+
+    def user_timeline(self, screen_name, count=20, since_id=None, max_id=None):
+        self._raise('user_timeline')
+        self.calls.append({'screen_name': screen_name, 'count': count, 'since_id': since_id, 'max_id': max_id})
+        tids = sorted(self.timelines.get(screen_name, []), reverse=True)
+        tids = [tid for tid in tids if (since_id is None or tid > since_id) and (max_id is None or tid <= max_id)]
+        return [faux_status(tid) for tid in tids[:count] if tid not in self.hidden]
+
+    def retweet(self, id):
+        self._raise('retweet')
+        self.retweeted.append(id)
+
+    def update_status(self, text):
+        self._raise('update_status')
+        self.tweeted.append(text)
+
+    def _raise(self, method):
+        if self.errors.get(method):
+            raise self.errors[method].pop(0)
+
+
+class FakeClock():
+    """
+    A stand-in for the real time,
+    where sleeping just moves time along.
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+        self.sleeps = []
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+
+def faux_error(status):
+    """
+    A TweepError for an HTTP status.
+    """
+    return TweepError('Twitter error response: status code = %s' % status, response=MagicMock(status=status))
+
+
+class FakeCollection():
+    """
+    A stand-in for a pymongo collection, in memory,
+    which supports just the queries and inserts the brain uses.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, docs=(), unique=('tid', 'body')):
+        """
+        docs
+        Docs which are already in the collection.
+
+        unique
+        Fields which are uniquely indexed.
+        """
+        self.unique = unique
+        self.docs = []
+        self._indexes = {field: set() for field in unique}
+        self.finds = 0
+        self.inserts = 0
+        for doc in docs:
+            self.add(dict(doc))
+
+    def find(self, spec, fields=None):
+        self.finds += 1
+        return [dict(doc) for doc in self.docs if self._match(doc, spec)]
+
+    def insert(self, docs, continue_on_error=False):
+        self.inserts += 1
+        failed = False
+        for doc in docs:
+            try:
+                self.add(doc)
+            except DuplicateKeyError:
+                failed = True
+                if not continue_on_error:
+                    break
+        if failed:
+            raise DuplicateKeyError('E11000 duplicate key error')
+
+    def add(self, doc):
+        """
+        Adds a doc, enforcing the unique indexes.
+        """
+        doc.setdefault('_id', next(self._ids))
+        for field in self.unique:
+            if doc.get(field) in self._indexes[field]:
+                raise DuplicateKeyError('E11000 duplicate key error')
+        for field in self.unique:
+            self._indexes[field].add(doc.get(field))
+        self.docs.append(dict(doc))
+
+    def _match(self, doc, spec):
+        for key, value in spec.items():
+            if key == '$or':
+                if not any(self._match(doc, sub) for sub in value):
+                    return False
+            elif isinstance(value, dict) and '$in' in value:
+                if doc.get(key) not in value['$in']:
+                    return False
+            elif doc.get(key) != value:
+                return False
+        return True
+
+
+class FakeTweet():
+    """
+    A stand-in for the Tweet model,
+    backed by a FakeCollection.
+    """
+    collection = None
+
+    def __init__(self, **data):
+        self.data = data
+
+    def validate(self):
+        # Just the Tweet model's required fields.
+        for field in ['tid', 'body', 'username']:
+            if not self.data.get(field) and self.data.get(field) != 0:
+                raise ValidationError('Field is required: %s' % field)
+
+    def to_mongo(self):
+        return dict(self.data)
+
+    @classmethod
+    def _get_collection(cls):
+        return cls.collection
+
+
+def faux_status(tid, text=None, protected=False, retweeted=False):
+    """
+    A tweet as returned by tweepy.
+    """
+    user = MagicMock(protected=protected)
+    return MagicMock(id=tid, text=text or 'tweet number %s' % tid, user=user, retweeted=retweeted)
+
+
+def faux_tweet(tid, body=None, protected=False, retweeted=False):
+    return {
+        'body': body or 'tweet number %s' % tid,
+        'tid': tid,
+        'protected': protected,
+        'retweeted': retweeted
+    }
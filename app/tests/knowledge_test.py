@@ -0,0 +1,169 @@
+import unittest, os, pickle
+from app.brain.knowledge import CompactKnowledge, Vocabulary
+from app.brain.markov import Markov
+
+test_filepath = 'app/tests/markov.pickle'
+test_mapped_filepath = 'app/tests/markov.mkv'
+test_log_filepath = 'app/tests/markov.log'
+test_seq_filepath = 'app/tests/markov.log.seq'
+
+knowledge = {
+        (): {('hey', 'this', 'is'): 2, ('this', 'is', 'a'): 1},
+        ('is', 'a', 'test'): {'<STOP>': 2},
+        ('hey', 'this', 'is'): {'a': 2},
+        ('this', 'is', 'a'): {'test': 3}
+}
+
+class CompactKnowledgeTest(unittest.TestCase):
+    def setUp(self):
+        self.k = CompactKnowledge(knowledge)
+
+    def tearDown(self):
+        # Clean up test files.
+        for filepath in [test_filepath, test_mapped_filepath, test_log_filepath, test_seq_filepath]:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+
+    def test_vocabulary(self):
+        vocab = Vocabulary(['foo', 'bar', 'foo'])
+        self.assertEqual(len(vocab), 2)
+        self.assertEqual(vocab[vocab.add('bar')], 'bar')
+        self.assertIsNone(vocab.get('baz'))
+
+    def test_empty(self):
+        self.assertEqual(CompactKnowledge(), {(): {}})
+
+    def test_packs_knowledge(self):
+        self.assertEqual(self.k, knowledge)
+        self.assertEqual(len(self.k), 4)
+        self.assertEqual(self.k[('this', 'is', 'a')], {'test': 3})
+        self.assertNotIn(('is', 'a', 'foo'), self.k)
+        self.assertEqual(self.k.get(('foo',), {}), {})
+
+    def test_learn_pending(self):
+        self.k.learn({('this', 'is', 'a'): {'dog': 1}, ('a', 'dog'): {'<STOP>': 1}})
+        self.assertEqual(self.k[('this', 'is', 'a')], {'test': 3, 'dog': 1})
+        self.assertEqual(self.k[('a', 'dog')], {'<STOP>': 1})
+        self.assertEqual(len(self.k), 5)
+
+        # Compacting shouldn't change anything.
+        expected = self.k.to_dict()
+        self.k.compact()
+        self.assertEqual(self.k, expected)
+        self.assertEqual(self.k._pending, {})
+
+    def test_pickle(self):
+        k = pickle.loads(pickle.dumps(self.k))
+        self.assertEqual(k, knowledge)
+
+    def test_dump_and_open(self):
+        self.k.learn({('a', 'dög'): {'<STOP>': 1}})
+        self.k.dump(test_mapped_filepath)
+        k = CompactKnowledge.open(test_mapped_filepath)
+        self.assertEqual(k, self.k)
+        self.assertEqual(k[('this', 'is', 'a')], {'test': 3})
+        self.assertEqual(k[()], knowledge[()])
+        self.assertNotIn(('is', 'a', 'foo'), k)
+
+        # Learning on an opened file.
+        k.learn({('this', 'is', 'a'): {'dog': 1}})
+        k.compact()
+        self.assertEqual(k[('this', 'is', 'a')], {'test': 3, 'dog': 1})
+
+    def test_dump_meta(self):
+        self.k.meta = {'seq': 5}
+        self.k.dump(test_mapped_filepath)
+        k = CompactKnowledge.open(test_mapped_filepath)
+        self.assertEqual(k.meta, {'seq': 5})
+
+    def test_open_bad_file(self):
+        with open(test_mapped_filepath, 'wb') as file:
+            file.write(b'not a markov file at all')
+        self.assertRaises(ValueError, CompactKnowledge.open, test_mapped_filepath)
+
+    def test_scan(self):
+        self.k.learn({('is', 'a', 'test'): {'<STOP>': 1}, ('a', 'test', 'of'): {'this': 1}})
+        self.assertEqual(dict(self.k.scan()), dict(self.k.items()))
+        self.assertEqual(dict(self.k.scan())[('is', 'a', 'test')], {'<STOP>': 3})
+
+    def test_nbytes(self):
+        self.assertGreater(self.k.nbytes, 0)
+        self.assertGreater(CompactKnowledge(dict(knowledge, more={'posts': 1})).nbytes, self.k.nbytes)
+
+    def test_markov_prune_compact(self):
+        m = Markov(ngram_size=3, filepath=test_filepath, compact=True)
+        m.knowledge = CompactKnowledge(knowledge)
+        m_ = Markov(ngram_size=3, filepath='app/tests/markov_pruned.pickle')
+        m_.knowledge = dict((prior, dict(posts)) for prior, posts in knowledge.items())
+        try:
+            stats = m.prune(min_count=3)
+            stats_ = m_.prune(min_count=3)
+        finally:
+            for filepath in ['app/tests/markov_pruned.pickle', 'app/tests/markov_pruned.log', 'app/tests/markov_pruned.log.seq']:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+        self.assertIsInstance(m.knowledge, CompactKnowledge)
+        self.assertEqual(m.knowledge, m_.knowledge)
+        self.assertEqual(stats['posts_after'], stats_['posts_after'])
+        self.assertLess(stats['bytes_after'], stats['bytes_before'])
+
+        # The pruned tokens are gone from the vocabulary too.
+        self.assertNotIn('hey', m.knowledge.vocab)
+
+    def test_markov_loads_mapped(self):
+        m = Markov(ngram_size=3, filepath=test_filepath, compact=True)
+        m.train(['hey this is a test?'])
+        m.checkpoint()
+
+        m_ = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertIsInstance(m_.knowledge, CompactKnowledge)
+        self.assertEqual(m_.knowledge, m.knowledge)
+
+    def test_markov_falls_back_to_pickle(self):
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        m.train(['hey this is a test?'])
+        m.checkpoint()
+
+        m_ = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m_.knowledge, m.knowledge)
+
+    def test_markov_compact(self):
+        m = Markov(ngram_size=3, filepath=test_filepath, compact=True, spasm=0.0)
+        m.train(['hey this is a test?'])
+        m.train(['hey this is a test?'])
+        expected = {
+                (): {('hey', 'this', 'is'): 2},
+                ('is', 'a', 'test'): {'<STOP>': 2},
+                ('hey', 'this', 'is'): {'a': 2},
+                ('this', 'is', 'a'): {'test': 2}
+        }
+        self.assertEqual(m.knowledge, expected)
+
+        m.compact()
+        self.assertIsInstance(m.knowledge, CompactKnowledge)
+        self.assertEqual(m.knowledge, expected)
+        self.assertEqual(m.generate(), 'hey this is a test')
+
+        m.reset()
+        self.assertEqual(m.knowledge, {(): {}})
+
+    def test_markov_move_mapped(self):
+        # A stale pickle is left there, but the mapped file is preferred.
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        m.train(['hey this is a test?'])
+        m.checkpoint()
+
+        m = Markov(ngram_size=3, filepath='app/tests/markov_moved.pickle', compact=True)
+        m.train(['this is only a test.'])
+        m.move(test_filepath)
+        self.assertFalse(os.path.exists('app/tests/markov_moved.mkv'))
+
+        m_ = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertIsInstance(m_.knowledge, CompactKnowledge)
+        self.assertEqual(m_.knowledge, m.knowledge)
+
+if __name__ == '__main__':
+    unittest.main()
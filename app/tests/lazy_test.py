@@ -0,0 +1,92 @@
+import unittest, threading, time
+from unittest.mock import MagicMock
+from app.brain import lazy
+from app.brain.lazy import Lazy
+
+class Thing():
+    def __init__(self):
+        self.size = 1
+
+    def grow(self, by):
+        self.size += by
+        return self.size
+
+
+class LazyTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = MagicMock(side_effect=Thing)
+        self.lazy = Lazy('thing', self.factory)
+
+    def test_not_loaded_until_used(self):
+        self.assertFalse(lazy.loaded(self.lazy))
+        self.assertFalse(self.factory.called)
+        self.assertEqual(self.lazy.grow(2), 3)
+        self.assertTrue(lazy.loaded(self.lazy))
+        self.assertIsNotNone(lazy.load_time(self.lazy))
+
+    def test_loaded_once(self):
+        self.lazy.grow(1)
+        self.lazy.grow(1)
+        self.assertEqual(self.lazy.size, 3)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_loaded_once_across_threads(self):
+        def slow():
+            time.sleep(0.05)
+            return Thing()
+        factory = MagicMock(side_effect=slow)
+        proxy = Lazy('thing', factory)
+
+        threads = [threading.Thread(target=proxy.grow, args=(1,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(factory.call_count, 1)
+        self.assertEqual(proxy.size, 6)
+
+    def test_setattr(self):
+        self.lazy.size = 10
+        self.assertEqual(lazy.load(self.lazy).size, 10)
+        self.assertFalse('size' in self.lazy.__dict__)
+
+    def test_swap(self):
+        old = lazy.load(self.lazy)
+        new = Thing()
+        new.size = 5
+
+        self.assertIs(lazy.swap(self.lazy, new), old)
+        self.assertEqual(self.lazy.size, 5)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_swap_before_loaded(self):
+        self.assertIsNone(lazy.swap(self.lazy, Thing()))
+        self.assertTrue(lazy.loaded(self.lazy))
+        self.lazy.grow(1)
+        self.assertFalse(self.factory.called)
+
+    def test_warm(self):
+        lazy.warm(self.lazy).join()
+        self.assertTrue(lazy.loaded(self.lazy))
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_passes_through_same_names(self):
+        # The object's own load, swap etc. aren't hidden by the proxy's.
+        class Model():
+            def load(self):
+                return 'knowledge'
+        proxy = Lazy('model', Model)
+        self.assertEqual(proxy.load(), 'knowledge')
+
+    def test_dir_does_not_load(self):
+        dir(self.lazy)
+        self.assertFalse(lazy.loaded(self.lazy))
+
+    def test_repr(self):
+        self.assertIn('not loaded', repr(self.lazy))
+        lazy.load(self.lazy)
+        self.assertIn('Thing', repr(self.lazy))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
-import unittest, os
+import unittest, os, pickle, sys, threading
+from app.brain import deltalog
 from app.brain.markov import Markov
 
 test_filepath = 'app/tests/markov.pickle'
+test_mapped_filepath = 'app/tests/markov.mkv'
+test_log_filepath = 'app/tests/markov.log'
+test_seq_filepath = 'app/tests/markov.log.seq'
 
 class MarkovTest(unittest.TestCase):
     def setUp(self):
@@ -9,11 +13,12 @@ class MarkovTest(unittest.TestCase):
         self.doc = 'hey this is a test?'
 
     def tearDown(self):
-        # Clean up test pickle.
-        try:
-            os.remove(test_filepath)
-        except FileNotFoundError:
-            pass
+        # Clean up test files.
+        for filepath in [test_filepath, test_log_filepath, test_seq_filepath]:
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
 
     def test_tokenizer_default_stop_words(self):
         tokens = self.m.tokenize(self.doc)
@@ -58,11 +63,341 @@ class MarkovTest(unittest.TestCase):
         self.m.train([self.doc])
         self.assertEqual(self.m.knowledge, expected)
 
+    def test_ngramize_sizes(self):
+        tokens = self.m.tokenize(self.doc)
+        ngrams = [ngram for ngram in self.m.ngramize(tokens, 1)]
+        expected = [
+            ['hey', 'this'],
+            ['this', 'is'],
+            ['is', 'a'],
+            ['a', 'test'],
+            ['test', '<STOP>']
+        ]
+        self.assertEqual(ngrams, expected)
+        self.assertEqual(tokens, ['hey', 'this', 'is', 'a', 'test'])
+
+    def test_train_multi_order(self):
+        self.m = Markov(ngram_size=2, max_order=2, filepath=test_filepath)
+        self.assertEqual(self.m.orders, (1, 2))
+
+        self.m.train(['hey this is'])
+        expected = {
+                (): {('hey', 'this'): 1},
+                ('hey',): {'this': 1},
+                ('this',): {'is': 1},
+                ('is',): {'<STOP>': 1},
+                ('hey', 'this'): {'is': 1},
+                ('this', 'is'): {'<STOP>': 1}
+        }
+        self.assertEqual(self.m.knowledge, expected)
+
+    def test_knows_order(self):
+        self.assertEqual(self.m.orders, (3,))
+        self.assertFalse(self.m.knows_order(2))
+
+        m = Markov(ngram_size=1, max_order=3, filepath=test_filepath)
+        self.assertTrue(all(m.knows_order(n) for n in (1, 2, 3)))
+        self.assertFalse(m.knows_order(4))
+
+    def test_knows_order_saved(self):
+        # Trained and saved with just the one ngram size...
+        self.m.train([self.doc])
+        self.m.checkpoint()
+        self.m.train([self.doc])
+
+        # ...then loaded configured for more.
+        m = Markov(ngram_size=3, max_order=3, filepath=test_filepath)
+        self.assertEqual(m.counted_orders, (3,))
+        self.assertFalse(m.knows_order(2))
+        self.assertTrue(m.knows_orders(3))
+        self.assertFalse(m.knows_orders(3, max_order=3))
+
+        # Training doesn't mix other sizes in.
+        m.train(['this is only a test'])
+        self.assertEqual(set(len(prior) for prior in m.knowledge if prior), {3})
+        m = Markov(ngram_size=3, max_order=3, filepath=test_filepath)
+        self.assertEqual(set(len(prior) for prior in m.knowledge if prior), {3})
+
+        # Until it's reset, i.e. to be retrained.
+        m.reset()
+        m.train([self.doc])
+        self.assertEqual(m.counted_orders, (1, 2, 3))
+        m = Markov(ngram_size=3, max_order=3, filepath=test_filepath)
+        self.assertTrue(m.knows_orders(3, max_order=3))
+
+    def test_knows_order_unnumbered(self):
+        # Saved before the ngram sizes were.
+        with open(test_filepath, 'wb') as file:
+            pickle.dump(self.m.count([self.doc]), file)
+
+        m = Markov(ngram_size=3, max_order=3, filepath=test_filepath)
+        self.assertEqual(m.counted_orders, (3,))
+        self.assertFalse(m.knows_order(1))
+
+    def test_switch_ngram_size_without_retraining(self):
+        docs = ['hey this is a test? this is only a test.', 'is a test a test of a test']
+        self.m = Markov(ngram_size=3, max_order=3, filepath=test_filepath, spasm=0.0, ramble=False)
+        self.m.train(docs)
+        m = Markov(ngram_size=1, filepath='app/tests/markov_serial.pickle')
+        try:
+            m.train(docs)
+
+            # The ngram size 1 counts are all there.
+            self.m.n = 1
+            for prior, posts in m.knowledge.items():
+                if prior:
+                    self.assertEqual(self.m.knowledge[prior], posts)
+
+            for speech in self.m.generate_many(20, seed=0):
+                self.assertTrue(speech)
+        finally:
+            os.remove('app/tests/markov_serial.log')
+            os.remove('app/tests/markov_serial.log.seq')
+
+    def test_train_parallel_same_as_serial(self):
+        docs = [
+            'hey this is a test? this is only a test.',
+            'RT @foo this is not a drill, hey this is real.',
+            'is a test a test of a test'
+        ] * 10
+        self.m.train(docs)
+        m = Markov(ngram_size=3, filepath='app/tests/markov_parallel.pickle')
+        try:
+            m.train(docs, processes=2, chunk_size=4)
+            self.assertEqual(m.knowledge, self.m.knowledge)
+        finally:
+            os.remove('app/tests/markov_parallel.log')
+            os.remove('app/tests/markov_parallel.log.seq')
+
+    def test_train_streaming_batches(self):
+        docs = ['hey this is a test?', 'this is only a test.', 'hey this is not a drill'] * 5
+        progress = []
+        self.m.train((doc for doc in docs), batch_size=4, progress=progress.append)
+        self.assertEqual(progress, [4, 8, 12, 15])
+
+        m = Markov(ngram_size=3, filepath='app/tests/markov_serial.pickle')
+        try:
+            m.train(docs)
+            self.assertEqual(m.knowledge, self.m.knowledge)
+        finally:
+            os.remove('app/tests/markov_serial.log')
+            os.remove('app/tests/markov_serial.log.seq')
+
+    def test_train_logs_and_replays(self):
+        self.m.train([self.doc])
+        self.assertFalse(os.path.exists(test_filepath))
+
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge, self.m.knowledge)
+
+    def test_checkpoint(self):
+        self.m.train([self.doc])
+        self.m.checkpoint()
+        self.assertEqual(os.path.getsize(test_log_filepath), 0)
+
+        self.m.train([self.doc])
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge[('this', 'is', 'a')], {'test': 2})
+
+    def test_checkpoint_interrupted(self):
+        # i.e. the process died after saving, before truncating the log.
+        self.m.train([self.doc])
+        self.m.save()
+
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge, self.m.knowledge)
+
+        m.train([self.doc])
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge[('this', 'is', 'a')], {'test': 2})
+
+    def test_loads_unnumbered(self):
+        # Saved and logged before either was numbered.
+        delta = self.m.count([self.doc])
+        with open(test_filepath, 'wb') as file:
+            pickle.dump(delta, file)
+        with open(test_log_filepath, 'wb') as file:
+            pickle.dump(delta, file)
+
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge[('this', 'is', 'a')], {'test': 2})
+
+        m.checkpoint()
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge[('this', 'is', 'a')], {'test': 2})
+
+    def test_move(self):
+        self.m.train([self.doc])
+        m = Markov(ngram_size=3, filepath='app/tests/markov_moved.pickle')
+        m.train(['hey this is only a test'])
+        try:
+            m.move(test_filepath)
+            self.assertFalse(os.path.exists('app/tests/markov_moved.pickle'))
+            self.assertFalse(os.path.exists('app/tests/markov_moved.log'))
+
+            # The logged training at the old path is replaced too.
+            m_ = Markov(ngram_size=3, filepath=test_filepath)
+            self.assertEqual(m_.knowledge, m.knowledge)
+
+            # And it saves to the new path from now on.
+            m.train([self.doc])
+            m_ = Markov(ngram_size=3, filepath=test_filepath)
+            self.assertEqual(m_.knowledge, m.knowledge)
+        finally:
+            for filepath in ['app/tests/markov_moved.pickle', 'app/tests/markov_moved.log', 'app/tests/markov_moved.log.seq']:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+    def test_checkpoint_keeps_others_training(self):
+        # i.e. the web app and the worker, each with its own Markov.
+        other = Markov(ngram_size=3, filepath=test_filepath)
+        other.train(['hey this is only a test.'])
+        self.m.train([self.doc])
+        self.m.checkpoint()
+
+        expected = Markov(ngram_size=3, filepath='app/tests/markov_expected.pickle')
+        try:
+            expected.train(['hey this is only a test.', self.doc])
+            self.assertEqual(self.m.knowledge, expected.knowledge)
+            self.assertEqual(Markov(ngram_size=3, filepath=test_filepath).knowledge, expected.knowledge)
+
+            # The other one's checkpoint doesn't count anything twice.
+            other.train([self.doc])
+            other.checkpoint()
+            expected.train([self.doc])
+            self.assertEqual(Markov(ngram_size=3, filepath=test_filepath).knowledge, expected.knowledge)
+        finally:
+            os.remove('app/tests/markov_expected.log')
+            os.remove('app/tests/markov_expected.log.seq')
+
+    def test_sync(self):
+        other = Markov(ngram_size=3, filepath=test_filepath)
+        other.train(['hey this is only a test.'])
+        self.m.train([self.doc])
+
+        self.assertFalse(self.m.sync())
+        self.assertEqual(self.m.knowledge[('hey', 'this', 'is')], {'a': 1, 'only': 1})
+
+        # Once it's saved elsewhere, it's loaded again.
+        other.checkpoint()
+        self.assertTrue(self.m.sync())
+        self.assertEqual(self.m.knowledge, other.knowledge)
+
+    def test_prune_not_saved_over(self):
+        other = Markov(ngram_size=3, filepath=test_filepath)
+        self.m.train([self.doc, 'hey this is only a test.'])
+        self.m.prune(min_count=2)
+
+        other.train([self.doc])
+        other.checkpoint()
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge[('hey', 'this', 'is')], {'a': 1})
+
+    def test_checkpoint_keeps_pinned(self):
+        self.m.train([self.doc])
+        with deltalog.pinned(test_log_filepath) as since:
+            self.m.train(['hey this is only a test.'])
+            self.m.checkpoint()
+            self.assertEqual([entry.seq for entry in deltalog.replay(test_log_filepath, after=since)], [2])
+
+            # Replaying skips them, since they're saved.
+            m = Markov(ngram_size=3, filepath=test_filepath)
+            self.assertEqual(m.knowledge, self.m.knowledge)
+
+        self.m.checkpoint()
+        self.assertEqual(os.path.getsize(test_log_filepath), 0)
+
+    def test_replay_ignores_partial_entry(self):
+        self.m.train([self.doc])
+        with open(test_log_filepath, 'ab') as file:
+            file.write(b'\x80\x04\x95')
+
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge, self.m.knowledge)
+
     def test_reset(self):
         self.m.train([self.doc])
         self.m.reset()
         self.assertEqual(self.m.knowledge, {():{}})
 
+    def test_prune(self):
+        self.m.knowledge = {
+                (): {('hey', 'this', 'is'): 3, ('this', 'is', 'a'): 1},
+                ('hey', 'this', 'is'): {'a': 3, 'not': 1},
+                ('this', 'is', 'a'): {'test': 1, '<STOP>': 1},
+                ('is', 'a', 'drill'): {'ok': 1}
+        }
+        stats = self.m.prune(min_count=2)
+        expected = {
+                (): {('hey', 'this', 'is'): 3},
+                ('hey', 'this', 'is'): {'a': 3},
+                ('this', 'is', 'a'): {'<STOP>': 1}
+        }
+        self.assertEqual(self.m.knowledge, expected)
+        self.assertEqual((stats['priors_before'], stats['priors_after']), (4, 3))
+        self.assertEqual((stats['posts_before'], stats['posts_after']), (7, 3))
+        self.assertLess(stats['bytes_after'], stats['bytes_before'])
+
+        # It's saved.
+        m = Markov(ngram_size=3, filepath=test_filepath)
+        self.assertEqual(m.knowledge, expected)
+
+    def test_prune_min_prior_count(self):
+        self.m.knowledge = {
+                (): {('hey', 'this', 'is'): 1},
+                ('hey', 'this', 'is'): {'a': 2, 'not': 1},
+                ('this', 'is', 'a'): {'test': 1, '<STOP>': 1},
+                ('this', 'is', 'not'): {'<STOP>': 3}
+        }
+        self.m.prune(min_count=1, min_prior_count=3)
+
+        # The post leading into the dropped prior goes too.
+        expected = {
+                (): {('hey', 'this', 'is'): 1},
+                ('hey', 'this', 'is'): {'not': 1},
+                ('this', 'is', 'not'): {'<STOP>': 3}
+        }
+        self.assertEqual(self.m.knowledge, expected)
+
+    def test_prune_keeps_stops_reachable(self):
+        docs = ['hey this is a test? this is only a test.', 'hey this is not a drill', 'is a test a test of a test'] * 2
+        docs += ['this is a drill', 'hey this is new', 'this is only the beginning']
+        self.m = Markov(ngram_size=3, max_order=3, filepath=test_filepath)
+        self.m.train(docs)
+        self.m.prune(min_count=2, min_prior_count=3)
+
+        for n in (1, 2, 3):
+            self.m.n = n
+            stoppable = set(prior for prior, posts in self.m.knowledge.items() if self.m.stop_token in posts)
+            while True:
+                more = set(prior for prior, posts in self.m.knowledge.items()
+                        if prior and len(prior) == n and any(self.m._next_prior(prior, post) in stoppable for post in posts))
+                if more <= stoppable:
+                    break
+                stoppable |= more
+
+            # Every chain left can stop.
+            self.assertTrue(self.m.knowledge[()])
+            for start in self.m.knowledge[()]:
+                self.assertIn(self.m._next_prior((), start), stoppable)
+            for prior, posts in self.m.knowledge.items():
+                if prior and len(prior) == n:
+                    self.assertIn(prior, stoppable)
+
+    def test_prune_max_posts(self):
+        self.m.knowledge = {
+                (): {},
+                ('hey', 'this', 'is'): {'a': 5, 'not': 3, 'the': 2, '<STOP>': 1}
+        }
+        self.m.prune(min_count=1, max_posts=2)
+        self.assertEqual(self.m.knowledge[('hey', 'this', 'is')], {'a': 5, 'not': 3, '<STOP>': 1})
+
+    def test_train_prune(self):
+        self.m.train([self.doc, self.doc, 'hey this is not a test'], prune={'min_count': 2})
+        self.assertEqual(self.m.knowledge[()], {('hey', 'this', 'is'): 3})
+        self.assertEqual(self.m.knowledge[('hey', 'this', 'is')], {'a': 2})
+        self.assertNotIn(('this', 'is', 'not'), self.m.knowledge)
+
     def test_weighted_choice(self):
         num_trials = 100000
         dict = {
@@ -92,8 +427,8 @@ class MarkovTest(unittest.TestCase):
                     'pal': 1
                 }
         }
-        self.m.prev = ('why', 'hello', 'there')
-        self.assertEqual(self.m._next_token(), 'pal')
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(self.m._next_token(prev), 'pal')
 
     def test_next_token_weighted(self):
         num_trials = 100000
@@ -103,11 +438,11 @@ class MarkovTest(unittest.TestCase):
                     'friend': 1
                 }
         }
-        self.m.prev = ('why', 'hello', 'there')
+        prev = ('why', 'hello', 'there')
 
         results = {}
         for i in range(num_trials):
-            token = self.m._next_token()
+            token = self.m._next_token(prev)
             results[token] = results.get(token, 0) + 1
 
         # Convert to percents
@@ -117,14 +452,63 @@ class MarkovTest(unittest.TestCase):
         self.assertAlmostEqual(results['pal'], 0.5, places=2)
         self.assertAlmostEqual(results['friend'], 0.5, places=2)
 
+    def test_sampler_invalidated_by_train(self):
+        self.m.train(['why hello there pal'])
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(self.m._next_token(prev), 'pal')
+
+        # Retraining should update the cached sampler.
+        for i in range(100):
+            self.m.train(['why hello there friend'])
+        results = set(self.m._next_token(prev) for i in range(1000))
+        self.assertIn('friend', results)
+
+    def test_sampler_invalidated_by_new_knowledge(self):
+        self.m.knowledge = {('why', 'hello', 'there'): {'pal': 1}}
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(self.m._next_token(prev), 'pal')
+
+        self.m.knowledge = {('why', 'hello', 'there'): {'friend': 1}}
+        self.assertEqual(self.m._next_token(prev), 'friend')
+
     def test_next_token_insufficient_previous_tokens(self):
         self.m.knowledge = {
                 (): {
                     ('pal',): 1
                 }
         }
-        self.m.prev = ('why',)
-        self.assertEqual(self.m._next_token(), ('pal',))
+        prev = ('why',)
+        self.assertEqual(self.m._next_token(prev), ('pal',))
+
+    def test_next_token_backs_off(self):
+        self.m = Markov(ramble=False, ngram_size=3, max_order=3, filepath=test_filepath, spasm=0.0)
+        self.m.knowledge = {
+                (): {('hey',): 1},
+                ('hello', 'there'): {'pal': 1}
+        }
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(self.m._next_token(prev), 'pal')
+
+        # Nothing to back off to, and not rambling.
+        prev = ('why', 'hello', 'friend')
+        self.assertIsNone(self.m._next_token(prev))
+
+    def test_next_token_backs_off_before_rambling(self):
+        self.m = Markov(ramble=True, ngram_size=3, max_order=3, filepath=test_filepath, spasm=0.0)
+        self.m.knowledge = {
+                (): {('hey',): 1},
+                ('there',): {'pal': 1}
+        }
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(set(self.m._next_token(prev) for i in range(100)), {'pal'})
+
+    def test_next_token_no_backoff_without_max_order(self):
+        self.m.knowledge = {
+                (): {('hey',): 1},
+                ('hello', 'there'): {'pal': 1}
+        }
+        prev = ('why', 'hello', 'there')
+        self.assertEqual(self.m._next_token(prev), ('hey',))
 
     def test_generate(self):
         self.m = Markov(ramble=False, ngram_size=3, filepath=test_filepath)
@@ -194,3 +578,221 @@ class MarkovTest(unittest.TestCase):
         for i in range(1000):
             speech = self.m.generate()
             self.assertEqual(speech, 'hello hello hello goodbye hey')
+
+    def test_consolidate_backtracks_to_stop(self):
+        self.m.max_chars = 20
+        self.m.knowledge = {
+                ('b', 'c', 'd'): {'<STOP>': 1}
+        }
+        tokens = ['a', 'b', 'c', 'd', 'eeeeeeeeee', 'ffffffffff']
+        self.assertEqual(self.m._consolidate(tokens), ['a', 'b', 'c', 'd'])
+
+    def test_consolidate_backs_off_to_stop(self):
+        self.m = Markov(ngram_size=3, max_order=3, filepath=test_filepath, max_chars=20)
+        self.m.knowledge = {
+                ('c', 'd'): {'<STOP>': 1}
+        }
+        tokens = ['a', 'b', 'c', 'd', 'eeeeeeeeee', 'ffffffffff']
+        self.assertEqual(self.m._consolidate(tokens), ['a', 'b', 'c', 'd'])
+
+    def test_consolidate_long_tokens(self):
+        # Shouldn't hit the recursion limit.
+        self.m.knowledge = {(): {}}
+        tokens = ['hey'] * 10000
+        self.assertEqual(self.m._consolidate(tokens), [])
+
+    def test_generate_records_latency(self):
+        self.m.train([self.doc])
+        for i in range(10):
+            self.m.generate()
+        self.assertEqual(len(self.m.latencies), 10)
+        self.assertGreater(self.m.latency(99), 0)
+
+    def test_generate_caches_bounded(self):
+        docs = ['hey this is a test', 'hey this is not a test', 'this is a test of a drill']
+        self.m.train(docs)
+        self.m.max_cached = 2
+        for i in range(50):
+            self.assertTrue(self.m.generate())
+            self.assertLessEqual(len(self.m._samplers), 2)
+            self.assertLessEqual(len(self.m._stoppable), 2)
+
+    def test_generate_many(self):
+        self.m = Markov(ramble=False, ngram_size=3, filepath=test_filepath, spasm=0.0)
+        self.m.knowledge = {
+                (): {
+                    ('hello',): 1
+                },
+                ('hello', 'hello', 'hello'): {
+                    'goodbye': 1
+                }
+        }
+        speeches = self.m.generate_many(10)
+        self.assertEqual(speeches, ['hello hello hello goodbye'] * 10)
+
+    def test_generate_many_backs_off(self):
+        self.m = Markov(ramble=False, ngram_size=3, max_order=3, filepath=test_filepath, spasm=0.0)
+        self.m.knowledge = {
+                (): {
+                    ('why', 'hello', 'there'): 1
+                },
+                ('hello', 'there'): {
+                    'pal': 1
+                },
+                ('there', 'pal'): {
+                    'friend': 1
+                },
+                ('friend',): {
+                    '<STOP>': 1
+                }
+        }
+        speeches = self.m.generate_many(10)
+        self.assertEqual(speeches, ['why hello there pal friend'] * 10)
+        self.assertEqual(self.m.generate(), 'why hello there pal friend')
+
+    def test_generate_many_seed(self):
+        self.m.train(['hey this is a test', 'hey this is not a test', 'this is a test of a drill'])
+        self.assertEqual(self.m.generate_many(20, seed=1), self.m.generate_many(20, seed=1))
+
+    def test_generate_many_weighted(self):
+        self.m = Markov(ramble=False, ngram_size=3, filepath=test_filepath, spasm=0.0)
+        self.m.knowledge = {
+                (): {
+                    ('why', 'hello', 'there'): 1
+                },
+                ('why', 'hello', 'there'): {
+                    'pal': 1,
+                    'friend': 1
+                }
+        }
+        speeches = self.m.generate_many(10000)
+        self.assertAlmostEqual(speeches.count('why hello there pal')/10000, 0.5, places=1)
+        self.assertEqual(len(set(speeches)), 2)
+
+    def test_generate_many_under_max_chars_consolidate_strategy(self):
+        self.m.knowledge = {
+                (): {
+                    'hello': 1
+                },
+                ('hello', 'hello', 'hello'): {
+                    'goodbye': 1
+                },
+                ('hello', 'hello', 'goodbye'): {
+                    'hey': 1,
+                    '<STOP>': 1
+                },
+                ('hello', 'goodbye', 'hey'): {
+                    'goodbyeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee': 1
+                }
+        }
+        for speech in self.m.generate_many(1000):
+            self.assertIn(speech, ['hello hello hello goodbye', 'hello hello hello goodbye hey'])
+
+    def test_generate_many_under_max_chars_fallsback_to_truncation_strategy(self):
+        self.m.knowledge = {
+                (): {
+                    ('hello',): 1
+                },
+                ('hello', 'hello', 'hello'): {
+                    'goodbye': 1
+                },
+                ('hello', 'hello', 'goodbye'): {
+                    'hey': 1
+                },
+                ('hello', 'goodbye', 'hey'): {
+                    'goodbyeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee': 1
+                }
+        }
+        for speech in self.m.generate_many(100):
+            self.assertEqual(speech, 'hello hello hello goodbye hey')
+
+
+class MarkovConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        # Each doc's tokens are its own, so every chain
+        # should generate exactly one of the docs.
+        self.docs = [' '.join('t%s%s' % (i, c) for c in 'abcdef') for i in range(50)]
+        self.m = Markov(ngram_size=2, filepath=test_filepath, ramble=False, spasm=0.0)
+        self.m.train(self.docs)
+
+        # Switch threads as often as possible, to shake out races.
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+        for filepath in [test_filepath, test_mapped_filepath, test_log_filepath, test_seq_filepath]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def test_generate_on_many_threads(self):
+        results = []
+        errors = []
+
+        def generate(i):
+            try:
+                for j in range(300):
+                    if j % 10 == i % 10:
+                        results.extend(self.m.generate_many(10))
+                    else:
+                        results.append(self.m.generate())
+                    self.m.latency()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=generate, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 8 * (270 + 30 * 10))
+        self.assertEqual(set(results) - set(self.docs), set())
+
+    def test_generate_while_training(self):
+        for compact in (False, True):
+            self.m = Markov(ngram_size=2, filepath=test_filepath, ramble=False, spasm=0.0, compact=compact)
+            self.m.reset()
+            self.m.train(self.docs)
+
+            new_docs = [' '.join('t%s%s' % (i, c) for c in 'abcdef') for i in range(50, 100)]
+            results = []
+            errors = []
+            training = threading.Event()
+
+            def generate(i):
+                try:
+                    while not training.is_set():
+                        if i % 2:
+                            results.extend(self.m.generate_many(10))
+                        else:
+                            results.append(self.m.generate())
+                except Exception as e:
+                    errors.append(e)
+
+            def train():
+                try:
+                    for i, doc in enumerate(new_docs):
+                        self.m.train([doc])
+                        if i % 10 == 9:
+                            self.m.compact()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    training.set()
+
+            threads = [threading.Thread(target=generate, args=(i,)) for i in range(4)]
+            threads.append(threading.Thread(target=train))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertTrue(results)
+            self.assertEqual(set(results) - set(self.docs + new_docs), set())
+
+            # Everything trained on is there afterwards.
+            self.assertEqual(set(self.m.generate_many(500, seed=0)) - set(self.docs + new_docs), set())
+            self.assertEqual(self.m.knowledge[('t99e', 't99f')], {'<STOP>': 1})
@@ -0,0 +1,98 @@
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from app import metrics
+from app.brain.markov import Markov
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(metrics.enable)
+
+    def test_counter(self):
+        metrics.inc('foo_total')
+        metrics.inc('foo_total', 2)
+        self.assertIn('# TYPE foo_total counter\nfoo_total 3\n', metrics.render())
+
+    def test_counter_labels(self):
+        metrics.inc('foo_total', endpoint='a')
+        metrics.inc('foo_total', endpoint='b', status=403)
+        rendered = metrics.render()
+        self.assertIn('foo_total{endpoint="a"} 1', rendered)
+        self.assertIn('foo_total{endpoint="b",status="403"} 1', rendered)
+        self.assertEqual(rendered.count('# TYPE foo_total'), 1)
+
+    def test_label_escaping(self):
+        metrics.inc('foo_total', reason='a "quoted"\nthing')
+        self.assertIn('foo_total{reason="a \\"quoted\\"\\nthing"} 1', metrics.render())
+
+    def test_histogram(self):
+        metrics.observe('foo_seconds', 0.002)
+        metrics.observe('foo_seconds', 0.2)
+        metrics.observe('foo_seconds', 100)
+        rendered = metrics.render()
+        self.assertIn('# TYPE foo_seconds histogram', rendered)
+        self.assertIn('foo_seconds_bucket{le="0.001"} 0', rendered)
+        self.assertIn('foo_seconds_bucket{le="0.005"} 1', rendered)
+        self.assertIn('foo_seconds_bucket{le="0.5"} 2', rendered)
+        self.assertIn('foo_seconds_bucket{le="+Inf"} 3', rendered)
+        self.assertIn('foo_seconds_sum 100.202', rendered)
+        self.assertIn('foo_seconds_count 3', rendered)
+
+    def test_timed(self):
+        with metrics.timed('foo_seconds', op='find'):
+            pass
+        self.assertIn('foo_seconds_count{op="find"} 1', metrics.render())
+
+    def test_timed_raises(self):
+        with self.assertRaises(ValueError):
+            with metrics.timed('foo_seconds'):
+                raise ValueError
+        self.assertIn('foo_seconds_count 1', metrics.render())
+
+    def test_help(self):
+        metrics.describe('foo_total', 'How many foos.')
+        metrics.inc('foo_total')
+        self.assertIn('# HELP foo_total How many foos.\n# TYPE foo_total counter', metrics.render())
+
+    def test_disabled(self):
+        metrics.disable()
+        metrics.inc('foo_total')
+        metrics.observe('foo_seconds', 1)
+        with metrics.timed('bar_seconds'):
+            pass
+        self.assertEqual(metrics.render(), '\n')
+
+    def test_serve(self):
+        metrics.inc('foo_total')
+        server = metrics.serve(0, host='127.0.0.1')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%s' % server.server_address[1]
+
+        with urlopen(url + '/metrics') as response:
+            self.assertEqual(response.headers['Content-Type'], metrics.CONTENT_TYPE)
+            self.assertIn('foo_total 1', response.read().decode('utf-8'))
+
+        with self.assertRaises(HTTPError) as raised:
+            urlopen(url + '/nope')
+        self.assertEqual(raised.exception.code, 404)
+
+    def test_markov_generate(self):
+        m = Markov(ngram_size=1, filepath='app/tests/markov_metrics.pickle')
+        m.knowledge = {
+            (): {('hey',): 1},
+            ('hey',): {'there': 1},
+            ('there',): {'<STOP>': 1}
+        }
+        m.spasm = 0
+        m.generate()
+        rendered = metrics.render()
+        self.assertIn('brain_markov_generate_seconds_count 1', rendered)
+        self.assertIn('brain_markov_generate_tokens_total 2', rendered)
+        self.assertIn('brain_markov_generate_retries_total 0', rendered)
+
+
+if __name__ == '__main__':
+    unittest.main()
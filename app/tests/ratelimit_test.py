@@ -0,0 +1,160 @@
+import unittest, threading, time
+from app.brain.ratelimit import Scheduler, TokenBucket
+from .fakes import FakeClock
+
+class Flaky():
+    """
+    A function which fails a few times before it works.
+    """
+    def __init__(self, failures, error=ValueError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error('nope')
+        return args, kwargs
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_burst(self):
+        bucket = TokenBucket(1, 3, self.clock)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.reserve(), 1)
+
+    def test_queues_in_order(self):
+        bucket = TokenBucket(2, 1, self.clock)
+        self.assertEqual([bucket.reserve() for i in range(4)], [0, 0.5, 1, 1.5])
+
+    def test_refills(self):
+        bucket = TokenBucket(1, 2, self.clock)
+        bucket.reserve()
+        bucket.reserve()
+        self.clock.sleep(10)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 1])
+
+    def test_hold(self):
+        bucket = TokenBucket(1, 5, self.clock)
+        bucket.hold(10)
+        self.assertEqual(bucket.reserve(), 11)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limits = {'timeline': (10, 10, 2)}
+
+    def test_call(self):
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        result = scheduler.call('timeline', lambda *args, **kwargs: (args, kwargs), 1, foo='bar')
+        self.assertEqual(result, ((1,), {'foo': 'bar'}))
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_spaces_calls(self):
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        times = [scheduler.call('timeline', self.clock.time) for i in range(5)]
+        self.assertEqual(times, [0, 0, 1, 2, 3])
+
+        stats = scheduler.stats()['timeline']
+        self.assertEqual(stats['calls'], 5)
+        self.assertEqual(stats['waited'], 3)
+        self.assertEqual(stats['max_wait'], 1)
+        self.assertEqual(stats['queued'], 0)
+
+    def test_limited(self):
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        for i in range(5):
+            scheduler.call('timeline', self.clock.time)
+        self.assertEqual(scheduler.stats()['timeline']['limited'], 3)
+
+    def test_limited_overlapping_waits(self):
+        # Waits at once are only counted for as long as they overlap.
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        stats = scheduler._stats_for('timeline')
+        scheduler._limit('timeline', stats, 2)
+        scheduler._limit('timeline', stats, 3)
+        self.clock.now = 5
+        scheduler._limit('timeline', stats, 1)
+        self.assertEqual(stats['limited'], 4)
+
+    def test_endpoints_have_own_budgets(self):
+        scheduler = Scheduler({'timeline': (1, 10, 1), 'statuses': (1, 10, 1)}, clock=self.clock)
+        scheduler.call('timeline', self.clock.time)
+        self.assertEqual(scheduler.call('statuses', self.clock.time), 0)
+
+    def test_unlimited_endpoint(self):
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        for i in range(100):
+            scheduler.call('other', self.clock.time)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_does_not_retry_by_default(self):
+        scheduler = Scheduler(self.limits, clock=self.clock)
+        func = Flaky(1)
+        self.assertRaises(ValueError, scheduler.call, 'timeline', func)
+        self.assertEqual(func.calls, 1)
+        self.assertEqual(scheduler.stats()['timeline']['errors'], 1)
+
+    def test_backs_off(self):
+        scheduler = Scheduler(self.limits, clock=self.clock, should_retry=lambda endpoint, err: True, backoff=5)
+        func = Flaky(2)
+        scheduler.call('timeline', func, 'foo')
+        self.assertEqual(func.calls, 3)
+
+        # Backs off 5s then 10s, plus a token's wait each time.
+        self.assertEqual(self.clock.now, 17)
+
+        stats = scheduler.stats()['timeline']
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['retries'], 2)
+
+    def test_backoff_holds_up_other_calls(self):
+        scheduler = Scheduler(self.limits, clock=self.clock, should_retry=lambda endpoint, err: True, backoff=5)
+        scheduler.call('timeline', Flaky(1))
+        started = self.clock.now
+        scheduler.call('timeline', self.clock.time)
+        self.assertGreater(self.clock.now, started)
+
+    def test_max_backoff(self):
+        scheduler = Scheduler(clock=self.clock, should_retry=lambda endpoint, err: True, backoff=5, max_backoff=8, max_retries=3)
+        scheduler.call('other', Flaky(3))
+        self.assertEqual(self.clock.sleeps, [5, 8, 8])
+
+    def test_gives_up(self):
+        scheduler = Scheduler(self.limits, clock=self.clock, should_retry=lambda endpoint, err: True, max_retries=2)
+        func = Flaky(5)
+        self.assertRaises(ValueError, scheduler.call, 'timeline', func)
+        self.assertEqual(func.calls, 3)
+
+    def test_only_retries_some_errors(self):
+        scheduler = Scheduler(self.limits, clock=self.clock, should_retry=lambda endpoint, err: isinstance(err, KeyError))
+        self.assertRaises(ValueError, scheduler.call, 'timeline', Flaky(1))
+        func = Flaky(1, error=KeyError)
+        scheduler.call('timeline', func)
+        self.assertEqual(func.calls, 2)
+
+    def test_concurrent_calls(self):
+        # Real time, but quick.
+        scheduler = Scheduler({'timeline': (50, 1, 1)})
+        times = []
+        def call():
+            times.append(scheduler.call('timeline', time.monotonic))
+
+        threads = [threading.Thread(target=call) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        times.sort()
+        self.assertGreaterEqual(times[-1] - times[0], 0.07)
+        self.assertGreater(scheduler.stats()['timeline']['max_queued'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
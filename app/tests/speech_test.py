@@ -0,0 +1,39 @@
+import unittest, time
+from unittest.mock import MagicMock
+from app.brain.speech import SpeechPool
+
+class SpeechPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.markov = MagicMock()
+        self.markov.generate.side_effect = ('speech %s' % i for i in range(1000))
+        self.pool = SpeechPool(self.markov, size=5)
+
+        # Don't start the background thread.
+        self.pool._thread = MagicMock()
+
+    def test_pop_empty_generates(self):
+        self.assertEqual(self.pool.pop(), 'speech 0')
+
+    def test_fill(self):
+        self.pool.fill()
+        self.assertEqual(len(self.pool), 5)
+        self.assertEqual(self.pool.pop(), 'speech 0')
+        self.assertEqual(len(self.pool), 4)
+
+    def test_invalidate(self):
+        self.pool.fill()
+        self.pool.invalidate()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.pool.pop(), 'speech 5')
+
+    def test_background_refill(self):
+        self.pool._thread = None
+        self.pool.pop()
+        for i in range(100):
+            if len(self.pool) == 5:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool), 5)
+
+if __name__ == '__main__':
+    unittest.main()
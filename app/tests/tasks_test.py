@@ -0,0 +1,63 @@
+import unittest, threading
+from app.brain.tasks import Task, Tasks
+
+class TaskTest(unittest.TestCase):
+    def test_run(self):
+        def func(progress):
+            progress(1, 2)
+            progress(2)
+        task = Task('foo', func).start()
+
+        self.assertTrue(task.join(5))
+        self.assertEqual(task.status, 'done')
+        self.assertEqual((task.done, task.total), (2, 2))
+        self.assertIsNotNone(task.finished_at)
+
+    def test_failure(self):
+        def func(progress):
+            raise Exception('oh no')
+        task = Task('foo', func).start()
+
+        self.assertTrue(task.join(5))
+        self.assertEqual(task.status, 'failed')
+        self.assertEqual(task.error, 'oh no')
+
+    def test_stats(self):
+        task = Task('foo', lambda progress: None)
+        self.assertEqual(task.stats()['id'], task.id)
+        self.assertEqual(task.stats()['status'], 'pending')
+
+
+class TasksTest(unittest.TestCase):
+    def setUp(self):
+        self.tasks = Tasks()
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def wait(self, progress):
+        self.release.wait(5)
+
+    def test_get(self):
+        task = self.tasks.start('foo', self.wait)
+        self.assertIs(self.tasks.get(task.id), task)
+        self.assertIsNone(self.tasks.get('nope'))
+
+    def test_one_running_per_name(self):
+        task = self.tasks.start('foo', self.wait)
+        self.assertIs(self.tasks.start('foo', self.wait), task)
+        self.assertIsNot(self.tasks.start('bar', self.wait), task)
+
+        self.release.set()
+        task.join(5)
+        self.assertIsNot(self.tasks.start('foo', self.wait), task)
+
+    def test_max_kept(self):
+        self.tasks = Tasks(max_kept=2)
+        self.release.set()
+        first = self.tasks.start('foo', self.wait)
+        first.join(5)
+        for i in range(2):
+            self.tasks.start('foo', self.wait).join(5)
+        self.assertIsNone(self.tasks.get(first.id))
@@ -0,0 +1,71 @@
+import unittest
+from nltk.tokenize import sent_tokenize
+from app.brain.tokenizer import Tokenizer
+
+# Docs from the Markov tests, plus some tweet-like ones.
+corpus = [
+    'hey this is a test?',
+    'hey this is a test? this is only a test.',
+    'RT @foo this is not a drill, hey this is real.',
+    'is a test a test of a test',
+    'why hello there pal',
+    'Hello there! How are you? I am fine.',
+    'So   many    spaces. And “fancy” quotes – dashes too.'
+]
+
+class TokenizerTest(unittest.TestCase):
+    def setUp(self):
+        self.t = Tokenizer()
+
+    def test_tokenize(self):
+        self.assertEqual(self.t.tokenize('Hey, this is a TEST?'), ['hey', 'this', 'is', 'a', 'test'])
+
+    def test_tokenize_keeps_mentions(self):
+        self.assertEqual(self.t.tokenize('hi @Foo!'), ['hi', '@foo'])
+
+    def test_tokenize_stop_rule(self):
+        t = Tokenizer(stop_rule=lambda token: token == 'RT' or token[0] == '@')
+        self.assertEqual(t.tokenize('RT @foo: rt this'), ['rt', 'this'])
+
+    def test_tokens_are_interned(self):
+        a = self.t.tokenize('Hello')[0]
+        b = Tokenizer().tokenize(''.join(['HEL', 'LO']))[0]
+        self.assertIs(a, b)
+
+    def test_sentences(self):
+        self.assertEqual(self.t.sentences('Hello there! How are you? I am fine.'), [
+            ['hello', 'there'],
+            ['how', 'are', 'you'],
+            ['i', 'am', 'fine']
+        ])
+
+    def test_sentences_abbreviations(self):
+        self.assertEqual(len(self.t.sentences('Mr. Smith went to Washington. He liked it.')), 2)
+        self.assertEqual(len(self.t.sentences('Ask J. R. R. Tolkien, e.g. tomorrow.')), 1)
+
+    def test_sentences_ellipsis(self):
+        self.assertEqual(len(self.t.sentences('Wait... what? No way')), 2)
+        self.assertEqual(len(self.t.sentences('Wait... What? No way')), 3)
+
+    def test_sentences_closing_quotes(self):
+        self.assertEqual(self.t.sentences('"Go away." Fine.'), [['go', 'away'], ['fine']])
+
+    def test_sentences_leaves_out_empty(self):
+        t = Tokenizer(stop_rule=lambda token: token[0] == '@')
+        self.assertEqual(t.sentences('@foo. Hi! ... ?'), [['hi']])
+
+    def test_matches_sent_tokenize(self):
+        for doc in corpus:
+            expected = [self.t.tokenize(sent) for sent in sent_tokenize(doc)]
+            expected = [tokens for tokens in expected if tokens]
+            self.assertEqual(self.t.sentences(doc), expected)
+
+    def test_cache_is_bounded(self):
+        t = Tokenizer(max_cached=10)
+        t.tokenize(' '.join(str(i) for i in range(100)))
+        self.assertLessEqual(len(t._cache), 10)
+        self.assertEqual(t.tokenize('1 2 3'), ['1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
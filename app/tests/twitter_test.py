@@ -0,0 +1,133 @@
+import unittest
+from unittest.mock import patch
+from app.brain import twitter
+from tweepy import TweepError
+from app.brain.ratelimit import Scheduler
+from .fakes import FakeAPI, FakeClock, faux_error
+
+class TwitterTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeAPI({'foo': list(range(1, 451))})
+        patcher = patch('app.brain.twitter.api', new=self.api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(twitter.LIMITS, clock=self.clock, should_retry=twitter._should_retry)
+        patcher = patch('app.brain.twitter.scheduler', new=self.scheduler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tweets(self):
+        tweets = twitter.tweets('foo')
+        self.assertEqual(len(tweets), 200)
+        self.assertEqual(tweets[0], {
+            'body': 'tweet number 450',
+            'tid': 450,
+            'protected': False,
+            'retweeted': False
+        })
+        self.assertEqual(len(self.api.calls), 1)
+
+    def test_tweets_pages(self):
+        tweets = twitter.tweets('foo', pages=16)
+        self.assertEqual([tweet['tid'] for tweet in tweets], list(range(450, 0, -1)))
+
+        # It keeps going until a page comes back empty.
+        self.assertEqual(len(self.api.calls), 4)
+        self.assertEqual(self.api.calls[1]['max_id'], 250)
+        self.assertEqual(self.api.calls[2]['max_id'], 50)
+        self.assertEqual(self.api.calls[3]['max_id'], 0)
+
+    def test_tweets_short_pages(self):
+        # Hidden tweets make the first page come back short,
+        # but there are still older tweets to get.
+        self.api.hidden = set(range(300, 351))
+        tweets = twitter.tweets('foo', pages=16)
+        self.assertEqual([tweet['tid'] for tweet in tweets],
+                         [tid for tid in range(450, 0, -1) if tid not in self.api.hidden])
+
+    def test_tweets_limited_pages(self):
+        tweets = twitter.tweets('foo', pages=2)
+        self.assertEqual(len(tweets), 400)
+        self.assertEqual(len(self.api.calls), 2)
+
+    def test_tweets_since_id(self):
+        tweets = twitter.tweets('foo', since_id=440, pages=16)
+        self.assertEqual([tweet['tid'] for tweet in tweets], list(range(450, 440, -1)))
+        self.assertEqual(len(self.api.calls), 1)
+        self.assertEqual(self.api.calls[0]['since_id'], 440)
+
+    def test_tweets_since_id_pages(self):
+        tweets = twitter.tweets('foo', since_id=10, pages=16)
+        self.assertEqual([tweet['tid'] for tweet in tweets], list(range(450, 10, -1)))
+        self.assertTrue(all(call['since_id'] == 10 for call in self.api.calls))
+
+        # No need to ask for a page once it's back to `since_id`.
+        self.assertEqual(len(self.api.calls), 3)
+
+    def test_tweets_max_id(self):
+        tweets = twitter.tweets('foo', max_id=100, pages=16)
+        self.assertEqual([tweet['tid'] for tweet in tweets], list(range(100, 0, -1)))
+
+    def test_tweets_retries_rate_limit(self):
+        self.api.errors['user_timeline'] = [faux_error(429), faux_error(503)]
+        tweets = twitter.tweets('foo')
+        self.assertEqual(len(tweets), 200)
+        self.assertEqual(self.scheduler.stats()['user_timeline']['retries'], 2)
+
+    def test_tweets_does_not_retry_other_errors(self):
+        self.api.errors['user_timeline'] = [faux_error(404)]
+        self.assertRaises(TweepError, twitter.tweets, 'foo')
+        self.assertEqual(self.scheduler.stats()['user_timeline']['retries'], 0)
+
+    def test_tweets_are_spaced(self):
+        # More pages than the burst allows for.
+        self.api.timelines['foo'] = list(range(1, 5000))
+        twitter.tweets('foo', count=100, pages=20)
+        self.assertTrue(self.clock.sleeps)
+        self.assertGreater(self.scheduler.stats()['user_timeline']['waited'], 0)
+
+    def test_tweet(self):
+        twitter.tweet('hello')
+        self.assertEqual(self.api.tweeted, ['hello'])
+
+    def test_retweet(self):
+        twitter.retweet(123)
+        self.assertEqual(self.api.retweeted, [123])
+
+    def test_retweet_forbidden(self):
+        self.api.errors['retweet'] = [faux_error(403)]
+        twitter.retweet(123)
+        self.assertEqual(self.api.retweeted, [])
+
+    def test_tweet_forbidden(self):
+        self.api.errors['update_status'] = [faux_error(403)]
+        twitter.tweet('hello')
+        self.assertEqual(self.api.tweeted, [])
+
+    def test_tweet_not_retried_on_server_error(self):
+        # The tweet may have gone out, so it isn't sent again.
+        self.api.errors['update_status'] = [faux_error(503)]
+        self.assertRaises(TweepError, twitter.tweet, 'hello')
+        self.assertEqual(self.api.tweeted, [])
+        self.assertEqual(self.scheduler.stats()['statuses']['retries'], 0)
+
+    def test_retweet_retries_rate_limit(self):
+        self.api.errors['retweet'] = [faux_error(429)]
+        twitter.retweet(123)
+        self.assertEqual(self.api.retweeted, [123])
+        self.assertEqual(self.scheduler.stats()['statuses']['retries'], 1)
+
+    def test_tweet_error(self):
+        self.api.errors['update_status'] = [faux_error(401)]
+        self.assertRaises(TweepError, twitter.tweet, 'hello')
+
+    def test_status(self):
+        self.assertEqual(twitter._status(faux_error(429)), 429)
+        self.assertEqual(twitter._status(TweepError('Failed to send request: 403 Forbidden')), 403)
+        self.assertEqual(twitter._status(TweepError('Failed to send request')), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest, threading, time
+from unittest.mock import MagicMock
+from app import metrics
+from app.jobs.worker import Job, Worker
+
+class JobTest(unittest.TestCase):
+    def test_run(self):
+        func = MagicMock()
+        job = Job('foo', func, 10)
+        job.run()
+        self.assertTrue(func.called)
+
+        stats = job.stats()
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['failures'], 0)
+        self.assertIsNotNone(stats['last_duration'])
+
+    def test_run_failure(self):
+        job = Job('foo', MagicMock(side_effect=ValueError), 10)
+        job.run()
+        self.assertEqual(job.stats()['failures'], 1)
+        self.assertEqual(job.stats()['runs'], 1)
+
+    def test_run_metrics(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        Job('foo', MagicMock(), 10).run()
+        Job('foo', MagicMock(side_effect=ValueError), 10).run()
+        rendered = metrics.render()
+        self.assertIn('brain_worker_job_seconds_count{job="foo"} 2', rendered)
+        self.assertIn('brain_worker_job_failures_total{job="foo"} 1', rendered)
+
+    def test_durations(self):
+        job = Job('foo', lambda: time.sleep(0.05), 10)
+        job.run()
+        job.run()
+        stats = job.stats()
+        self.assertGreaterEqual(stats['mean_duration'], 0.05)
+        self.assertGreaterEqual(stats['max_duration'], stats['last_duration'])
+
+    def test_schedule_jitter(self):
+        job = Job('foo', MagicMock(), 100, jitter=0.1)
+        runs = set()
+        for i in range(100):
+            job.schedule(1000)
+            self.assertGreaterEqual(job.next_run, 1090)
+            self.assertLessEqual(job.next_run, 1110)
+            runs.add(job.next_run)
+        self.assertGreater(len(runs), 1)
+
+    def test_schedule_without_jitter(self):
+        job = Job('foo', MagicMock(), 100, jitter=0)
+        job.schedule(1000)
+        self.assertEqual(job.next_run, 1100)
+
+
+class WorkerTest(unittest.TestCase):
+    def run_worker(self, worker, seconds):
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        time.sleep(seconds)
+        worker.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_runs_jobs_on_intervals(self):
+        fast, slow = MagicMock(), MagicMock()
+        worker = Worker([Job('fast', fast, 0.02, jitter=0), Job('slow', slow, 0.5, jitter=0)])
+        self.run_worker(worker, 0.3)
+        self.assertGreater(fast.call_count, 5)
+        self.assertEqual(slow.call_count, 1)
+
+    def test_keeps_running_after_failure(self):
+        func = MagicMock(side_effect=ValueError)
+        worker = Worker([Job('foo', func, 0.02, jitter=0)])
+        self.run_worker(worker, 0.2)
+        self.assertGreater(func.call_count, 1)
+        self.assertEqual(worker.stats()['foo']['failures'], func.call_count)
+
+    def test_stop_checkpoints(self):
+        checkpoint = MagicMock()
+        worker = Worker([Job('foo', MagicMock(), 60)], checkpoint=checkpoint)
+        self.run_worker(worker, 0.1)
+        self.assertEqual(checkpoint.call_count, 1)
+
+    def test_stop_finishes_current_job(self):
+        finished = []
+        def job():
+            time.sleep(0.2)
+            finished.append(True)
+
+        checkpoint = MagicMock(side_effect=lambda: self.assertEqual(finished, [True]))
+        worker = Worker([Job('foo', job, 60, jitter=0)], checkpoint=checkpoint)
+        self.run_worker(worker, 0.05)
+        self.assertEqual(finished, [True])
+        self.assertTrue(checkpoint.called)
+
+    def test_stats(self):
+        worker = Worker([Job('foo', MagicMock(), 0.02, jitter=0), Job('bar', MagicMock(), 60)])
+        self.run_worker(worker, 0.1)
+        stats = worker.stats()
+        self.assertGreater(stats['foo']['runs'], 0)
+        self.assertEqual(stats['bar']['runs'], 0)
+        self.assertIsNone(stats['bar']['last_duration'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
-from app import app
+from app import app, brain
 
 if __name__ == '__main__':
-    app.run(debug=False, port=5001)
\ No newline at end of file
+    # Load the brain in the background while the app starts up.
+    brain.warm()
+
+    # Keep up with what the worker trains the brain on.
+    brain.follow()
+    app.run(debug=False, port=5001)
@@ -1,14 +1,14 @@
-import json
-from app.brain import train
-
-#f = open('/Users/ftseng/Desktop/articles.json', 'r')
-#data = json.load(f)
-#docs = [article['text'] for article in data]
-
-
-#f = open('/Users/ftseng/Downloads/text datasets/imdb_plots.puretext.json', 'r')
-#docs = json.load(f)
-
-print(len(docs))
-
-#train(docs)
+# Bulk train the brain on a corpus file.
+# The docs are streamed, so the file can be larger than memory.
+#
+#   $ python brain.train.py articles.jsonl text
+#   $ python brain.train.py imdb_plots.puretext.json
+#   $ python brain.train.py sentences.txt
+
+import sys
+from app.brain import train, corpus
+
+if __name__ == '__main__':
+    filepath = sys.argv[1]
+    field = sys.argv[2] if len(sys.argv) > 2 else None
+    train(corpus.read(filepath, field=field))
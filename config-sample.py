@@ -2,6 +2,9 @@ CSRF_ENABLED = True
 SECRET_KEY = 'some-passphrase'
 MONGODB_SETTINGS = {'DB': 'pubsci_brain'}
 
+# Whether or not to record metrics (served at /metrics).
+METRICS_ENABLED = True
+
 AUTH_USER = 'admin'
 AUTH_PASS = 'password'
 
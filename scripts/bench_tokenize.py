@@ -0,0 +1,81 @@
+# Benchmark the training tokenizer against the old
+# NLTK sent_tokenize + per-token strip/intern/lower path,
+# and check how often they agree.
+#
+#   $ python scripts/bench_tokenize.py [corpus file] [field]
+#
+# Without a corpus file, some tweet-like docs are made up.
+#
+# This needs NLTK's punkt data (see the readme),
+# since that's what the old path ran on;
+# it won't time the new path against anything else.
+
+import random, string, sys, time
+from nltk.tokenize import sent_tokenize
+from app.brain import corpus
+from app.brain.markov import TRAINING_TOKENIZER, _stop_rule
+
+PUNCTUATION = string.punctuation.replace('@', '') + '“”‘’–"'
+
+
+def old_tokenize(doc, stop_rule):
+    tokens = []
+    for token in doc.split(' '):
+        token = sys.intern(token.strip(PUNCTUATION))
+        if not token or stop_rule(token):
+            continue
+        tokens.append(token.lower())
+    return tokens
+
+
+def old_sentences(doc):
+    sentences = []
+    for sent in sent_tokenize(doc):
+        tokens = old_tokenize(sent, stop_rule=_stop_rule)
+        if tokens:
+            sentences.append(tokens)
+    return sentences
+
+
+def fake_docs(n, seed=0):
+    rand = random.Random(seed)
+    words = ['the', 'brain', 'Science', 'is', 'a', 'test', 'of', 'public', 'data', 'we',
+             'think', 'about', 'this', 'new', 'paper', 'on', 'climate', 'and', 'why']
+    ends = ['.', '!', '?', ',', '', '', '']
+    docs = []
+    for i in range(n):
+        tokens = []
+        if rand.random() < 0.2:
+            tokens += ['RT', '@muse%s:' % rand.randint(0, 50)]
+        for j in range(rand.randint(5, 25)):
+            tokens.append(rand.choice(words) + rand.choice(ends))
+        docs.append(' '.join(tokens))
+    return docs
+
+
+def bench(func, docs):
+    started = time.perf_counter()
+    results = [func(doc) for doc in docs]
+    return results, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    try:
+        sent_tokenize('Test.')
+    except LookupError:
+        sys.exit('The punkt data is missing; get it with:\n\n  $ python -m nltk.downloader punkt\n')
+
+    if len(sys.argv) > 1:
+        docs = list(corpus.read(sys.argv[1], field=sys.argv[2] if len(sys.argv) > 2 else None))
+    else:
+        docs = fake_docs(20000)
+
+    old, old_time = bench(old_sentences, docs)
+    new, new_time = bench(TRAINING_TOKENIZER.sentences, docs)
+    agree = sum(1 for a, b in zip(old, new) if a == b)
+
+    print('%s docs' % len(docs))
+    print('old: %.3fs (%.0f docs/sec)' % (old_time, len(docs) / old_time))
+    print('new: %.3fs (%.0f docs/sec)' % (new_time, len(docs) / new_time))
+    print('speedup: %.1fx' % (old_time / new_time))
+    print('identical output for %s of %s docs (%.1f%%)' % (agree, len(docs), 100 * agree / len(docs)))
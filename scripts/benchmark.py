@@ -0,0 +1,333 @@
+# Benchmark the brain's hot paths: Markov training, generation
+# and consolidation, classifier training and classification,
+# and pondering end to end.
+#
+#   $ python scripts/benchmark.py
+#   $ python scripts/benchmark.py --sizes 1000,10000 --ngrams 1,2,3 --output bench.json
+#   $ python scripts/benchmark.py --corpus sentences.txt --compare bench.json
+#
+# Reports throughput, latency percentiles, peak memory (via tracemalloc,
+# on a separate run so it doesn't skew the timings) and saved sizes,
+# and saves the results as JSON so they can be compared across commits.
+#
+# Twitter and the Tweet/Muse collections are faked (with the test fakes),
+# and the models are saved to a temporary directory,
+# so nothing is fetched, tweeted, or written to the db.
+# The app's setup is faked too, since it connects to the db
+# (and makes a Config there) as soon as anything in the app is imported,
+# so no db (or Twitter credentials) are needed at all.
+
+import argparse, json, logging, os, pickle, platform, random, shutil, subprocess, sys, tempfile, time, tracemalloc, types
+from unittest.mock import MagicMock, patch
+import numpy as np
+
+
+def fake_app():
+    """
+    Stands in for the app package's setup, its db models and config,
+    and the Twitter client, so the brain can be imported without them.
+    """
+    app = types.ModuleType('app')
+    app.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')]
+
+    models = types.ModuleType('app.models')
+    models.Tweet, models.Muse, models.Doc, models.Config = MagicMock(), MagicMock(), MagicMock(), MagicMock()
+
+    config = types.ModuleType('app.config')
+    config.config = lambda: MagicMock()
+    config.invalidate = lambda: None
+
+    twitter = types.ModuleType('app.brain.twitter')
+
+    sys.modules.update({'app': app, 'app.models': models, 'app.config': config, 'app.brain.twitter': twitter})
+
+fake_app()
+
+from app import brain
+from app.brain import corpus
+from app.brain.classifier import Classifier
+from app.brain.markov import Markov
+from app.tests.fakes import FakeTwitter, FakeCollection, FakeTweet, faux_tweet
+
+
+def synthetic_docs(n, seed=0, vocab_size=5000):
+    """
+    Makes up `n` tweet-like docs, with words drawn from
+    a Zipfian vocabulary so some are far more common than others.
+    """
+    rand = random.Random(seed)
+    vocab = ['w%s' % i for i in range(vocab_size)]
+    weights = list(np.cumsum([1 / (rank + 1) for rank in range(vocab_size)]))
+    ends = ['.', '!', '?', ',', '', '', '', '', '']
+
+    docs = []
+    for i in range(n):
+        tokens = []
+        if rand.random() < 0.1:
+            tokens += ['RT', '@muse%s:' % rand.randint(0, 100)]
+        words = rand.choices(vocab, cum_weights=weights, k=rand.randint(5, 25))
+        tokens += [word + rand.choice(ends) for word in words]
+        docs.append(' '.join(tokens))
+    return docs
+
+
+def percentiles(latencies):
+    """
+    Latency percentiles, in milliseconds.
+    """
+    if not latencies:
+        return {}
+    return {'p%s_ms' % p: float(np.percentile(latencies, p)) * 1000 for p in (50, 90, 99)}
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    The peak memory (in bytes) allocated while running `func`.
+    """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_markov(docs, n, tmpdir, generations):
+    results = []
+    filepath = os.path.join(tmpdir, 'markov-%s.pickle' % n)
+
+    m = Markov(ngram_size=n, filepath=filepath, compact=True)
+    _, elapsed = timed(m.train, docs)
+    m.checkpoint()
+    memory = peak_memory(Markov(ngram_size=n, filepath=os.path.join(tmpdir, 'traced-markov-%s.pickle' % n), compact=True).train, docs)
+    results.append({
+        'benchmark': 'markov.train',
+        'elapsed': elapsed,
+        'docs_per_sec': len(docs) / elapsed,
+        'peak_memory': memory,
+        'saved_size': os.path.getsize(m.mapped_filepath),
+        'pickle_size': len(pickle.dumps(m.knowledge.to_dict(), pickle.HIGHEST_PROTOCOL))
+    })
+
+    # Seeded, so the same chains are generated each run.
+    random.seed(0)
+    latencies = []
+    chains = []
+    for i in range(generations):
+        tokens, length = m._chain()
+        chains.append(tokens)
+        _, elapsed = timed(m.generate)
+        latencies.append(elapsed)
+    results.append(dict({
+        'benchmark': 'markov.generate',
+        'per_sec': len(latencies) / sum(latencies)
+    }, **percentiles(latencies)))
+
+    latencies = [timed(m._consolidate, tokens)[1] for tokens in chains]
+    results.append(dict({
+        'benchmark': 'markov.consolidate',
+        'per_sec': len(latencies) / sum(latencies)
+    }, **percentiles(latencies)))
+
+    _, elapsed = timed(m.generate_many, generations, seed=0)
+    results.append({
+        'benchmark': 'markov.generate_many',
+        'elapsed': elapsed,
+        'per_sec': generations / elapsed
+    })
+
+    for result in results:
+        result['ngram_size'] = n
+    return results
+
+
+def bench_classifier(docs, tmpdir, batch_size=100):
+    results = []
+    rand = random.Random(0)
+    labels = [rand.randint(0, 1) for doc in docs]
+
+    clf = Classifier(filepath=os.path.join(tmpdir, 'classifier.pickle'), running_idf=True)
+    _, elapsed = timed(clf.train, docs, labels)
+    clf.checkpoint()
+    traced = Classifier(filepath=os.path.join(tmpdir, 'traced-classifier.pickle'), running_idf=True)
+    results.append({
+        'benchmark': 'classifier.train',
+        'elapsed': elapsed,
+        'docs_per_sec': len(docs) / elapsed,
+        'peak_memory': peak_memory(traced.train, docs, labels, save=False),
+        'pickle_size': os.path.getsize(clf.filepath)
+    })
+
+    latencies = []
+    for i in range(0, len(docs), batch_size):
+        _, elapsed = timed(clf.classify, docs[i:i+batch_size])
+        latencies.append(elapsed)
+    results.append(dict({
+        'benchmark': 'classifier.classify',
+        'docs_per_sec': len(docs) / sum(latencies),
+        'batch_size': batch_size
+    }, **percentiles(latencies)))
+
+    return results
+
+
+def bench_ponder(docs, tmpdir, muses=10):
+    """
+    Ponders with the tweets spread over `muses` fake Muses.
+    """
+    timelines = {}
+    fakes = []
+    per_muse = max(1, len(docs) // muses)
+    for i in range(muses):
+        username = 'muse%s' % i
+        muse = MagicMock(username=username, negative=i % 2 == 1, last_tid=None)
+        fakes.append(muse)
+        timelines[username] = [faux_tweet(i * per_muse + j, body=doc) for j, doc in enumerate(docs[i*per_muse:(i+1)*per_muse])]
+
+    Muse = MagicMock()
+    Muse.objects.side_effect = lambda negative: [muse for muse in fakes if muse.negative == negative]
+    FakeTweet.collection = FakeCollection()
+    config = MagicMock(retweet_threshold=1.1, max_retweets=0)
+
+    with patch('app.brain.twitter', new=FakeTwitter(timelines)), \
+         patch('app.brain.Muse', new=Muse), \
+         patch('app.brain.Tweet', new=FakeTweet), \
+         patch('app.brain.config', new=lambda: config), \
+         patch('app.brain.CLS', new=Classifier(filepath=os.path.join(tmpdir, 'ponder-classifier.pickle'), running_idf=True)), \
+         patch('app.brain.MKV', new=Markov(filepath=os.path.join(tmpdir, 'ponder-markov.pickle'), compact=True)):
+        _, elapsed = timed(brain.ponder)
+
+    tweets = sum(len(timeline) for timeline in timelines.values())
+    return [{
+        'benchmark': 'ponder',
+        'elapsed': elapsed,
+        'tweets_per_sec': tweets / elapsed,
+        'muses': muses
+    }]
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(corpora, sizes, ngrams, generations):
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='brain-bench-')
+    try:
+        for name, docs in corpora.items():
+            for size in sizes:
+                sample = docs[:size]
+                if len(sample) < size:
+                    print('Only %s docs in %s, skipping size %s.' % (len(docs), name, size), file=sys.stderr)
+                    continue
+
+                # Each run starts from scratch.
+                workdir = tempfile.mkdtemp(dir=tmpdir)
+                benches = []
+                for n in ngrams:
+                    benches += bench_markov(sample, n, workdir, generations)
+                benches += bench_classifier(sample, workdir)
+                benches += bench_ponder(sample, workdir)
+
+                for result in benches:
+                    result.update(corpus=name, size=size)
+                    results.append(result)
+                    print(summarize(result))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def key(result):
+    return (result['benchmark'], result['corpus'], result['size'], result.get('ngram_size'))
+
+
+def headline(result):
+    """
+    The metric to compare a benchmark by, higher being better.
+    """
+    for metric in ('docs_per_sec', 'tweets_per_sec', 'per_sec'):
+        if metric in result:
+            return metric
+
+
+def summarize(result):
+    details = ', '.join('%s=%s' % (k, round(v, 3) if isinstance(v, float) else v)
+                        for k, v in sorted(result.items()) if k not in ('benchmark', 'corpus', 'size', 'ngram_size'))
+    n = ' n=%s' % result['ngram_size'] if 'ngram_size' in result else ''
+    return '%s [%s, %s docs%s]: %s' % (result['benchmark'], result['corpus'], result['size'], n, details)
+
+
+def compare(results, baseline):
+    """
+    Prints how each benchmark's headline metric changed from a baseline.
+    """
+    previous = {key(result): result for result in baseline['results']}
+    print('\nCompared to %s:' % (baseline.get('commit') or 'baseline'))
+    for result in results:
+        before = previous.get(key(result))
+        metric = headline(result)
+        if before is None or metric not in before:
+            continue
+        change = (result[metric] - before[metric]) / before[metric] * 100
+        print('%s: %s %.1f -> %.1f (%+.1f%%)' % (summarize(result).split(':')[0], metric, before[metric], result[metric], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the brain\'s hot paths.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma-separated corpus sizes')
+    parser.add_argument('--ngrams', default='1,2,3', help='comma-separated ngram sizes')
+    parser.add_argument('--generations', type=int, default=200, help='how many generations to time')
+    parser.add_argument('--corpus', help='a sample corpus file to benchmark as well')
+    parser.add_argument('--field', help='the doc text field, for JSON corpora')
+    parser.add_argument('--output', help='where to save the results as JSON')
+    parser.add_argument('--compare', help='results JSON to compare against')
+    args = parser.parse_args(argv)
+
+    # The brain logs a lot while training and pondering.
+    logging.disable(logging.INFO)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    ngrams = [int(n) for n in args.ngrams.split(',')]
+
+    corpora = {'synthetic': synthetic_docs(max(sizes))}
+    if args.corpus:
+        docs = []
+        for doc in corpus.read(args.corpus, field=args.field):
+            docs.append(doc)
+            if len(docs) >= max(sizes):
+                break
+        corpora[os.path.basename(args.corpus)] = docs
+
+    results = run(corpora, sizes, ngrams, args.generations)
+    output = {
+        'commit': commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(output, file, indent=2)
+        print('Saved results to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(results, json.load(file))
+
+    return output
+
+
+if __name__ == '__main__':
+    main()
@@ -35,4 +35,4 @@ if __name__ == '__main__':
         except IndexError:
             pass
 
-    # brain.MKV.save()
\ No newline at end of file
+    # brain.MKV.checkpoint()
\ No newline at end of file
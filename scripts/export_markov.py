@@ -0,0 +1,28 @@
+# Export a pickled Markov knowledge to the memory-mapped format,
+# which the Markov will load instead of the pickle from then on.
+#
+#   $ python scripts/export_markov.py [app/brain/markov.pickle]
+
+import sys
+from app.brain.markov import Markov
+
+
+def export(filepath):
+    """
+    Writes the knowledge pickled at `filepath`
+    to a '.mkv' file alongside it.
+
+    It's loaded and checkpointed through a Markov,
+    so any training logged since it was pickled is included,
+    and the '.mkv' file is saved with the seq of the last of it
+    (as well as which ngram sizes it counts),
+    so loading it doesn't replay that training again.
+    """
+    markov = Markov(filepath=filepath, compact=True)
+    markov.compact()
+    return markov.mapped_filepath
+
+
+if __name__ == '__main__':
+    filepath = sys.argv[1] if len(sys.argv) > 1 else 'app/brain/markov.pickle'
+    print('Exported to %s' % export(filepath))